@@ -12,4 +12,7 @@ if [[ -z $PEEWEE_DATABASE_URL ]] ; then
 fi
 mkdir ~/.pacifica-ingest/
 printf '[database]\npeewee_url = '${PEEWEE_DATABASE_URL}'\n' > ~/.pacifica-ingest/config.ini
-celery -A pacifica.ingest.tasks worker --loglevel=info
+celery -A pacifica.ingest.tasks worker --loglevel=info \
+  ${CELERY_QUEUES:+--queues=$CELERY_QUEUES} \
+  ${CELERY_CONCURRENCY:+--concurrency=$CELERY_CONCURRENCY} \
+  ${CELERY_PREFETCH:+--prefetch-multiplier=$CELERY_PREFETCH}
@@ -5,13 +5,17 @@ import os
 import getpass
 from sys import argv as sys_argv
 from time import sleep
+from datetime import datetime, timedelta
 from threading import Thread
 from argparse import ArgumentParser, SUPPRESS
 import cherrypy
 from peewee import OperationalError
 from .rest import Root, error_page_default
 from .tasks import move, ingest
-from .orm import OrmSync, update_state, IngestStateSystem, SCHEMA_MAJOR, SCHEMA_MINOR
+from .orm import OrmSync, update_state, prune_states, read_stages, IngestStateSystem, SCHEMA_MAJOR, SCHEMA_MINOR
+from .utils import stage_summary
+from .config import get_config, reload_config
+from .profiling import PROFILE_MODES, profile_hot_spots
 from .globals import CONFIG_FILE, CHERRYPY_CONFIG
 
 
@@ -79,6 +83,9 @@ def cmd(argv=None):
     setup_db_subparser(subparsers)
     setup_dbchk_subparser(subparsers)
     setup_retry_subparser(subparsers)
+    setup_prune_subparser(subparsers)
+    setup_stages_subparser(subparsers)
+    setup_profile_subparser(subparsers)
     args = parser.parse_args(argv)
     return args.func(args)
 
@@ -140,9 +147,69 @@ def setup_retry_subparser(subparsers):
         '--job_id', dest='job_id',
         help='Job ID to use when ingesting.'
     )
+    retry_parser.add_argument(
+        '--resume', default=False,
+        dest='resume', action='store_true',
+        help='Skip files the job already ingested.'
+    )
+    retry_parser.add_argument(
+        '--profile', dest='profile', default=None, choices=PROFILE_MODES,
+        help='Profile the job overriding the profile_mode option.'
+    )
     retry_parser.set_defaults(func=cli_ingest_move)
 
 
+def setup_prune_subparser(subparsers):
+    """Setup the prune subparser."""
+    prune_parser = subparsers.add_parser(
+        'prune',
+        description='Move completed jobs out of the job state table.'
+    )
+    prune_parser.add_argument(
+        '--days', dest='days', type=int, default=None,
+        help='Move jobs completed more than this many days ago.'
+    )
+    prune_parser.add_argument(
+        '--batch-size', dest='batch_size', type=int, default=None,
+        help='Number of jobs moved in each transaction.'
+    )
+    prune_parser.add_argument(
+        '--export', dest='export', default=None,
+        help='Append the jobs to this JSON lines file instead of the history table.'
+    )
+    prune_parser.set_defaults(func=prune_jobs)
+
+
+def setup_stages_subparser(subparsers):
+    """Setup the stages subparser."""
+    stages_parser = subparsers.add_parser(
+        'stages',
+        description='Report the duration and throughput of job stages.'
+    )
+    stages_parser.add_argument(
+        '--days', dest='days', type=float, default=7,
+        help='Report the stages finished in the last days.'
+    )
+    stages_parser.set_defaults(func=stage_report)
+
+
+def setup_profile_subparser(subparsers):
+    """Setup the profile subparser."""
+    profile_parser = subparsers.add_parser(
+        'profile',
+        description='Summarize the hot spots of a profiled job.'
+    )
+    profile_parser.add_argument(
+        '--job_id', dest='job_id', required=True,
+        help='Job ID of the profiled job.'
+    )
+    profile_parser.add_argument(
+        '--top', dest='top', type=int, default=20,
+        help='Number of hot spots to show for each task.'
+    )
+    profile_parser.set_defaults(func=profile_report)
+
+
 def update_wrapper(args):
     """Call update state with appropriate args."""
     return update_state(
@@ -177,11 +244,71 @@ def dbchk(args):
     return bool2cmdint(IngestStateSystem.is_safe())
 
 
+def prune_jobs(args):
+    """Move the completed jobs older than the retention window out of the state table."""
+    os.environ['INGEST_CONFIG'] = args.config
+    OrmSync.dbconn_blocking()
+    days = args.days
+    if days is None:
+        days = get_config().getint('database', 'retention_days')
+    batch_size = args.batch_size or get_config().getint('database', 'prune_batch_size')
+    if days <= 0:
+        print('Set the days to keep completed jobs with --days or retention_days.')
+        return -1
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    if args.export:
+        with open(args.export, 'a') as export_fd:
+            total = prune_states(cutoff, batch_size, export_fd)
+    else:
+        total = prune_states(cutoff, batch_size)
+    print('Pruned {} job states.'.format(total))
+    return 0
+
+
+def stage_report(args):
+    """Print the percentiles of the stage durations and throughput."""
+    os.environ['INGEST_CONFIG'] = args.config
+    OrmSync.dbconn_blocking()
+    summary = stage_summary(read_stages(datetime.utcnow() - timedelta(days=args.days)))
+    print('{:<20} {:>8} {:>8} {:>10} {:>10} {:>10} {:>10}'.format(
+        'stage', 'count', 'failed', 'p50 s', 'p95 s', 'p99 s', 'p50 MB/s'))
+    for task, task_summary in sorted(summary.items()):
+        seconds = task_summary['seconds']
+        throughput = task_summary['throughput']['p50']
+        print('{:<20} {:>8} {:>8} {:>10.2f} {:>10.2f} {:>10.2f} {:>10}'.format(
+            task, task_summary['count'], task_summary['failed'],
+            seconds['p50'], seconds['p95'], seconds['p99'],
+            '-' if throughput is None else '{:.2f}'.format(throughput / 10 ** 6)
+        ))
+    return 0
+
+
+def profile_report(args):
+    """Print the summary and hot spots of the profiles of a job."""
+    os.environ['INGEST_CONFIG'] = args.config
+    for task, profile in profile_hot_spots(args.job_id, args.top).items():
+        summary = profile['summary']
+        print('{} job {} {} {:.2f}s wall {:.2f}s cpu {:.1f} MB peak memory'.format(
+            task, summary['job_id'], summary['mode'], summary['seconds'],
+            summary['cpu_seconds'], summary['peak_memory'] / 10 ** 6))
+        unit = 's' if summary['mode'] == 'cprofile' else 'samples'
+        print('{:>12} {:>12}  function'.format('own ' + unit, 'total ' + unit))
+        for function, own, total in profile['hot_spots']:
+            print('{:>12.3f} {:>12.3f}  {}'.format(own, total, function))
+        print('top allocations')
+        for site, size in summary['top_allocations']:
+            print('{:>12.1f} KB  {}'.format(size / 10 ** 3, site))
+    return 0
+
+
 def cli_ingest_move(args):
     """Call a local ingest or move action."""
+    if args.profile:
+        os.environ['PROFILE_MODE'] = args.profile
+        reload_config()
     if args.move:
         return move(args.job_id, args.file_path, args.username)
-    return ingest(args.job_id, args.file_path, args.username)
+    return ingest(args.job_id, args.file_path, args.username, args.resume)
 
 
 if __name__ == '__main__':
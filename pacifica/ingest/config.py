@@ -1,14 +1,61 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 """Configuration reading and validation module."""
-from os import getenv
+from os import getenv, stat
+from time import monotonic
+from threading import Lock
 from configparser import ConfigParser as SafeConfigParser
-from pacifica.ingest.globals import CONFIG_FILE
+from pacifica.ingest.globals import CONFIG_FILE, CONFIG_CHECK_INTERVAL
 
+CONFIG_LOCK = Lock()
+CONFIG_CACHE = {'config': None, 'mtime': None, 'checked': 0.0}
 
-def get_config():
-    """Return the ConfigParser object with defaults set."""
-    configparser = SafeConfigParser()
+
+class ConfigSnapshot(SafeConfigParser):
+    """ConfigParser that is read only once it has been loaded."""
+
+    frozen = False
+
+    def freeze(self):
+        """Stop any further changes to the configuration."""
+        self.frozen = True
+
+    def _check_frozen(self):
+        """Raise an error if the configuration is read only."""
+        if self.frozen:
+            raise TypeError('Configuration is read only, use reload_config().')
+
+    def add_section(self, section):
+        """Add a section if the configuration is not read only."""
+        self._check_frozen()
+        return super().add_section(section)
+
+    def set(self, section, option, value=None):
+        """Set an option if the configuration is not read only."""
+        self._check_frozen()
+        return super().set(section, option, value)
+
+    def remove_section(self, section):
+        """Remove a section if the configuration is not read only."""
+        self._check_frozen()
+        return super().remove_section(section)
+
+    def remove_option(self, section, option):
+        """Remove an option if the configuration is not read only."""
+        self._check_frozen()
+        return super().remove_option(section, option)
+
+
+def config_mtime():
+    """Return the modification time of the config file or None."""
+    try:
+        return stat(CONFIG_FILE).st_mtime
+    except OSError:
+        return None
+
+
+def set_ingest_defaults(configparser):
+    """Add the ingest section with its defaults to the ConfigParser object."""
     configparser.add_section('ingest')
     configparser.set('ingest', 'auth_header', getenv(
         'INGEST_AUTH_HEADER', 'X-Http-Authed-User'))
@@ -18,18 +65,98 @@ def get_config():
         'TRANSFER_SIZE', '4 Mb'))
     configparser.set('ingest', 'volume_path', getenv(
         'VOLUME_PATH', '/tmp'))
+    configparser.set('ingest', 'upload_workers', getenv(
+        'UPLOAD_WORKERS', '1'))
+    configparser.set('ingest', 'http_pool_size', getenv(
+        'HTTP_POOL_SIZE', '10'))
+    configparser.set('ingest', 'receive_hashtype', getenv(
+        'RECEIVE_HASHTYPE', 'sha1'))
+    configparser.set('ingest', 'mmap_upload', getenv(
+        'MMAP_UPLOAD', 'True'))
+    configparser.set('ingest', 'upload_chunk_size', getenv(
+        'UPLOAD_CHUNK_SIZE', '1 Mb'))
+    configparser.set('ingest', 'dedup_index', getenv(
+        'DEDUP_INDEX', 'False'))
+    configparser.set('ingest', 'dedup_max_entries', getenv(
+        'DEDUP_MAX_ENTRIES', '1000000'))
+    configparser.set('ingest', 'dedup_reference_url', getenv(
+        'DEDUP_REFERENCE_URL', ''))
+    configparser.set('ingest', 'move_workers', getenv(
+        'MOVE_WORKERS', '8'))
+    configparser.set('ingest', 'move_preflight', getenv(
+        'MOVE_PREFLIGHT', 'False'))
+    configparser.set('ingest', 'fanout_batch_size', getenv(
+        'FANOUT_BATCH_SIZE', '0 Mb'))
+    configparser.set('ingest', 'large_job_size', getenv(
+        'LARGE_JOB_SIZE', '1 Gb'))
+    configparser.set('ingest', 'large_job_files', getenv(
+        'LARGE_JOB_FILES', '10000'))
+    configparser.set('ingest', 'max_large_jobs', getenv(
+        'MAX_LARGE_JOBS', '2'))
+    configparser.set('ingest', 'admission_min_memory', getenv(
+        'ADMISSION_MIN_MEMORY', '1 Gb'))
+    configparser.set('ingest', 'admission_min_disk', getenv(
+        'ADMISSION_MIN_DISK', '1 Gb'))
+    configparser.set('ingest', 'admission_wait', getenv(
+        'ADMISSION_WAIT', '60'))
+    configparser.set('ingest', 'fair_share', getenv(
+        'FAIR_SHARE', 'False'))
+    configparser.set('ingest', 'fair_share_max_running', getenv(
+        'FAIR_SHARE_MAX_RUNNING', '16'))
+    configparser.set('ingest', 'fair_share_weight', getenv(
+        'FAIR_SHARE_WEIGHT', '1'))
+    configparser.set('ingest', 'fair_share_weights', getenv(
+        'FAIR_SHARE_WEIGHTS', ''))
+    configparser.set('ingest', 'fair_share_cap', getenv(
+        'FAIR_SHARE_CAP', '4'))
+    configparser.set('ingest', 'fair_share_caps', getenv(
+        'FAIR_SHARE_CAPS', ''))
+    configparser.set('ingest', 'fair_share_interval', getenv(
+        'FAIR_SHARE_INTERVAL', '5'))
+    configparser.set('ingest', 'fair_share_timeout', getenv(
+        'FAIR_SHARE_TIMEOUT', '21600'))
+    configparser.set('ingest', 'progress_interval', getenv(
+        'PROGRESS_INTERVAL', '5'))
+    configparser.set('ingest', 'progress_step', getenv(
+        'PROGRESS_STEP', '1'))
+    configparser.set('ingest', 'state_poll_interval', getenv(
+        'STATE_POLL_INTERVAL', '1'))
+    configparser.set('ingest', 'state_wait_timeout', getenv(
+        'STATE_WAIT_TIMEOUT', '30'))
+    configparser.set('ingest', 'state_query_limit', getenv(
+        'STATE_QUERY_LIMIT', '1000'))
+    configparser.set('ingest', 'profile_mode', getenv(
+        'PROFILE_MODE', 'off'))
+    configparser.set('ingest', 'profile_interval', getenv(
+        'PROFILE_INTERVAL', '0.01'))
+
+
+def read_config():
+    """Return a new ConfigParser object with defaults set."""
+    configparser = ConfigSnapshot()
+    set_ingest_defaults(configparser)
     configparser.add_section('uniqueid')
     configparser.set('uniqueid', 'url', getenv(
         'UNIQUEID_URL', 'http://127.0.0.1:8051'))
+    configparser.set('uniqueid', 'lease_size', getenv(
+        'UNIQUEID_LEASE_SIZE', '0'))
     configparser.add_section('policy')
     configparser.set('policy', 'ingest_url', getenv(
         'POLICY_INGEST_URL', 'http://127.0.0.1:8181/ingest'))
+    configparser.set('policy', 'stream_body', getenv(
+        'POLICY_STREAM_BODY', 'False'))
+    configparser.set('policy', 'compress_body', getenv(
+        'POLICY_COMPRESS_BODY', 'False'))
     configparser.add_section('archiveinterface')
     configparser.set('archiveinterface', 'url', getenv(
         'ARCHIVEINTERFACE_URL', 'http://127.0.0.1:8080'))
     configparser.add_section('metadata')
     configparser.set('metadata', 'ingest_url', getenv(
         'METADATA_INGEST_URL', 'http://127.0.0.1:8121/ingest'))
+    configparser.set('metadata', 'stream_body', getenv(
+        'METADATA_STREAM_BODY', 'False'))
+    configparser.set('metadata', 'compress_body', getenv(
+        'METADATA_COMPRESS_BODY', 'False'))
     configparser.add_section('database')
     configparser.set('database', 'peewee_url', getenv(
         'PEEWEE_URL', 'sqliteext:///db.sqlite3'))
@@ -37,10 +164,66 @@ def get_config():
         'DATABASE_CONNECT_ATTEMPTS', '10'))
     configparser.set('database', 'connect_wait', getenv(
         'DATABASE_CONNECT_WAIT', '20'))
+    configparser.set('database', 'pool', getenv(
+        'DATABASE_POOL', 'False'))
+    configparser.set('database', 'pool_max_connections', getenv(
+        'DATABASE_POOL_MAX_CONNECTIONS', '16'))
+    configparser.set('database', 'pool_stale_timeout', getenv(
+        'DATABASE_POOL_STALE_TIMEOUT', '300'))
+    configparser.set('database', 'state_write_behind', getenv(
+        'DATABASE_STATE_WRITE_BEHIND', '0'))
+    configparser.set('database', 'stage_history', getenv(
+        'DATABASE_STAGE_HISTORY', 'False'))
+    configparser.set('database', 'retention_days', getenv(
+        'DATABASE_RETENTION_DAYS', '0'))
+    configparser.set('database', 'prune_batch_size', getenv(
+        'DATABASE_PRUNE_BATCH_SIZE', '500'))
+    configparser.set('database', 'prune_interval', getenv(
+        'DATABASE_PRUNE_INTERVAL', '3600'))
     configparser.add_section('celery')
     configparser.set('celery', 'broker_url', getenv(
         'BROKER_URL', 'pyamqp://'))
     configparser.set('celery', 'backend_url', getenv(
         'BACKEND_URL', 'rpc://'))
+    configparser.set('celery', 'small_queue', getenv(
+        'CELERY_SMALL_QUEUE', 'celery'))
+    configparser.set('celery', 'large_queue', getenv(
+        'CELERY_LARGE_QUEUE', 'celery'))
+    configparser.set('celery', 'metrics_port', getenv(
+        'CELERY_METRICS_PORT', '0'))
+    configparser.set('celery', 'metrics_dir', getenv(
+        'CELERY_METRICS_DIR', ''))
     configparser.read(CONFIG_FILE)
+    configparser.freeze()
+    return configparser
+
+
+def reload_config():
+    """Read the configuration again and replace the cached copy."""
+    with CONFIG_LOCK:
+        mtime = config_mtime()
+        configparser = read_config()
+        CONFIG_CACHE['config'] = configparser
+        CONFIG_CACHE['mtime'] = mtime
+        CONFIG_CACHE['checked'] = monotonic()
+    return configparser
+
+
+def get_config():
+    """
+    Return the cached read only ConfigParser object.
+
+    The config file modification time is checked at most once every
+    ``CONFIG_CHECK_INTERVAL`` seconds and the configuration is read
+    again if it changed. Changes to the environment are only picked
+    up by calling ``reload_config()``.
+    """
+    configparser = CONFIG_CACHE['config']
+    if configparser is None:
+        return reload_config()
+    now = monotonic()
+    if now - CONFIG_CACHE['checked'] >= CONFIG_CHECK_INTERVAL:
+        CONFIG_CACHE['checked'] = now
+        if config_mtime() != CONFIG_CACHE['mtime']:
+            return reload_config()
     return configparser
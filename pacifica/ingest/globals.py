@@ -8,3 +8,4 @@ CONFIG_FILE = getenv('INGEST_CONFIG', join(
     expanduser('~'), '.pacifica-ingest', 'config.ini'))
 CHERRYPY_CONFIG = getenv('INGEST_CPCONFIG', join(
     expanduser('~'), '.pacifica-ingest', 'cpconfig.ini'))
+CONFIG_CHECK_INTERVAL = float(getenv('INGEST_CONFIG_CHECK_INTERVAL', '10'))
@@ -0,0 +1,285 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Runtime metrics in the Prometheus text exposition format.
+
+Each process keeps its own counters and histograms. The values are
+taken as a snapshot, a dictionary of metric names to the value of
+each label set, so the snapshots of many worker processes can be
+summed by the worker exporter before they are rendered.
+"""
+import os
+import json
+import logging
+from glob import glob
+from threading import Lock, Thread
+from http.server import BaseHTTPRequestHandler, HTTPServer
+try:
+    from http.server import ThreadingHTTPServer
+except ImportError:  # pragma: no cover
+    from socketserver import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        """HTTP server handling each request in a thread before Python 3.7."""
+
+        daemon_threads = True
+
+LOGGER = logging.getLogger(__name__)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+RATE_BUCKETS = tuple(10 ** power * scale for power in range(4, 10) for scale in (1, 2.5, 5))
+
+
+def label_text(names, values):
+    """Return the label set of a sample like {name="value"}."""
+    if not names:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)
+    ))
+
+
+class Metric:
+    """A counter or gauge keeping one value for each label set."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        """Create the metric without any values."""
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        """Return the label values in the order of the label names."""
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def inc(self, amount=1, **labels):
+        """Add the amount to the value for the labels."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """Set the value for the labels."""
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def snapshot(self):
+        """Return the values as a list of [label values, value] lists."""
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    @staticmethod
+    def merge(values, other):
+        """Add the other value to the values."""
+        return values + other
+
+    def samples(self, values):
+        """Yield the sample lines for the snapshot values."""
+        for key, value in values:
+            yield '{}{} {}'.format(self.name, label_text(self.labels, key), value)
+
+
+class Gauge(Metric):
+    """A value that goes up and down."""
+
+    kind = 'gauge'
+
+
+class Histogram(Metric):
+    """A histogram of observations with cumulative buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=SECONDS_BUCKETS):
+        """Create the histogram with the upper bounds of the buckets."""
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        """Count the observation in its buckets."""
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def snapshot(self):
+        """Return the values as a list of [label values, bucket counts, sum and count] lists."""
+        with self._lock:
+            return [[list(key), list(counts)] for key, counts in self._values.items()]
+
+    @staticmethod
+    def merge(values, other):
+        """Add the other bucket counts, sum and count to the values."""
+        return [value + other_value for value, other_value in zip(values, other)]
+
+    def samples(self, values):
+        """Yield the bucket, sum and count lines for the snapshot values."""
+        for key, counts in values:
+            for bound, count in zip(self.buckets + ('+Inf',), counts[:-2] + counts[-1:]):
+                yield '{}_bucket{} {}'.format(
+                    self.name, label_text(self.labels + ('le',), key + [bound]), count)
+            yield '{}_sum{} {}'.format(self.name, label_text(self.labels, key), counts[-2])
+            yield '{}_count{} {}'.format(self.name, label_text(self.labels, key), counts[-1])
+
+
+class Registry:
+    """The metrics of a process and the gauges collected when scraped."""
+
+    def __init__(self):
+        """Create the empty registry."""
+        self.metrics = {}
+        self.collectors = []
+
+    def add(self, metric):
+        """Register the metric and return it."""
+        self.metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self):
+        """Return the values of every metric of the process."""
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def collect(self):
+        """Return the values of the gauges collected now as a snapshot."""
+        snapshot = {}
+        for collector in self.collectors:
+            # pylint: disable=broad-except
+            try:
+                snapshot.update(collector())
+            except Exception as ex:
+                LOGGER.error('Failed to collect metrics: %s', ex)
+            # pylint: enable=broad-except
+        return snapshot
+
+    def merge(self, snapshots):
+        """Sum the values of the snapshots by metric and label set."""
+        merged = {}
+        for snapshot in snapshots:
+            for name, values in snapshot.items():
+                metric = self.metrics.get(name)
+                if metric is None:
+                    continue
+                by_key = merged.setdefault(name, {})
+                for key, value in values:
+                    key = tuple(key)
+                    by_key[key] = metric.merge(by_key[key], value) if key in by_key else value
+        return {name: [[list(key), value] for key, value in by_key.items()] for name, by_key in merged.items()}
+
+    def render(self, snapshot):
+        """Return the snapshot in the text exposition format."""
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            if name not in snapshot:
+                continue
+            lines.append('# HELP {} {}'.format(name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+            lines.extend(metric.samples(sorted(snapshot[name])))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Registry()
+HTTP_REQUEST_SECONDS = METRICS.add(Histogram(
+    'ingest_http_request_seconds', 'Time to serve a request by endpoint.', ('method', 'endpoint', 'status')))
+UPLOAD_BYTES = METRICS.add(Metric(
+    'ingest_upload_received_bytes_total', 'Bytes of bundles received by the upload endpoint.'))
+UPLOAD_RATE = METRICS.add(Histogram(
+    'ingest_upload_received_bytes_per_second', 'Receive rate of each uploaded bundle.', buckets=RATE_BUCKETS))
+JOBS = METRICS.add(Gauge('ingest_jobs', 'Jobs in the job state table by state.', ('state', 'complete')))
+QUEUED_JOBS = METRICS.add(Gauge(
+    'ingest_fair_share_jobs', 'Jobs in the fair share queue by user and status.', ('user', 'status')))
+HTTP_SESSION_REQUESTS = METRICS.add(Gauge(
+    'ingest_http_session_requests', 'Requests sent by the shared session of a service.', ('service',)))
+HTTP_SESSION_CONNECTIONS = METRICS.add(Gauge(
+    'ingest_http_session_connections', 'Connections opened by the shared session of a service.', ('service',)))
+QUEUE_WAIT_SECONDS = METRICS.add(Histogram(
+    'ingest_queue_wait_seconds', 'Time from sending a job to a worker starting it.', ('task',)))
+TASK_RETRIES = METRICS.add(Metric('ingest_task_retries_total', 'Celery task retries by task.', ('task',)))
+ARCHIVE_PUT_SECONDS = METRICS.add(Histogram(
+    'ingest_archive_put_seconds', 'Time to upload each file to the archive interface.'))
+ARCHIVE_PUT_BYTES = METRICS.add(Metric(
+    'ingest_archive_put_bytes_total', 'Bytes of files uploaded to the archive interface.'))
+ARCHIVE_PUT_RATE = METRICS.add(Histogram(
+    'ingest_archive_put_bytes_per_second', 'Upload rate of each file to the archive interface.',
+    buckets=RATE_BUCKETS))
+HASH_BYTES = METRICS.add(Metric('ingest_hash_bytes_total', 'Bytes hashed by where they were hashed.', ('stage',)))
+HASH_SECONDS = METRICS.add(Metric(
+    'ingest_hash_seconds_total', 'Time spent hashing by where it was hashed.', ('stage',)))
+DOWNSTREAM_ERRORS = METRICS.add(Metric(
+    'ingest_downstream_errors_total', 'Failed requests to downstream services.', ('service',)))
+DOWNSTREAM_RETRIES = METRICS.add(Metric(
+    'ingest_downstream_retries_total', 'Retried requests to downstream services.', ('service',)))
+
+
+def snapshot_path(metrics_dir, pid):
+    """Return the path of the snapshot file of a worker process."""
+    return os.path.join(metrics_dir, 'worker-{}.json'.format(pid))
+
+
+def write_snapshot(metrics_dir):
+    """Write the snapshot of this process for the worker exporter."""
+    path = snapshot_path(metrics_dir, os.getpid())
+    with open('{}.tmp'.format(path), 'w') as snapshot_fd:
+        json.dump(METRICS.snapshot(), snapshot_fd)
+    os.replace('{}.tmp'.format(path), path)
+
+
+def read_snapshots(metrics_dir):
+    """Return the snapshots written by the other worker processes."""
+    own_path = snapshot_path(metrics_dir, os.getpid())
+    snapshots = []
+    for path in glob(snapshot_path(metrics_dir, '*')):
+        if path == own_path:
+            continue
+        try:
+            with open(path) as snapshot_fd:
+                snapshots.append(json.load(snapshot_fd))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def worker_metrics(metrics_dir):
+    """Return the metrics of every worker process in the text exposition format."""
+    return METRICS.render(METRICS.merge(read_snapshots(metrics_dir) + [METRICS.snapshot(), METRICS.collect()]))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serve the worker metrics on any path."""
+
+    metrics_dir = ''
+
+    # pylint: disable=invalid-name
+    def do_GET(self):
+        """Send the metrics of the worker processes."""
+        body = worker_metrics(self.metrics_dir).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    # pylint: enable=invalid-name
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Do not log every scrape."""
+
+
+def start_exporter(port, metrics_dir):
+    """Serve the worker metrics on the port from a background thread and return the server."""
+    for path in glob(snapshot_path(metrics_dir, '*')):
+        # snapshots of an earlier run of the worker
+        os.remove(path)
+    handler = type('WorkerMetricsHandler', (MetricsHandler,), {'metrics_dir': metrics_dir})
+    server = ThreadingHTTPServer(('', port), handler)
+    server_thread = Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    return server
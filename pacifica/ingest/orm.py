@@ -1,17 +1,50 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 """ORM for index server."""
-from time import sleep
-from datetime import datetime
-from peewee import Model, OperationalError, BooleanField
-from peewee import CharField, IntegerField, BigIntegerField, TextField, DateTimeField, DecimalField
+import json
+import atexit
+import logging
+from os import getpid
+from time import sleep, monotonic
+from datetime import datetime, timedelta
+from threading import Condition, Event, Lock, Thread
+from peewee import Model, OperationalError, BooleanField, AutoField, MySQLDatabase, JOIN, fn
+from peewee import CharField, IntegerField, BigIntegerField, TextField, DateTimeField, DecimalField, FloatField
 from playhouse.migrate import SchemaMigrator, migrate
 from playhouse.db_url import connect
+from playhouse.shortcuts import model_to_dict
 from pacifica.ingest.config import get_config
 
 SCHEMA_MAJOR = 2
-SCHEMA_MINOR = 0
-DB = connect(get_config().get('database', 'peewee_url'))
+SCHEMA_MINOR = 7
+LOGGER = logging.getLogger(__name__)
+
+
+def connect_database():
+    """
+    Return the database for the configured URL.
+
+    With the ``pool`` option the database keeps a pool of connections
+    for the process, so connecting and closing around every query
+    reuses an open connection.
+    """
+    config = get_config()
+    url = config.get('database', 'peewee_url')
+    if not config.getboolean('database', 'pool'):
+        return connect(url)
+    scheme, address = url.split('://', 1)
+    if not scheme.endswith('+pool'):
+        url = '{}+pool://{}'.format(scheme, address)
+    return connect(url, max_connections=config.getint('database', 'pool_max_connections'),
+                   stale_timeout=config.getint('database', 'pool_stale_timeout'))
+
+
+DB = connect_database()
+DEDUP_LOCK = Lock()
+PROGRESS_FIELDS = ('task_percent', 'bytes_done', 'bytes_total', 'files_done', 'files_total', 'throughput')
+# job state queries filter on these and the updated time
+STATE_INDEXES = (('state', 'updated'), ('task', 'updated'), ('complete', 'updated'), ('updated',))
+DEDUP_STATS = {'lookups': 0, 'hits': 0, 'hit_bytes': 0}
 
 
 class OrmSync:
@@ -48,7 +81,14 @@ class OrmSync:
     versions = [
         (0, 0),
         (1, 0),
-        (2, 0)
+        (2, 0),
+        (2, 1),
+        (2, 2),
+        (2, 3),
+        (2, 4),
+        (2, 5),
+        (2, 6),
+        (2, 7)
     ]
 
     @staticmethod
@@ -87,6 +127,59 @@ class OrmSync:
             BooleanField(default=False)
         ))
 
+    @classmethod
+    def update_2_0_to_2_1(cls):
+        """Update by creating the ingest file checkpoint table."""
+        if not IngestFile.table_exists():
+            IngestFile.create_table()
+
+    @classmethod
+    def update_2_1_to_2_2(cls):
+        """Update by creating the content hash index table."""
+        if not IngestDedup.table_exists():
+            IngestDedup.create_table()
+
+    @classmethod
+    def update_2_2_to_2_3(cls):
+        """Update by creating the fair share job queue table."""
+        if not IngestQueue.table_exists():
+            IngestQueue.create_table()
+
+    @classmethod
+    def update_2_3_to_2_4(cls):
+        """Update by adding the progress columns."""
+        migrator = SchemaMigrator(DB)
+        col_names = [col_md.name for col_md in DB.get_columns('ingeststate')]
+        for col_name in ['bytes_done', 'bytes_total', 'files_done', 'files_total', 'throughput']:
+            if col_name not in col_names:
+                migrate(migrator.add_column('ingeststate', col_name, getattr(IngestState, col_name)))
+
+    @classmethod
+    def update_2_4_to_2_5(cls):
+        """Update by adding the indexes for job state queries."""
+        migrator = SchemaMigrator(DB)
+        index_columns = {index_md.name: list(index_md.columns) for index_md in DB.get_indexes('ingeststate')}
+        for columns in STATE_INDEXES:
+            index_name = 'ingeststate_{}'.format('_'.join(columns))
+            if index_columns.get(index_name) == list(columns):
+                continue
+            if index_name in index_columns:
+                # MySQL keeps an index without the columns dropped by update_0_0_to_1_0()
+                migrate(migrator.drop_index('ingeststate', index_name))
+            migrate(migrator.add_index('ingeststate', columns, False))
+
+    @classmethod
+    def update_2_5_to_2_6(cls):
+        """Update by creating the job state history table."""
+        if not IngestStateHistory.table_exists():
+            IngestStateHistory.create_table()
+
+    @classmethod
+    def update_2_6_to_2_7(cls):
+        """Update by creating the job stage timing table."""
+        if not IngestStage.table_exists():
+            IngestStage.create_table()
+
     @classmethod
     def update_tables(cls):
         """Update the database to the current version."""
@@ -164,6 +257,11 @@ class IngestState(BaseModel):
     complete = BooleanField(default=False)
     created = DateTimeField(default=datetime.utcnow)
     updated = DateTimeField(default=datetime.utcnow)
+    bytes_done = BigIntegerField(default=0)
+    bytes_total = BigIntegerField(default=0)
+    files_done = BigIntegerField(default=0)
+    files_total = BigIntegerField(default=0)
+    throughput = FloatField(default=0)
 
     @classmethod
     def atomic(cls):
@@ -203,34 +301,336 @@ class IngestState(BaseModel):
         """Map to uniqueindex table."""
 
         table_name = 'ingeststate'
+        indexes = tuple((columns, False) for columns in STATE_INDEXES)
+
+
+class IngestStateHistory(IngestState):
+    """Map a completed ingest job moved out of the state table."""
+
+    archived = DateTimeField(default=datetime.utcnow)
+
+    class Meta:
+        """Map to ingeststatehistory table."""
+
+        table_name = 'ingeststatehistory'
+        indexes = (
+            (('updated',), False),
+        )
+
+
+class IngestStage(BaseModel):
+    """
+    Map a stage of an ingest job to when it started and finished.
+
+    Until the stage finishes bytes_done and files_done hold the counts
+    of the job when it started, then the counts done during the stage.
+    """
+
+    stage_id = AutoField(column_name='id')
+    job_id = BigIntegerField(index=True)
+    task = CharField()
+    state = CharField(default='OK')
+    started = DateTimeField(default=datetime.utcnow)
+    finished = DateTimeField(null=True, index=True)
+    bytes_done = BigIntegerField(default=0)
+    files_done = BigIntegerField(default=0)
+
+    class Meta:
+        """Map to ingeststage table."""
+
+        table_name = 'ingeststage'
+
+
+class IngestFile(BaseModel):
+    """Map a file verified in the archive to the ingest job that uploaded it."""
+
+    file_id = BigIntegerField(primary_key=True)
+    job_id = BigIntegerField(index=True)
+    name = TextField()
+    size = BigIntegerField()
+    hashtype = CharField()
+    hashsum = CharField()
+    created = DateTimeField(default=datetime.utcnow)
+
+    class Meta:
+        """Map to ingestfile table."""
+
+        table_name = 'ingestfile'
+
+
+class IngestDedup(BaseModel):
+    """Map the content hash of a file to the archived file that has it."""
+
+    dedup_id = AutoField(column_name='id')
+    hashtype = CharField()
+    hashsum = CharField()
+    file_id = BigIntegerField()
+    size = BigIntegerField()
+    hits = IntegerField(default=0)
+    last_used = DateTimeField(default=datetime.utcnow, index=True)
+
+    class Meta:
+        """Map to ingestdedup table."""
+
+        table_name = 'ingestdedup'
+        indexes = (
+            (('hashtype', 'hashsum'), True),
+        )
+
+
+class IngestQueue(BaseModel):
+    """Map a job waiting for the fair share dispatcher to its user and task arguments."""
+
+    job_id = BigIntegerField(primary_key=True, column_name='id')
+    user = CharField(index=True)
+    task = CharField()
+    args = TextField()
+    dispatched = BooleanField(default=False, index=True)
+    created = DateTimeField(default=datetime.utcnow)
+
+    class Meta:
+        """Map to ingestqueue table."""
+
+        table_name = 'ingestqueue'
 # pylint: enable=too-few-public-methods
 
 
+def write_state(job_id, job_state, completed=False):
+    """Insert or update the (state, task, task percent, exception) of an ingest job in one statement."""
+    state, task, task_percent, exception = job_state
+    preserve = [
+        IngestState.state, IngestState.task, IngestState.task_percent,
+        IngestState.exception, IngestState.complete, IngestState.updated
+    ]
+    query = IngestState.insert(
+        job_id=job_id, state=state, task=task, task_percent=task_percent,
+        exception=exception, complete=completed, updated=datetime.utcnow()
+    )
+    # pylint: disable=no-member,protected-access
+    database = IngestState._meta.database
+    # pylint: enable=no-member,protected-access
+    if isinstance(database, MySQLDatabase):
+        # MySQL finds the conflict from the primary key itself
+        query = query.on_conflict(preserve=preserve)
+    else:
+        query = query.on_conflict(conflict_target=[IngestState.job_id], preserve=preserve)
+    IngestState.database_connect()
+    # pylint: disable=no-value-for-parameter
+    query.execute()
+    # pylint: enable=no-value-for-parameter
+    IngestState.database_close()
+
+
+def write_progress(job_id, progress):
+    """Write the progress of an ingest job in one statement unless the job failed."""
+    IngestState.database_connect()
+    IngestState.update(updated=datetime.utcnow(), **{key: progress[key] for key in PROGRESS_FIELDS}).where(
+        (IngestState.job_id == job_id) & (IngestState.state != 'FAILED')).execute()
+    IngestState.database_close()
+
+
+class StateBuffer:
+    """
+    Write-behind buffer of ingest job progress updates.
+
+    Only the latest update of each job is kept and the buffer is
+    written every ``state_write_behind`` seconds by a background
+    thread. Final and FAILED states are written right away after any
+    update buffered for the job is dropped. The first state of a job is
+    written right away too so the job can be read back at once.
+    """
+
+    max_written = 10000
+
+    def __init__(self):
+        """Create the empty buffer without starting the thread."""
+        self._lock = Lock()
+        self._write_lock = Lock()
+        self._pending = {}
+        self._written = set()
+        self._pid = None
+
+    def _run(self, interval):
+        """Flush the buffer until the process exits."""
+        while True:
+            sleep(interval)
+            try:
+                self.flush()
+            # pylint: disable=broad-except
+            except Exception as ex:
+                LOGGER.error('Failed to write ingest states: %s', ex)
+            # pylint: enable=broad-except
+
+    def _start(self, interval):
+        """Start the flush thread once in each process."""
+        if self._pid == getpid():
+            return
+        self._pid = getpid()
+        self._pending = {}
+        flush_thread = Thread(target=self._run, args=(interval,))
+        flush_thread.daemon = True
+        flush_thread.start()
+
+    def update(self, job_id, job_state):
+        """
+        Keep the update as the latest for the job until the next flush.
+
+        Return False without keeping the update if this process has not
+        written a state of the job yet.
+        """
+        with self._lock:
+            if int(job_id) not in self._written:
+                return False
+            self._start(get_config().getfloat('database', 'state_write_behind'))
+            self._pending[int(job_id)] = job_state
+            return True
+
+    def write(self, job_id, job_state, completed=False):
+        """Drop any buffered update for the job and write the state now."""
+        with self._write_lock:
+            with self._lock:
+                self._pending.pop(int(job_id), None)
+            write_state(job_id, job_state, completed)
+            with self._lock:
+                if completed:
+                    self._written.discard(int(job_id))
+                    return
+                if len(self._written) >= self.max_written:
+                    self._written.clear()
+                self._written.add(int(job_id))
+
+    def write_progress(self, job_id, progress):
+        """Write any buffered update for the job and then the progress."""
+        with self._write_lock:
+            with self._lock:
+                job_state = self._pending.pop(int(job_id), None)
+            if job_state is not None:
+                write_state(job_id, job_state)
+            write_progress(job_id, progress)
+
+    def flush(self):
+        """Write the latest buffered update of every job."""
+        with self._write_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = {}
+            for job_id, job_state in pending.items():
+                write_state(job_id, job_state)
+
+
+STATE_BUFFER = StateBuffer()
+atexit.register(STATE_BUFFER.flush)
+
+
 def update_state(job_id, state, task, task_percent, exception=''):
-    """Update the state of an ingest job."""
+    """
+    Update the state of an ingest job.
+
+    With ``state_write_behind`` set progress updates are buffered and
+    only the latest of each job is written, the first and final states
+    of a job are always written before returning.
+    """
     completed = False
     if state == 'FAILED' or (task == 'ingest metadata' and task_percent == 100):
         completed = True
     if job_id and int(job_id) >= 0:
-        IngestState.database_connect()
-        record = IngestState.get_or_create(job_id=job_id,
-                                           defaults={'task': '', 'task_percent': 0, 'state': ''})[0]
-
-        record.state = state
-        record.task = task
-        record.task_percent = task_percent
-        record.exception = exception
-        record.complete = completed
-        record.updated = datetime.utcnow()
-        record.save()
-        IngestState.database_close()
+        job_state = (state, task, task_percent, exception)
+        if get_config().getboolean('database', 'stage_history'):
+            record_stage(job_id, job_state)
+        if not completed and get_config().getfloat('database', 'state_write_behind') > 0 and \
+                STATE_BUFFER.update(job_id, job_state):
+            return
+        STATE_BUFFER.write(job_id, job_state, completed)
+        STATE_WATCHER.poll()
+
+
+def finish_stage(stage, state, counts):
+    """Save the stage as finished now with the job counts of bytes and files done."""
+    stage.finished = datetime.utcnow()
+    stage.state = state
+    stage.bytes_done = counts[0] - stage.bytes_done
+    stage.files_done = counts[1] - stage.files_done
+    stage.save()
+
+
+def record_stage(job_id, job_state):
+    """
+    Record the start or end of a stage of an ingest job.
+
+    A stage starts when its task is set at 0 percent and ends when it
+    reaches 100 percent or fails. A stage that ends without a start
+    started when the stage before it ended. Starting a stage ends any
+    other stage of the job still running.
+    """
+    state, task, task_percent, _exception = job_state
+    ending = state == 'FAILED' or float(task_percent) >= 100
+    if not ending and float(task_percent) != 0:
+        return
+    IngestState.database_connect()
+    with IngestState.atomic():
+        current = IngestState.get_or_none(job_id=job_id)
+        counts = (current.bytes_done, current.files_done) if current else (0, 0)
+        # pylint: disable=not-an-iterable
+        running = {
+            stage.task: stage for stage in IngestStage.select().where(
+                (IngestStage.job_id == job_id) & IngestStage.finished.is_null()
+            )
+        }
+        # pylint: enable=not-an-iterable
+        stage = running.pop(task, None)
+        for other in running.values():
+            finish_stage(other, 'OK', counts)
+        if not ending:
+            if stage is None:
+                IngestStage.create(job_id=job_id, task=task, bytes_done=counts[0], files_done=counts[1])
+        else:
+            if stage is None:
+                last = IngestStage.select().where(
+                    (IngestStage.job_id == job_id) & IngestStage.finished.is_null(False)
+                ).order_by(IngestStage.finished.desc()).first()
+                stage = IngestStage(
+                    job_id=job_id, task=task, started=last.finished if last else datetime.utcnow(),
+                    bytes_done=counts[0], files_done=counts[1]
+                )
+            finish_stage(stage, state, counts)
+    IngestState.database_close()
+
+
+def read_stages(since):
+    """Return the task, state, seconds and bytes and files done of the stages finished after since."""
+    IngestState.database_connect()
+    # pylint: disable=not-an-iterable
+    stages = [
+        (task, state, (finished - started).total_seconds(), bytes_done, files_done)
+        for task, state, started, finished, bytes_done, files_done in IngestStage.select(
+            IngestStage.task, IngestStage.state, IngestStage.started, IngestStage.finished,
+            IngestStage.bytes_done, IngestStage.files_done
+        ).where(IngestStage.finished >= since).tuples()
+    ]
+    # pylint: enable=not-an-iterable
+    IngestState.database_close()
+    return stages
+
+
+def update_progress(job_id, progress):
+    """
+    Update the progress of the current task of an ingest job.
+
+    The progress is a dictionary with the task percent, bytes and files
+    done and total and the throughput in bytes per second.
+    """
+    if job_id and int(job_id) >= 0:
+        STATE_BUFFER.write_progress(job_id, progress)
 
 
 def read_state(job_id):
     """Return the state of an ingest job as a json object."""
     IngestState.database_connect()
     if job_id and job_id >= 0:
-        record = IngestState.get(job_id=job_id)
+        record = IngestState.get_or_none(job_id=job_id)
+        if record is None:
+            # completed jobs may have been moved out by prune_states()
+            record = IngestStateHistory.get(job_id=job_id)
     else:
         record = IngestState()
         record.state = 'DATA_ACCESS_ERROR'
@@ -238,3 +638,361 @@ def read_state(job_id):
         record.task_percent = 0
     IngestState.database_close()
     return record
+
+
+def query_states(filters, after=None, limit=100):
+    """
+    Return a page of the states of the ingest jobs matching the filters.
+
+    The filters are a dictionary with any of job_ids, state, task,
+    complete and since, the earliest updated time. The states are
+    ordered by job ID and only jobs after the job ID after are read,
+    so pages cost the same however deep they are. Return the states
+    and the job ID to read the next page after or None.
+    """
+    query = IngestState.select()
+    job_ids = filters.get('job_ids')
+    next_after = None
+    if job_ids is not None:
+        # only the IDs on this page are sent in the query
+        job_ids = sorted(set(int(job_id) for job_id in job_ids if after is None or int(job_id) > after))
+        if len(job_ids) > limit:
+            next_after = job_ids[limit - 1]
+        query = query.where(IngestState.job_id.in_(job_ids[:limit]))
+    for name in ['state', 'task', 'complete']:
+        if filters.get(name) is not None:
+            query = query.where(getattr(IngestState, name) == filters[name])
+    if filters.get('since') is not None:
+        query = query.where(IngestState.updated >= filters['since'])
+    if after is not None:
+        query = query.where(IngestState.job_id > after)
+    IngestState.database_connect()
+    # pylint: disable=not-an-iterable
+    records = list(query.order_by(IngestState.job_id).limit(limit))
+    # pylint: enable=not-an-iterable
+    IngestState.database_close()
+    if job_ids is None and len(records) == limit:
+        next_after = records[-1].job_id
+    return records, next_after
+
+
+def prune_states(cutoff, batch_size=500, export_fd=None):
+    """
+    Move the completed ingest jobs last updated before cutoff out of the state table.
+
+    The jobs are moved batch_size at a time each in its own
+    transaction so the tables are only locked briefly. They are moved
+    to the history table or written to export_fd as JSON lines and
+    their file checkpoints are removed. Return the number of jobs moved.
+    """
+    total = 0
+    start = monotonic()
+    IngestState.database_connect()
+    while True:
+        with IngestState.atomic():
+            # pylint: disable=not-an-iterable
+            records = list(IngestState.select().where(
+                IngestState.complete & (IngestState.updated < cutoff)
+            ).order_by(IngestState.job_id).limit(batch_size))
+            # pylint: enable=not-an-iterable
+            if not records:
+                break
+            job_ids = [record.job_id for record in records]
+            rows = [model_to_dict(record) for record in records]
+            # pylint: disable=no-value-for-parameter
+            if export_fd is None:
+                IngestStateHistory.delete().where(IngestStateHistory.job_id.in_(job_ids)).execute()
+                IngestStateHistory.insert_many(rows).execute()
+            else:
+                for row in rows:
+                    export_fd.write(json.dumps(row, default=str) + '\n')
+            IngestFile.delete().where(IngestFile.job_id.in_(job_ids)).execute()
+            IngestStage.delete().where(IngestStage.job_id.in_(job_ids)).execute()
+            IngestState.delete().where(IngestState.job_id.in_(job_ids)).execute()
+            # pylint: enable=no-value-for-parameter
+        total += len(records)
+        LOGGER.info('Pruned %s job states %.0f rows/s', total, total / max(monotonic() - start, 1e-6))
+    IngestState.database_close()
+    return total
+
+
+def count_states():
+    """Return the number of jobs in each state as (state, complete, count) tuples."""
+    IngestState.database_connect()
+    # pylint: disable=not-an-iterable
+    counts = list(IngestState.select(
+        IngestState.state, IngestState.complete, fn.COUNT(IngestState.job_id)
+    ).group_by(IngestState.state, IngestState.complete).tuples())
+    # pylint: enable=not-an-iterable
+    IngestState.database_close()
+    return counts
+
+
+def read_states(job_ids):
+    """Return the state records of the ingest jobs in as few queries as possible."""
+    records = []
+    IngestState.database_connect()
+    for job_id_chunk in chunks(job_ids):
+        # pylint: disable=not-an-iterable
+        records.extend(IngestState.select().where(IngestState.job_id.in_(job_id_chunk)))
+        # pylint: enable=not-an-iterable
+    IngestState.database_close()
+    return records
+
+
+class StateWatcher:
+    """
+    Wait for changes to the state of ingest jobs.
+
+    The states of every job someone waits on are read in one query
+    every ``state_poll_interval`` seconds by a background thread,
+    which wakes the waiting threads when a job was updated. Waiting
+    costs no database access and the thread stops when nobody waits.
+    """
+
+    def __init__(self):
+        """Create the watcher without starting the thread."""
+        self._cond = Condition()
+        self._wake = Event()
+        self._states = {}
+        self._waiters = {}
+        self._thread = None
+
+    def _run(self):
+        """Read the watched states until nobody waits on a job."""
+        interval = get_config().getfloat('ingest', 'state_poll_interval')
+        while True:
+            self._wake.wait(interval)
+            self._wake.clear()
+            with self._cond:
+                # keep the states of jobs nobody waits on for one interval
+                # so clients waiting again right away do not read them
+                for job_id in set(self._states.keys()) - set(self._waiters.keys()):
+                    del self._states[job_id]
+                job_ids = list(self._waiters.keys())
+                if not job_ids:
+                    self._thread = None
+                    return
+            try:
+                records = read_states(job_ids)
+            # pylint: disable=broad-except
+            except Exception as ex:
+                LOGGER.error('Failed to read ingest states: %s', ex)
+                continue
+            # pylint: enable=broad-except
+            with self._cond:
+                for record in records:
+                    if record.job_id in self._states:
+                        self._states[record.job_id] = record
+                self._cond.notify_all()
+
+    def poll(self):
+        """Read the watched states now instead of at the next interval."""
+        self._wake.set()
+
+    def wait(self, job_id, since=None, timeout=None):
+        """
+        Return the state of the job once it was updated after since.
+
+        The since value is the updated time of the state the caller
+        already has, as a string. The current state is returned if
+        since is None or the timeout passes first.
+        """
+        job_id = int(job_id)
+        if since is None:
+            return read_state(job_id)
+        with self._cond:
+            record = self._states.get(job_id)
+        if record is None:
+            record = read_state(job_id)
+        with self._cond:
+            self._states.setdefault(job_id, record)
+            self._waiters[job_id] = self._waiters.get(job_id, 0) + 1
+            if self._thread is None:
+                self._thread = Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            try:
+                self._cond.wait_for(lambda: str(self._states[job_id].updated) != since, timeout)
+                return self._states[job_id]
+            finally:
+                self._waiters[job_id] -= 1
+                if not self._waiters[job_id]:
+                    del self._waiters[job_id]
+
+
+STATE_WATCHER = StateWatcher()
+
+
+def checkpoint_file(job_id, name, file_id, size, file_hash):
+    """Record a file of an ingest job that was uploaded and verified in the archive."""
+    if job_id and int(job_id) >= 0:
+        hashtype, hashsum = file_hash
+        IngestState.database_connect()
+        IngestFile.replace(
+            file_id=file_id, job_id=job_id, name=name, size=size,
+            hashtype=hashtype, hashsum=hashsum
+        ).execute()
+        IngestState.database_close()
+
+
+def read_checkpoints(job_id):
+    """Return the files of an ingest job already verified in the archive by tar member name."""
+    checkpoints = {}
+    if job_id and int(job_id) >= 0:
+        IngestState.database_connect()
+        # pylint: disable=not-an-iterable
+        for record in IngestFile.select().where(IngestFile.job_id == job_id):
+            checkpoints[record.name] = record
+        # pylint: enable=not-an-iterable
+        IngestState.database_close()
+    return checkpoints
+
+
+def count_checkpoints(job_id):
+    """Return the number of files and bytes of an ingest job verified in the archive."""
+    IngestState.database_connect()
+    count, size = IngestFile.select(fn.COUNT(IngestFile.file_id), fn.SUM(IngestFile.size)).where(
+        IngestFile.job_id == job_id).scalar(as_tuple=True)
+    IngestState.database_close()
+    return count, size or 0
+
+
+def chunks(items, size=500):
+    """Yield lists of at most size items to keep query parameters bounded."""
+    items = list(items)
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
+
+
+def dedup_lookup(file_hashes):
+    """
+    Return the archived files with the same content as the file hashes.
+
+    The file hashes are (hash type, hash) tuples and the result maps
+    each tuple that is already known to its index record. The hit
+    count and last use of the records found are updated.
+    """
+    wanted = set(file_hashes)
+    known = {}
+    IngestState.database_connect()
+    with IngestState.atomic():
+        for hashsums in chunks({hashsum for _hashtype, hashsum in wanted}):
+            # pylint: disable=not-an-iterable
+            for record in IngestDedup.select().where(IngestDedup.hashsum.in_(hashsums)):
+                if (record.hashtype, record.hashsum) in wanted:
+                    known[(record.hashtype, record.hashsum)] = record
+            # pylint: enable=not-an-iterable
+        for record_ids in chunks(record.dedup_id for record in known.values()):
+            IngestDedup.update(
+                hits=IngestDedup.hits + 1, last_used=datetime.utcnow()
+            ).where(IngestDedup.dedup_id.in_(record_ids)).execute()
+    IngestState.database_close()
+    with DEDUP_LOCK:
+        DEDUP_STATS['lookups'] += len(wanted)
+        DEDUP_STATS['hits'] += len(known)
+        DEDUP_STATS['hit_bytes'] += sum(record.size for record in known.values())
+    return known
+
+
+def dedup_record(files, max_entries):
+    """
+    Add archived files to the content hash index.
+
+    The files are (hash type, hash, file ID, size) tuples, content
+    already in the index keeps its first file. The least recently used
+    entries are removed when there are more than max_entries.
+    """
+    IngestState.database_connect()
+    with IngestState.atomic():
+        for rows in chunks(files):
+            IngestDedup.insert_many(
+                rows, fields=[IngestDedup.hashtype, IngestDedup.hashsum, IngestDedup.file_id, IngestDedup.size]
+            ).on_conflict_ignore().execute()
+        # pylint: disable=no-value-for-parameter
+        extra = IngestDedup.select().count() - max_entries
+        # pylint: enable=no-value-for-parameter
+        if extra > 0:
+            oldest = IngestDedup.select(IngestDedup.dedup_id).order_by(
+                IngestDedup.last_used, IngestDedup.dedup_id).limit(extra)
+            evict = [record.dedup_id for record in oldest]
+            for record_ids in chunks(evict):
+                IngestDedup.delete().where(IngestDedup.dedup_id.in_(record_ids)).execute()
+    IngestState.database_close()
+
+
+def dedup_stats():
+    """Return the content hash index lookups, hits and hit rate of this process."""
+    with DEDUP_LOCK:
+        stats = dict(DEDUP_STATS)
+    stats['hit_rate'] = float(stats['hits']) / stats['lookups'] if stats['lookups'] else 0.0
+    return stats
+
+
+def queue_job(job_id, user, task, args):
+    """Add a job for the user to the fair share queue."""
+    IngestState.database_connect()
+    IngestQueue.create(job_id=job_id, user=user, task=task, args=args)
+    IngestState.database_close()
+
+
+def queue_depths():
+    """
+    Return the queued and running jobs of each user in the fair share queue.
+
+    The depth of each user also has the time the oldest queued job
+    was created.
+
+    Dispatched jobs are running until their ingest state is complete,
+    complete jobs are removed from the queue. So are jobs without a
+    state or not updated for ``fair_share_timeout`` seconds.
+    """
+    depths = {}
+    done_query = IngestState.job_id.is_null() | IngestState.complete
+    timeout = get_config().getfloat('ingest', 'fair_share_timeout')
+    if timeout > 0:
+        done_query |= IngestState.updated < datetime.utcnow() - timedelta(seconds=timeout)
+    IngestState.database_connect()
+    with IngestState.atomic():
+        done = IngestQueue.select(IngestQueue.job_id).join(
+            IngestState, JOIN.LEFT_OUTER, on=(IngestQueue.job_id == IngestState.job_id)
+        ).where(IngestQueue.dispatched & done_query)
+        for job_ids in chunks(record.job_id for record in done):
+            IngestQueue.delete().where(IngestQueue.job_id.in_(job_ids)).execute()
+        # pylint: disable=not-an-iterable
+        for record in IngestQueue.select(IngestQueue.user, IngestQueue.dispatched, IngestQueue.created):
+            depth = depths.setdefault(record.user, {'queued': 0, 'running': 0, 'oldest': None})
+            if record.dispatched:
+                depth['running'] += 1
+                continue
+            depth['queued'] += 1
+            if depth['oldest'] is None or record.created < depth['oldest']:
+                depth['oldest'] = record.created
+        # pylint: enable=not-an-iterable
+    IngestState.database_close()
+    return depths
+
+
+def claim_queued_job(user):
+    """
+    Mark the oldest queued job of the user as dispatched and return it.
+
+    The job is only returned to the caller that marked it, so several
+    dispatchers never send the same job. Return None if the user has
+    no queued job.
+    """
+    IngestState.database_connect()
+    record = None
+    while True:
+        record = IngestQueue.select().where(
+            (IngestQueue.user == user) & ~IngestQueue.dispatched
+        ).order_by(IngestQueue.created, IngestQueue.job_id).first()
+        if record is None:
+            break
+        claimed = IngestQueue.update(dispatched=True).where(
+            (IngestQueue.job_id == record.job_id) & ~IngestQueue.dispatched
+        ).execute()
+        if claimed:
+            break
+    IngestState.database_close()
+    return record
@@ -0,0 +1,185 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Opt-in profiling of ingest and move jobs.
+
+With ``profile_mode`` set each job writes its profile and peak memory
+to ``volume_path/profile/<job id>``. The cprofile mode profiles the
+thread running the task, the sample mode samples the stacks of every
+thread so the concurrent uploads are seen too.
+"""
+import os
+import sys
+import json
+import pstats
+import cProfile
+import tracemalloc
+from time import monotonic, process_time, sleep
+from datetime import datetime
+from threading import Event, Thread, get_ident
+from contextlib import contextmanager
+from .config import get_config
+
+PROFILE_MODES = ('off', 'cprofile', 'sample')
+
+
+def profile_dir(job_id):
+    """Return the directory the profiles of a job are written to."""
+    return os.path.join(get_config().get('ingest', 'volume_path'), 'profile', str(job_id))
+
+
+def frame_key(frame):
+    """Return the file, line and function of a frame like pstats does."""
+    code = frame.f_code
+    return '{}:{}({})'.format(code.co_filename, code.co_firstlineno, code.co_name)
+
+
+class StackSampler:
+    """
+    Sample the stacks of every thread of the process.
+
+    Each function counts the samples it was running in, its own, and
+    the samples it was on the stack for, its total.
+    """
+
+    def __init__(self, interval):
+        """Create the sampler taking a sample every interval seconds."""
+        self.interval = interval
+        self.samples = 0
+        self.functions = {}
+        self._stop = Event()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+
+    def _sample(self):
+        """Count the functions on the stack of each thread."""
+        for thread_id, frame in sys._current_frames().items():  # pylint: disable=protected-access
+            if thread_id == get_ident():
+                continue
+            self.samples += 1
+            seen = set()
+            leaf = True
+            while frame is not None:
+                key = frame_key(frame)
+                counts = self.functions.setdefault(key, [0, 0])
+                if leaf:
+                    counts[0] += 1
+                    leaf = False
+                if key not in seen:
+                    counts[1] += 1
+                    seen.add(key)
+                frame = frame.f_back
+
+    def _run(self):
+        """Sample until stopped."""
+        while not self._stop.is_set():
+            self._sample()
+            sleep(self.interval)
+
+    def start(self):
+        """Start sampling in the background."""
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling and wait for the last sample."""
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self, path):
+        """Write the samples of each function as JSON."""
+        with open(path, 'w') as samples_fd:
+            json.dump({'samples': self.samples, 'functions': self.functions}, samples_fd)
+
+
+@contextmanager
+def job_profile(job_id, task):
+    """Profile the job while it runs when ``profile_mode`` is set."""
+    config = get_config()
+    mode = config.get('ingest', 'profile_mode')
+    if mode not in PROFILE_MODES:
+        raise ValueError('Invalid profile_mode {}'.format(mode))
+    if mode == 'off':
+        yield
+        return
+    path = profile_dir(job_id)
+    os.makedirs(path, exist_ok=True)
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    elif hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    else:  # pragma: no cover
+        # reset_peak() was added in Python 3.9
+        tracemalloc.stop()
+        tracemalloc.start()
+    started = datetime.utcnow()
+    start = (monotonic(), process_time())
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+    else:
+        profiler = StackSampler(config.getfloat('ingest', 'profile_interval'))
+        profiler.start()
+    try:
+        yield
+    finally:
+        if mode == 'cprofile':
+            profiler.disable()
+            profiler.dump_stats(os.path.join(path, '{}.prof'.format(task)))
+        else:
+            profiler.stop()
+            profiler.dump(os.path.join(path, '{}.samples.json'.format(task)))
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        top_allocations = [
+            [str(stat.traceback), stat.size]
+            for stat in tracemalloc.take_snapshot().statistics('lineno')[:10]
+        ]
+        if not tracing:
+            tracemalloc.stop()
+        with open(os.path.join(path, '{}.json'.format(task)), 'w') as summary_fd:
+            json.dump({
+                'job_id': str(job_id),
+                'task': task,
+                'mode': mode,
+                'started': str(started),
+                'seconds': monotonic() - start[0],
+                'cpu_seconds': process_time() - start[1],
+                'peak_memory': peak_memory,
+                'top_allocations': top_allocations
+            }, summary_fd, indent=2)
+
+
+def read_hot_spots(path, task):
+    """Return the (function, own, total) tuples of the profile of a task."""
+    hot_spots = []
+    prof_path = os.path.join(path, '{}.prof'.format(task))
+    if os.path.exists(prof_path):
+        for (filename, lineno, func), stat in pstats.Stats(prof_path).stats.items():
+            hot_spots.append(('{}:{}({})'.format(filename, lineno, func), stat[2], stat[3]))
+    samples_path = os.path.join(path, '{}.samples.json'.format(task))
+    if os.path.exists(samples_path):
+        with open(samples_path) as samples_fd:
+            samples = json.load(samples_fd)
+        for key, (own, total) in samples['functions'].items():
+            hot_spots.append((key, own, total))
+    return hot_spots
+
+
+def profile_hot_spots(job_id, top=20):
+    """
+    Return the summary and hot spots of the profiles of a job by task.
+
+    The hot spots are (function, own, total) tuples in seconds for
+    cProfile and in samples for the sample mode, most own time first.
+    """
+    path = profile_dir(job_id)
+    profiles = {}
+    for name in sorted(os.listdir(path)):
+        if not name.endswith('.json') or name.endswith('.samples.json'):
+            continue
+        task = name[:-len('.json')]
+        with open(os.path.join(path, name)) as summary_fd:
+            summary = json.load(summary_fd)
+        hot_spots = sorted(read_hot_spots(path, task), key=lambda hot_spot: hot_spot[1], reverse=True)
+        profiles[task] = {'summary': summary, 'hot_spots': hot_spots[:top]}
+    return profiles
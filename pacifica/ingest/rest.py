@@ -2,14 +2,18 @@
 # -*- coding: utf-8 -*-
 """Ingest Server Main."""
 import os
-import shutil
 import json
+from time import monotonic
+from datetime import datetime, timedelta
 import peewee
 import cherrypy
-from .orm import read_state, update_state
-from .utils import get_unique_id, create_state_response, parse_size
-from .tasks import move, ingest
+from .orm import read_state, update_state, query_states, read_stages, count_states, queue_depths, STATE_WATCHER
+from .utils import get_unique_id, create_state_response, parse_size, stage_summary, session_stats
+from .tasks import is_large_job, job_queue, submit_job, fair_share_state
+from .tarutils import receive_tar, remove_tar, BundleCompressionException
 from .config import get_config
+from .metrics import METRICS, CONTENT_TYPE, HTTP_REQUEST_SECONDS, UPLOAD_BYTES, UPLOAD_RATE
+from .metrics import JOBS, QUEUED_JOBS, HTTP_SESSION_REQUESTS, HTTP_SESSION_CONNECTIONS
 
 
 def error_page_default(**kwargs):
@@ -23,6 +27,59 @@ def error_page_default(**kwargs):
     })
 
 
+class RequestMetricsTool(cherrypy.Tool):
+    """CherryPy tool timing each request by endpoint."""
+
+    def __init__(self):
+        """Start the timer when the resource is found."""
+        super().__init__('on_start_resource', self.start, priority=10)
+
+    def _setup(self):
+        """Stop the timer once the request is done."""
+        super()._setup()
+        cherrypy.request.hooks.attach('on_end_request', self.end, priority=90)
+
+    @staticmethod
+    def start():
+        """Save the start time of the request."""
+        cherrypy.request.metrics_start = monotonic()
+
+    @staticmethod
+    def end():
+        """Observe the time the request took."""
+        start = getattr(cherrypy.request, 'metrics_start', None)
+        if start is None:
+            return
+        HTTP_REQUEST_SECONDS.observe(
+            monotonic() - start,
+            method=cherrypy.request.method,
+            endpoint='/' + cherrypy.request.path_info.strip('/').split('/')[0],
+            status=str(cherrypy.response.status).split()[0]
+        )
+
+
+cherrypy.tools.request_metrics = RequestMetricsTool()
+
+
+def collect_metrics():
+    """Return the job, fair share queue and session gauges of the service."""
+    snapshot = {JOBS.name: [], HTTP_SESSION_REQUESTS.name: [], HTTP_SESSION_CONNECTIONS.name: []}
+    for state, complete, count in count_states():
+        snapshot[JOBS.name].append([[state, str(bool(complete)).lower()], count])
+    if get_config().getboolean('ingest', 'fair_share'):
+        snapshot[QUEUED_JOBS.name] = [
+            [[user, status], depth[status]]
+            for user, depth in queue_depths().items() for status in ['queued', 'running']
+        ]
+    for service, stats in session_stats().items():
+        snapshot[HTTP_SESSION_REQUESTS.name].append([[service], stats['requests']])
+        snapshot[HTTP_SESSION_CONNECTIONS.name].append([[service], stats['connections']])
+    return snapshot
+
+
+METRICS.collectors.append(collect_metrics)
+
+
 def get_remote_user():
     """Get the remote user from cherrypy request headers."""
     return cherrypy.request.headers.get(
@@ -53,10 +110,18 @@ class RestIngestState:
     # pylint: disable=invalid-name
     @staticmethod
     @cherrypy.tools.json_out()
-    def GET(job_id):
-        """Get the ingest state for the job."""
+    def GET(job_id, since=None, timeout=None):
+        """
+        Get the ingest state for the job.
+
+        With since set to the updated time of the last state seen the
+        request waits until the state changes or the timeout passes.
+        """
         try:
-            record = read_state(int(job_id))
+            if since is None:
+                record = read_state(int(job_id))
+            else:
+                record = STATE_WATCHER.wait(job_id, since, wait_timeout(timeout))
         except peewee.DoesNotExist:
             raise cherrypy.HTTPError(
                 '404 Not Found', 'job ID {} does not exist.'.format(job_id))
@@ -64,6 +129,170 @@ class RestIngestState:
     # pylint: enable=invalid-name
 
 
+class RestIngestStates:
+    """The CherryPy bulk ingest state object."""
+
+    exposed = True
+
+    # Cherrypy requires these named methods.
+    # pylint: disable=invalid-name
+    @staticmethod
+    @cherrypy.tools.json_out()
+    def GET(**params):
+        """
+        Get a page of the ingest states of the jobs matching the filters.
+
+        The job_id parameter is a comma separated list of job IDs.
+        """
+        if params.get('job_id') is not None:
+            job_ids = params.pop('job_id')
+            if not isinstance(job_ids, list):
+                job_ids = [job_ids]
+            params['job_ids'] = [job_id for value in job_ids for job_id in value.split(',') if job_id]
+        return state_query(params)
+
+    @staticmethod
+    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_in()
+    def POST():
+        """Get a page of the ingest states of the jobs in the posted filters."""
+        if not isinstance(cherrypy.request.json, dict):
+            raise cherrypy.HTTPError('400 Bad Request', 'filters must be a JSON object.')
+        return state_query(cherrypy.request.json)
+    # pylint: enable=invalid-name
+
+
+def parse_timestamp(value):
+    """Parse a timestamp like the updated time of a job state, the date or the seconds may be left out."""
+    value = str(value).strip().replace('T', ' ')
+    for time_format in ['%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']:
+        try:
+            return datetime.strptime(value, time_format)
+        except ValueError:
+            continue
+    raise ValueError('invalid timestamp {}'.format(value))
+
+
+def state_query(params):
+    """Return the page of job states for the query parameters."""
+    max_limit = get_config().getint('ingest', 'state_query_limit')
+    filters = {}
+    try:
+        if params.get('job_ids') is not None:
+            filters['job_ids'] = [int(job_id) for job_id in params['job_ids']]
+        for name in ['state', 'task']:
+            filters[name] = params.get(name)
+        if params.get('complete') is not None:
+            filters['complete'] = str(params['complete']).lower() in ['true', '1']
+        if params.get('since') is not None:
+            filters['since'] = parse_timestamp(params['since'])
+        after = int(params['after']) if params.get('after') is not None else None
+        limit = min(max(int(params.get('limit', max_limit)), 1), max_limit)
+    except (TypeError, ValueError) as ex:
+        raise cherrypy.HTTPError('400 Bad Request', 'invalid query {}.'.format(ex))
+    records, next_after = query_states(filters, after, limit)
+    return {
+        'jobs': [create_state_response(record) for record in records],
+        'next': next_after
+    }
+
+
+class RestStateEvents:
+    """The CherryPy ingest state event stream object."""
+
+    exposed = True
+
+    # Cherrypy requires these named methods.
+    # pylint: disable=invalid-name
+    @staticmethod
+    @cherrypy.config(**{'response.stream': True})
+    def GET(job_id, since=None):
+        """Stream the changes to the ingest state of the job as server-sent events."""
+        try:
+            record = STATE_WATCHER.wait(job_id)
+        except peewee.DoesNotExist:
+            raise cherrypy.HTTPError(
+                '404 Not Found', 'job ID {} does not exist.'.format(job_id))
+        cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        return state_events(record, since)
+    # pylint: enable=invalid-name
+
+
+def wait_timeout(timeout):
+    """Return the seconds to wait for a state change, at most state_wait_timeout."""
+    max_timeout = get_config().getfloat('ingest', 'state_wait_timeout')
+    if timeout is None:
+        return max_timeout
+    return min(max(float(timeout), 0), max_timeout)
+
+
+def state_events(record, since=None):
+    """Yield a state event for each change of the job state until it is complete."""
+    while True:
+        updated = str(record.updated)
+        if updated != since:
+            since = updated
+            yield 'event: state\ndata: {}\n\n'.format(json.dumps(create_state_response(record))).encode()
+            if record.complete:
+                return
+        else:
+            yield b': keep-alive\n\n'
+        record = STATE_WATCHER.wait(record.job_id, since, wait_timeout(None))
+
+
+class RestQueueState:
+    """The CherryPy fair share queue state object."""
+
+    exposed = True
+
+    # Cherrypy requires these named methods.
+    # pylint: disable=invalid-name
+    @staticmethod
+    @cherrypy.tools.json_out()
+    def GET():
+        """Get the queued and running jobs of each user."""
+        state = fair_share_state()
+        for user_state in state.values():
+            user_state['oldest'] = str(user_state['oldest']) if user_state['oldest'] else None
+        return state
+    # pylint: enable=invalid-name
+
+
+class RestStageReport:
+    """The CherryPy job stage timing report object."""
+
+    exposed = True
+
+    # Cherrypy requires these named methods.
+    # pylint: disable=invalid-name
+    @staticmethod
+    @cherrypy.tools.json_out()
+    def GET(days=7):
+        """Get the duration and throughput percentiles of the stages finished in the last days."""
+        try:
+            since = datetime.utcnow() - timedelta(days=float(days))
+        except ValueError:
+            raise cherrypy.HTTPError('400 Bad Request', 'invalid days {}.'.format(days))
+        return stage_summary(read_stages(since))
+    # pylint: enable=invalid-name
+
+
+class RestMetrics:
+    """The CherryPy metrics object."""
+
+    exposed = True
+
+    # Cherrypy requires these named methods.
+    # pylint: disable=invalid-name
+    @staticmethod
+    def GET():
+        """Get the metrics of the service in the Prometheus text format."""
+        cherrypy.response.headers['Content-Type'] = CONTENT_TYPE
+        return METRICS.render(METRICS.merge([METRICS.snapshot(), METRICS.collect()])).encode('utf8')
+    # pylint: enable=invalid-name
+
+
 class RestMove:
     """Ingest the data from the service."""
 
@@ -85,7 +314,15 @@ class RestMove:
         )
         with open(name, 'wb') as ingest_fd:
             ingest_fd.write(json.dumps(cherrypy.request.json).encode())
-        move.delay(job_id, name, authed_user)
+        files = []
+        if isinstance(cherrypy.request.json, list):
+            files = [
+                meta for meta in cherrypy.request.json
+                if isinstance(meta, dict) and meta.get('destinationTable') == 'Files'
+            ]
+        size = sum(int(meta['size']) for meta in files if str(meta.get('size', '')).isdigit())
+        large = is_large_job(size, len(files))
+        submit_job('move', authed_user, [job_id, name, authed_user], {'large': large}, job_queue(large))
         return create_state_response(read_state(job_id))
     # pylint: enable=invalid-name
 
@@ -108,12 +345,21 @@ class RestUpload:
             get_config().get('ingest', 'volume_path'),
             '{}.tar'.format(job_id)
         )
-        with open(name, 'wb') as ingest_fd:
-            shutil.copyfileobj(
-                cherrypy.request.body, ingest_fd,
-                parse_size(get_config().get('ingest', 'transfer_size'))
+        start = monotonic()
+        try:
+            members = receive_tar(
+                cherrypy.request.body, name,
+                parse_size(get_config().get('ingest', 'transfer_size')),
+                get_config().get('ingest', 'receive_hashtype')
             )
-        ingest.delay(job_id, name, authed_user)
+        except BundleCompressionException as ex:
+            remove_tar(name)
+            update_state(job_id, 'FAILED', 'UPLOADING', 0, str(ex))
+            raise cherrypy.HTTPError('400 Bad Request', str(ex))
+        UPLOAD_BYTES.inc(os.path.getsize(name))
+        UPLOAD_RATE.observe(os.path.getsize(name) / max(monotonic() - start, 1e-6))
+        large = is_large_job(os.path.getsize(name), len(members or []))
+        submit_job('ingest', authed_user, [job_id, name, authed_user], {'large': large}, job_queue(large))
         return create_state_response(read_state(job_id))
     # pylint: enable=invalid-name
 
@@ -122,7 +368,13 @@ class Root:
     """The CherryPy root object."""
 
     exposed = True
+    _cp_config = {'tools.request_metrics.on': True}
     get_state = RestIngestState()
+    get_states = RestIngestStates()
+    state_events = RestStateEvents()
+    queue_state = RestQueueState()
+    stage_report = RestStageReport()
+    metrics = RestMetrics()
     upload = RestUpload()
     move = RestMove()
 
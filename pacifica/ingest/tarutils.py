@@ -2,19 +2,52 @@
 # -*- coding: utf-8 -*-
 """Utilities and classes for unbundling and archiving a tar file."""
 from __future__ import print_function
+import io
+import os
+import shutil
 import tarfile
 import json
+import mmap
+import logging
 import hashlib
 import time
-import requests
-from .utils import get_unique_id
+from threading import local, Lock
+from concurrent.futures import ThreadPoolExecutor
+from .utils import get_unique_id, get_session, JsonListReader, json_list_str
+from .utils import json_list_chunks, iter_request_body, parse_size
 from .config import get_config
+from .metrics import ARCHIVE_PUT_SECONDS, ARCHIVE_PUT_BYTES, ARCHIVE_PUT_RATE, HASH_BYTES, HASH_SECONDS
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+LOGGER = logging.getLogger(__name__)
+# errors of a corrupt compressed stream, tarfile only wraps its own decompressors
+DECOMPRESSION_ERRORS = (tarfile.TarError,) + ((zstandard.ZstdError,) if zstandard else ())
+
+# magic numbers at the start of the supported compressed bundles
+COMPRESSION_MAGIC = [
+    (b'\x1f\x8b', 'gz'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zst')
+]
 
 
 class HashValidationException(Exception):
     """Class to capture hashsum validation failures."""
 
 
+class IngestFilesException(Exception):
+    """Class to capture the failures of a concurrent ingest of files."""
+
+
+class BundleCompressionException(Exception):
+    """Class to capture compressed bundles that can not be decompressed."""
+
+
+# pylint: disable=too-many-instance-attributes
 class FileIngester:
     """Class to ingest a single file from a tar file into the file archives."""
 
@@ -23,42 +56,49 @@ class FileIngester:
     recorded_hash = ''
     hashval = None
     server = ''
+    progress = None
 
-    def __init__(self, hashtype, hashcode, file_id):
+    def __init__(self, hashtype, hashcode, file_id, digest=None):
         """Constructor for FileIngester class."""
         if hashtype in hashlib.algorithms_available:
             self.hashval = getattr(hashlib, hashtype)()
         else:
             raise ValueError('Invalid Hashtype {}'.format(hashtype))
+        # digest already computed when the file was received
+        self.digest = digest
         self.recorded_hash = hashcode
         self.server = get_config().get('archiveinterface', 'url')
         self.file_id = file_id
-        self.session = requests.session()
-        retry_adapter = requests.adapters.HTTPAdapter(max_retries=5)
-        self.session.mount('https://', retry_adapter)
-        self.session.mount('http://', retry_adapter)
+        self.session = get_session('archiveinterface')
 
     def read(self, size):
         """Read wrapper for requests that calculates the hashcode inline."""
         buf = self.fileobj.read(size)
         # running checksum
-        self.hashval.update(buf)
+        if self.digest is None:
+            start = time.monotonic()
+            self.hashval.update(buf)
+            HASH_SECONDS.inc(time.monotonic() - start, stage='ingest')
+            HASH_BYTES.inc(len(buf), stage='ingest')
+        if self.progress is not None:
+            self.progress.add_bytes(len(buf))
         return buf
 
     def validate_hash(self):
         """Validate that the calculated hash matches the hash uploaded in the tar file."""
-        file_hash = self.hashval.hexdigest()
+        file_hash = self.hashval.hexdigest() if self.digest is None else self.digest
         if self.recorded_hash == file_hash:
             return True
         return False
 
     def upload_file_in_file(self, info, tar):
         """Upload a file from inside a tar file."""
-        self.fileobj = tar.extractfile(info)
+        self.fileobj = open_member(tar, info)
         size = info.size
         size_str = str(size)
         mod_time = time.ctime(info.mtime)
-        self.fileobj.seek(0)
+        # the member is opened at its start, members of compressed
+        # streams can not seek so do not rewind it here
         url = '{}/{}'.format(self.server, str(self.file_id))
 
         headers = {}
@@ -66,6 +106,7 @@ class FileIngester:
         headers['Content-Type'] = 'application/octet-stream'
         headers['Content-Length'] = size_str
 
+        start = time.monotonic()
         # pylint: disable=assignment-from-no-return
         req = self.session.put(
             url,
@@ -74,6 +115,10 @@ class FileIngester:
         )
         # pylint: enable=assignment-from-no-return
         self.fileobj.close()
+        seconds = time.monotonic() - start
+        ARCHIVE_PUT_SECONDS.observe(seconds)
+        ARCHIVE_PUT_BYTES.inc(size)
+        ARCHIVE_PUT_RATE.observe(size / max(seconds, 1e-6))
         body = req.text
         ret_dict = json.loads(body)
         size = int(ret_dict['total_bytes'])
@@ -86,112 +131,156 @@ class FileIngester:
             raise HashValidationException(
                 'File {} failed to validate.'.format(self.file_id))
         return True
+# pylint: enable=too-many-instance-attributes
+
+
+# pylint: disable=too-few-public-methods
+class FileRecord:
+    """Compact record of a file entry in the metadata."""
+
+    __slots__ = ('file_id', 'name', 'subdir', 'hashsum', 'hashtype', 'source', 'extra')
+    keys = ('name', 'subdir', 'hashsum', 'hashtype', 'source')
+
+    def __init__(self, meta):
+        """Keep the file entry fields, other keys are kept as a tuple."""
+        meta.pop('destinationTable', None)
+        self.file_id = meta.pop('_id', None)
+        self.name = meta.pop('name', None)
+        self.subdir = meta.pop('subdir', None)
+        self.hashsum = meta.pop('hashsum', None)
+        self.hashtype = meta.pop('hashtype', None)
+        self.source = meta.pop('source', None)
+        self.extra = tuple(meta.items())
+
+    def to_dict(self, clean=False):
+        """Return the file entry as it should be sent to other services."""
+        meta = dict(self.extra)
+        meta['destinationTable'] = 'Files'
+        meta['_id'] = self.file_id
+        for key in self.keys:
+            value = getattr(self, key)
+            if value is not None:
+                meta[key] = value
+        if clean:
+            meta['subdir'] = get_clipped(self.subdir)
+        return meta
+# pylint: enable=too-few-public-methods
 
 
 class MetaParser:
     """Class used to hold and search metadata."""
 
-    # entire metadata
-    meta = None
-    # a map of filenames to hashcodes
+    # entire metadata in order, file entries are FileRecord objects
+    records = []
+    # a map of file IDs to FileRecord objects
     files = {}
     start_id = -999
     transaction_id = -999
     file_count = -999
-
-    meta_str = ''
+    cleaned = False
 
     def __init__(self):
         """Constructor."""
-        self.session = requests.session()
-        retry_adapter = requests.adapters.HTTPAdapter(max_retries=5)
-        self.session.mount('https://', retry_adapter)
-        self.session.mount('http://', retry_adapter)
-
-    def file_obj_count(self, meta_list):
-        """Count the file objects in metadata and keep the count."""
-        self.file_count = 0
-        for meta in meta_list:
+        self.session = get_session('metadata')
+
+    def parse_meta(self, meta_fd, id_count=None, start_id=None):
+        """
+        Parse the metadata from a file object a list element at a time.
+
+        File entries are kept as FileRecord objects and get a range of
+        file IDs from the id server. The range is the number of file
+        entries unless id_count is given. A start_id from an earlier
+        parse of the same metadata assigns the same file IDs again.
+        """
+        self.records = []
+        self.files = {}
+        self.cleaned = False
+        file_records = []
+        for meta in JsonListReader(meta_fd):
             if meta['destinationTable'] == 'Files':
-                self.file_count += 1
+                record = FileRecord(meta)
+                file_records.append(record)
+                self.records.append(record)
+            else:
+                self.records.append(meta)
+        self.file_count = len(file_records) if id_count is None else id_count
+        self.start_id = get_unique_id(self.file_count, 'file') if start_id is None else start_id
+        for file_id, record in enumerate(file_records, self.start_id):
+            record.file_id = file_id
+            self.files[str(file_id)] = record
+        self.records.append({
+            'destinationTable': 'Transactions._id',
+            'value': self.transaction_id
+        })
 
     def read_meta(self, metafile, job_id):
         """Read the metadata from metafile and assume it's good."""
         self.transaction_id = job_id
-        meta_list = json.loads(open(metafile).read())
-        self.file_obj_count(meta_list)
-        self.start_id = get_unique_id(self.file_count, 'file')
-        self.files = {}
-        # all we care about for now is the hash and the file path
-        file_id = self.start_id
-        for meta in meta_list:
-            if meta['destinationTable'] == 'Files':
-                meta['_id'] = file_id
-                self.files[str(file_id)] = meta
-                file_id += 1
-        trans = {}
-        trans['destinationTable'] = 'Transactions._id'
-        trans['value'] = self.transaction_id
-        meta_list.append(trans)
-        self.meta_str = json.dumps(meta_list, sort_keys=True, indent=4)
-
-    def load_meta(self, tar, job_id):
+        with open(metafile, 'rb') as meta_fd:
+            self.parse_meta(meta_fd)
+
+    def load_meta(self, tar, job_id, start_id=None):
         """Load the metadata from a tar file into searchable structures."""
         # transaction id is the unique upload job id created by the ingest frontend
         self.transaction_id = job_id
-
-        meta_list = json.loads(tar.extractfile('metadata.txt').read())
-
-        # get the start index for the file
-        self.file_count = file_count(tar)
-        self.start_id = get_unique_id(self.file_count, 'file')
-
-        self.files = {}
-
-        # all we care about for now is the hash and the file path
-        file_id = self.start_id
-        for meta in meta_list:
-            if meta['destinationTable'] == 'Files':
-                meta['_id'] = file_id
-                self.files[str(file_id)] = meta
-                file_id += 1
-
-        trans = {}
-        trans['destinationTable'] = 'Transactions._id'
-        trans['value'] = self.transaction_id
-        meta_list.append(trans)
-
-        self.meta_str = json.dumps(meta_list, sort_keys=True, indent=4)
+        with tar.extractfile('metadata.txt') as meta_fd:
+            # get the start index for the file
+            self.parse_meta(meta_fd, file_count(tar), start_id)
+
+    def meta_dicts(self):
+        """Yield the metadata list elements as they should be sent."""
+        for meta in self.records:
+            yield meta.to_dict(self.cleaned) if isinstance(meta, FileRecord) else meta
+
+    @property
+    def meta_str(self):
+        """Return the metadata as a JSON string."""
+        return json_list_str(self.meta_dicts())
+
+    def request_body(self, section):
+        """
+        Return the headers and body for sending the metadata to a service.
+
+        The ``stream_body`` option of the config section sends compact
+        JSON generated from the records with a chunked body and the
+        ``compress_body`` option gzip compresses the body.
+        """
+        config = get_config()
+        compress = config.getboolean(section, 'compress_body')
+        headers = {'content-type': 'application/json'}
+        if compress:
+            headers['content-encoding'] = 'gzip'
+        if config.getboolean(section, 'stream_body'):
+            return headers, iter_request_body(json_list_chunks(self.meta_dicts(), compact=True), compress)
+        if compress:
+            return headers, b''.join(iter_request_body([self.meta_str], compress))
+        return headers, self.meta_str
 
     def get_hash(self, file_id):
         """Return the hash string for a file name."""
         file_element = self.files[file_id]
         # remove filetype if there is one
-        file_hash = file_element['hashsum'].replace('sha1:', '')
-        file_hash_type = file_element['hashtype']
+        file_hash = file_element.hashsum.replace('sha1:', '')
+        file_hash_type = file_element.hashtype
         return file_hash_type, file_hash
 
+    def set_file_id(self, file_id, new_id):
+        """Replace the ID of a file with one assigned by an earlier attempt."""
+        record = self.files.pop(file_id)
+        record.file_id = int(new_id)
+        self.files[str(new_id)] = record
+
     def get_fname(self, file_id):
         """Get the file name from the file ID."""
-        file_element = self.files[file_id]
-        name = file_element['name']
-        return name
+        return self.files[file_id].name
 
     def get_subdir(self, file_id):
         """Get the sub directory element from the file ID."""
-        file_element = self.files[file_id]
-        name = file_element['subdir']
-        return name
+        return self.files[file_id].subdir
 
     def clean_metadata(self):
-        """clean /data from filepaths."""
-        meta_list = json.loads(self.meta_str)
-
-        for meta in meta_list:
-            if meta['destinationTable'] == 'Files':
-                meta['subdir'] = get_clipped(meta['subdir'])
-
-        self.meta_str = json.dumps(meta_list, sort_keys=True, indent=4)
+        """Clean /data from filepaths when the metadata is output."""
+        self.cleaned = True
 
     def post_metadata(self):
         """Upload metadata to server."""
@@ -199,10 +288,10 @@ class MetaParser:
             self.clean_metadata()
 
             ingest_md_url = get_config().get('metadata', 'ingest_url')
-            headers = {'content-type': 'application/json'}
+            headers, body = self.request_body('metadata')
             # pylint: disable=assignment-from-no-return
             req = self.session.put(
-                ingest_md_url, headers=headers, data=self.meta_str)
+                ingest_md_url, headers=headers, data=body)
             # pylint: enable=assignment-from-no-return
             if req.json()['status'] == 'success':
                 return True, ''
@@ -222,66 +311,682 @@ def get_clipped(fname):
     return '/'.join(parts)  # this is also posix tar standard
 
 
-# pylint: disable=too-few-public-methods
 class TarIngester:
     """Class to read a tar file and upload it to the metadata and file archives."""
 
     tar = None
     meta = None
-
-    def __init__(self, tar, meta):
-        """Constructor for TarIngester class."""
+    members = None
+    workers = 1
+    checkpoint = None
+    progress = None
+
+    def __init__(self, tar, meta, workers=None, checkpoint=None):
+        """
+        Constructor for TarIngester class.
+
+        The checkpoint callable is called with the member name, file
+        ID, size and hash type and hash tuple of each file verified in
+        the archive.
+        """
         self.tar = tar
         self.meta = meta
+        if workers is None:
+            workers = get_config().getint('ingest', 'upload_workers')
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.done = set()
+
+    def member_name(self, file_id):
+        """Return the name of the tar member for the file ID."""
+        name = self.meta.get_fname(file_id)
+        path = self.meta.get_subdir(file_id) + '/' + name
+        # this is for posix tar standard
+        return '/'.join(['data', get_clipped(path)])
+
+    def get_info(self, file_id):
+        """Return the tar info object for the file ID."""
+        if self.members is None:
+            self.members = member_index(self.tar)
+        member_name = self.member_name(file_id)
+        info = self.members.get(member_name)
+        if info is None:
+            raise KeyError('filename {!r} not found'.format(member_name))
+        return info
+
+    def resume(self, checkpoints):
+        """
+        Skip the files verified in the archive by an earlier attempt.
+
+        The checkpoints map member names to records with the file ID,
+        size and hash of the uploaded file. A file is only skipped if
+        its size and hash still match and it keeps the file ID it was
+        uploaded with. Return the number of files skipped.
+        """
+        for file_id in list(self.meta.files.keys()):
+            record = checkpoints.get(self.member_name(file_id))
+            if record is None or record.size != self.get_info(file_id).size:
+                continue
+            if (record.hashtype, record.hashsum) != self.meta.get_hash(file_id):
+                continue
+            self.meta.set_file_id(file_id, record.file_id)
+            self.done.add(str(record.file_id))
+        return len(self.done)
+
+    def pending_files(self):
+        """Return the IDs of the files that still need to be uploaded."""
+        return [file_id for file_id in self.meta.files.keys() if file_id not in self.done]
+
+    def totals(self):
+        """Return the bytes and files of the bundle and the bytes and files already uploaded."""
+        bytes_total = bytes_done = 0
+        for file_id in self.meta.files.keys():
+            size = self.get_info(file_id).size
+            bytes_total += size
+            if file_id in self.done:
+                bytes_done += size
+        return bytes_total, len(self.meta.files), bytes_done, len(self.done)
+
+    def batches(self, batch_size):
+        """
+        Split the files still to upload into batches of about batch_size bytes.
+
+        Each batch is a list of [file ID, member name, hash type, hash]
+        lists that can be sent to another worker with ingest_members().
+        A file larger than batch_size is a batch on its own.
+        """
+        batches = [[]]
+        batch_bytes = 0
+        for file_id in self.pending_files():
+            info = self.get_info(file_id)
+            if batches[-1] and batch_bytes + info.size > batch_size:
+                batches.append([])
+                batch_bytes = 0
+            batches[-1].append([file_id, info.name] + list(self.meta.get_hash(file_id)))
+            batch_bytes += info.size
+        return [batch for batch in batches if batch]
+
+    def get_digest(self, file_id, info):
+        """Return the digest computed when the file was received or None."""
+        file_hash_type, _file_hash = self.meta.get_hash(file_id)
+        hashtype = getattr(self.tar, 'hashtype', None)
+        if hashtype is None or file_hash_type != hashtype:
+            return None
+        return self.tar.digests.get(info.name)
+
+    def verify_digests(self):
+        """Check the digests computed when the tar file was received before any upload."""
+        failed = []
+        for file_id in self.pending_files():
+            digest = self.get_digest(file_id, self.get_info(file_id))
+            if digest is not None and digest != self.meta.get_hash(file_id)[1]:
+                failed.append(file_id)
+        if failed:
+            raise HashValidationException(
+                'Files {} failed to validate.'.format(', '.join(failed)))
+
+    def ingest_file(self, file_id, info, tar):
+        """Ingest a single file from the tar file into the file archive."""
+        file_hash_type, file_hash = self.meta.get_hash(file_id)
+        print(info.name)
+        ingest = FileIngester(file_hash_type, file_hash, file_id, self.get_digest(file_id, info))
+        ingest.progress = self.progress
+        success = ingest.upload_file_in_file(info, tar)
+        if success and self.checkpoint is not None:
+            self.checkpoint(info.name, int(file_id), info.size, (file_hash_type, file_hash))
+        if success and self.progress is not None:
+            self.progress.add_file()
+        return success
 
     def ingest(self):
         """Ingest a tar file into the file archive."""
-        for file_id in self.meta.files.keys():
-            file_hash_type, file_hash = self.meta.get_hash(file_id)
-            name = self.meta.get_fname(file_id)
-
-            path = self.meta.get_subdir(file_id) + '/' + name
-            # this is for posix tar standard
-            info = self.tar.getmember('/'.join(['data', get_clipped(path)]))
-            print(info.name)
-            ingest = FileIngester(file_hash_type, file_hash, file_id)
-            ingest.upload_file_in_file(info, self.tar)
-# pylint: enable=too-few-public-methods
+        self.verify_digests()
+        if isinstance(self.tar, StreamedTar):
+            self.ingest_stream()
+            return
+        if self.workers > 1 and self.tar.name:
+            self.ingest_parallel()
+            return
+        for file_id in self.pending_files():
+            self.ingest_file(file_id, self.get_info(file_id), self.tar)
+
+    def ingest_stream(self):
+        """
+        Ingest a compressed tar file in a single pass.
+
+        The members are decompressed and uploaded in the order they are
+        stored since a compressed stream can not be read at random.
+        """
+        file_ids = {self.member_name(file_id): file_id for file_id in self.pending_files()}
+        start = time.time()
+        for info, tar in self.tar.stream():
+            file_id = file_ids.pop(info.name, None)
+            if file_id is not None:
+                self.ingest_file(file_id, info, tar)
+        if file_ids:
+            raise KeyError('filename {!r} not found'.format(next(iter(file_ids))))
+        self.tar.report(time.time() - start)
+
+    def ingest_parallel(self):
+        """
+        Ingest a tar file into the file archive using a pool of workers.
+
+        Each worker thread reads from its own handle on the tar file
+        so the members can be streamed without sharing a file offset.
+        All files are attempted and every failure is reported in the
+        raised exception.
+        """
+        thread_data = local()
+        tar_handles = []
+        tar_lock = Lock()
+
+        def worker(file_id, info):
+            """Upload the file using the tar file handle for this thread."""
+            if getattr(thread_data, 'tar', None) is None:
+                thread_data.tar = IndexedTarFile.open(self.tar.name, 'r:')
+                with tar_lock:
+                    tar_handles.append(thread_data.tar)
+            return self.ingest_file(file_id, info, thread_data.tar)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [
+                    (file_id, executor.submit(worker, file_id, self.get_info(file_id)))
+                    for file_id in self.pending_files()
+                ]
+        finally:
+            for tar in tar_handles:
+                tar.close()
+        errors = []
+        for file_id, future in futures:
+            if future.exception() is not None:
+                errors.append('{}: {}'.format(file_id, future.exception()))
+        if errors:
+            raise IngestFilesException('\n'.join(errors))
+
+
+def ingest_members(tar, batch, checkpoint=None):
+    """
+    Ingest a batch of files made by TarIngester.batches() from the tar file.
+
+    The checkpoint callable is called like the TarIngester one for
+    each file verified in the archive. Return the bytes uploaded.
+    """
+    members = member_index(tar)
+    total_bytes = 0
+    for file_id, name, hashtype, hashsum in batch:
+        info = members.get(name)
+        if info is None:
+            raise KeyError('filename {!r} not found'.format(name))
+        digest = None
+        if getattr(tar, 'hashtype', None) == hashtype:
+            digest = tar.digests.get(name)
+        print(name)
+        if FileIngester(hashtype, hashsum, file_id, digest).upload_file_in_file(info, tar):
+            if checkpoint is not None:
+                checkpoint(name, int(file_id), info.size, (hashtype, hashsum))
+        total_bytes += info.size
+    return total_bytes
+
+
+def bundle_compression(head):
+    """Return the compression of a bundle from its first bytes or None."""
+    for magic, compression in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def open_tar_stream(fileobj, compression, chunk_size):
+    """Open a tar file object for reading its members in order."""
+    if compression == 'zst':
+        if zstandard is None:
+            raise tarfile.CompressionError('zstandard module is not available')
+        fileobj = zstandard.ZstdDecompressor().stream_reader(
+            fileobj, read_size=chunk_size, read_across_frames=True)
+        compression = None
+    return tarfile.open(fileobj=fileobj, mode='r|{}'.format(compression or ''), bufsize=chunk_size)
 
 
 def open_tar(fpath):
     """Seek to the location of fpath, returns a file stream pointer and file size."""
+    with open(fpath, 'rb') as tar_fd:
+        compression = bundle_compression(tar_fd.read(8))
+    if compression:
+        try:
+            return StreamedTar(fpath, compression)
+        except DECOMPRESSION_ERRORS as ex:
+            LOGGER.error('Error opening: %s %s', fpath, ex)
+            return None
+
     # check validity
     if not tarfile.is_tarfile(fpath):
         return None
 
     # open tar file
     try:
-        tar = tarfile.open(fpath, 'r:')
+        tar = IndexedTarFile.open(fpath, 'r:')
     # not sure what exceptions would show up here and not be covered by is_tarfile
     except tarfile.TarError:  # pragma: no cover
         print('Error opening: ' + fpath)
         return None
 
+    load_tar_index(tar, fpath)
     return tar
 
 
-def patch_files(meta_obj):
-    """Patch the files in the archive interface."""
-    archive_url = get_config().get('archiveinterface', 'url')
-    session = requests.session()
-    retry_adapter = requests.adapters.HTTPAdapter(max_retries=5)
-    session.mount('https://', retry_adapter)
-    session.mount('http://', retry_adapter)
-    for file_id in meta_obj.files.keys():
-        data = {'path': meta_obj.files[file_id]['source']}
-        req = session.patch(
-            '{}/{}'.format(archive_url, file_id),
-            headers={'content-type': 'application/json'},
-            data=json.dumps(data)
+class IndexedTarFile(tarfile.TarFile):
+    """
+    TarFile with the member digests computed when it was received.
+
+    Regular members of an uncompressed tar file can also be read from
+    a memory map of the file without copying the data.
+    """
+
+    hashtype = None
+    digests = {}
+    mapped = None
+
+    def map_member(self, info, chunk_size):
+        """Return a MappedMember for the member or None if it can not be mapped."""
+        if not info.isreg() or info.sparse is not None or not hasattr(self.fileobj, 'fileno'):
+            return None
+        if self.mapped is None:
+            self.mapped = mmap.mmap(self.fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        return MappedMember(
+            memoryview(self.mapped)[info.offset_data:info.offset_data + info.size],
+            chunk_size
         )
-        if req.json().get('message') != 'File Moved Successfully':
-            raise Exception(json.dumps(req.json()))
+
+    def close(self):
+        """Close the memory map and the tar file."""
+        if self.mapped is not None:
+            try:
+                self.mapped.close()
+            except BufferError:  # pragma: no cover
+                # a member is still being read, the map closes when it is released
+                pass
+            self.mapped = None
+        super().close()
+
+
+# pylint: disable=too-many-instance-attributes
+class StreamedTar:
+    """
+    Compressed tar file read as a stream of members.
+
+    The member list, digests and metadata.txt come from the sidecar
+    files written when the bundle was received. Without them one pass
+    over the stream finds the members and metadata before the files
+    are uploaded in a second pass.
+    """
+
+    def __init__(self, fpath, compression):
+        """Constructor for StreamedTar class, checks the stream can be read."""
+        self.name = fpath
+        self.compression = compression
+        self.chunk_size = parse_size(get_config().get('ingest', 'transfer_size'))
+        self.members = None
+        self.metadata = None
+        self.hashtype = None
+        self.digests = {}
+        self.uncompressed_size = 0
+        index = read_tar_index(fpath)
+        if index is not None:
+            self.members = index_members(index)
+            self.hashtype = index.get('hashtype')
+            self.digests = index.get('digests', {})
+        with open(fpath, 'rb') as tar_fd:
+            with open_tar_stream(tar_fd, compression, self.chunk_size) as tar:
+                if tar.next() is None:
+                    raise tarfile.ReadError('empty tar file')
+
+    def stream(self):
+        """Yield each member and the stream tar file to extract it from."""
+        self.uncompressed_size = 0
+        with open(self.name, 'rb') as tar_fd:
+            with open_tar_stream(tar_fd, self.compression, self.chunk_size) as tar:
+                for info in tar:
+                    self.uncompressed_size += info.size
+                    yield info, tar
+
+    def _scan(self):
+        """Read the members and metadata.txt from the stream."""
+        members = []
+        for info, tar in self.stream():
+            members.append(info)
+            if info.name == 'metadata.txt':
+                self.metadata = tar.extractfile(info).read()
+        self.members = members
+
+    def getmembers(self):
+        """Return the members of the tar file."""
+        if self.members is None:
+            self._scan()
+        return self.members
+
+    def extractfile(self, member):
+        """Return a file object for metadata.txt, the only member read at random."""
+        if member != 'metadata.txt':
+            raise KeyError('filename {!r} can only be read in order'.format(member))
+        if os.path.exists(tar_metadata_path(self.name)):
+            return open(tar_metadata_path(self.name), 'rb')
+        if self.metadata is None:
+            self._scan()
+        if self.metadata is None:
+            raise KeyError('filename {!r} not found'.format(member))
+        return io.BytesIO(self.metadata)
+
+    def report(self, seconds):
+        """Log the compression ratio and throughput of the last pass."""
+        compressed_size = os.path.getsize(self.name)
+        ratio = self.uncompressed_size / max(compressed_size, 1)
+        LOGGER.info('%s %s ratio %.2f throughput %.1f MB/s', self.name, self.compression,
+                    ratio, self.uncompressed_size / max(seconds, 1e-6) / 10 ** 6)
+
+    def close(self):
+        """Nothing is held open between passes."""
+# pylint: enable=too-many-instance-attributes
+
+
+class MappedMember:
+    """
+    Read only file object for a tar member backed by a memory map.
+
+    Reads return memoryview slices of the map so the data is not
+    copied before it is hashed and sent. A read returns at least
+    chunk_size bytes, when that much is left, so the HTTP body is
+    sent in larger blocks than the size asked for by the caller.
+    """
+
+    def __init__(self, view, chunk_size):
+        """Constructor for MappedMember class."""
+        self.view = view
+        self.chunk_size = chunk_size
+        self.pos = 0
+
+    def read(self, size=-1):
+        """Return a memoryview of the next part of the member."""
+        if size is None or size < 0:
+            end = len(self.view)
+        else:
+            end = self.pos + max(size, self.chunk_size)
+        buf = self.view[self.pos:end]
+        self.pos += len(buf)
+        return buf
+
+    def seek(self, offset, whence=0):
+        """Move to a position in the member."""
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += len(self.view)
+        self.pos = max(0, min(offset, len(self.view)))
+        return self.pos
+
+    def tell(self):
+        """Return the position in the member."""
+        return self.pos
+
+    def close(self):
+        """Release the view of the memory map."""
+        self.view.release()
+
+
+def open_member(tar, info):
+    """Return a file object for a tar member, backed by a memory map if possible."""
+    config = get_config()
+    if isinstance(tar, IndexedTarFile) and config.getboolean('ingest', 'mmap_upload'):
+        member = tar.map_member(info, parse_size(config.get('ingest', 'upload_chunk_size')))
+        if member is not None:
+            return member
+    return tar.extractfile(info)
+
+
+# pylint: disable=too-few-public-methods
+class TeeReader:
+    """File object that writes everything read from a source to a destination."""
+
+    def __init__(self, src, dst, head=b''):
+        """Constructor for TeeReader class, head is data already read from the source."""
+        self.src = src
+        self.dst = dst
+        self.head = head
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        """Read from the source and write the data to the destination."""
+        if self.head:
+            buf = self.head if size is None or size < 0 else self.head[:size]
+            self.head = self.head[len(buf):]
+        else:
+            buf = self.src.read(size)
+        self.dst.write(buf)
+        self.bytes_read += len(buf)
+        return buf
+# pylint: enable=too-few-public-methods
+
+
+def tar_index_path(fpath):
+    """Return the path of the index sidecar for a tar file."""
+    return '{}.idx'.format(fpath)
+
+
+def tar_metadata_path(fpath):
+    """Return the path of the metadata sidecar for a compressed tar file."""
+    return '{}.metadata.txt'.format(fpath)
+
+
+def read_digest(member_fd, hashtype, chunk_size):
+    """Return the hex digest of the data read from member_fd."""
+    hashval = getattr(hashlib, hashtype)()
+    hash_bytes = 0
+    hash_seconds = 0.0
+    buf = member_fd.read(chunk_size)
+    while buf:
+        start = time.monotonic()
+        hashval.update(buf)
+        hash_seconds += time.monotonic() - start
+        hash_bytes += len(buf)
+        buf = member_fd.read(chunk_size)
+    HASH_SECONDS.inc(hash_seconds, stage='receive')
+    HASH_BYTES.inc(hash_bytes, stage='receive')
+    return hashval.hexdigest()
+
+
+def receive_tar(src, fpath, chunk_size, hashtype=None):
+    """
+    Copy a tar file from src to fpath indexing the members on the way.
+
+    The tar headers are parsed while the data is written so the index
+    sidecar can be saved without reading the file again. If hashtype
+    is given the digest of each regular file is computed in the same
+    pass. Compressed tar files are decompressed as they are read and
+    their metadata.txt is saved to its own sidecar. Data that is not a
+    tar file is still copied, but without an index. A compressed tar
+    file that can not be decompressed and read raises
+    BundleCompressionException.
+    """
+    if hashtype and hashtype not in hashlib.algorithms_available:
+        raise ValueError('Invalid Hashtype {}'.format(hashtype))
+    members = None
+    digests = {}
+    with open(fpath, 'wb') as tar_fd:
+        head = src.read(chunk_size)
+        compression = bundle_compression(head)
+        reader = TeeReader(src, tar_fd, head)
+        try:
+            with open_tar_stream(reader, compression, chunk_size) as tar:
+                for info in tar:
+                    if compression and info.name == 'metadata.txt':
+                        with open(tar_metadata_path(fpath), 'wb') as md_fd:
+                            shutil.copyfileobj(tar.extractfile(info), md_fd, chunk_size)
+                    elif hashtype and info.isreg():
+                        digests[info.name] = read_digest(tar.extractfile(info), hashtype, chunk_size)
+                members = tar.getmembers()
+        except DECOMPRESSION_ERRORS as ex:
+            if compression:
+                raise BundleCompressionException('Invalid {} compressed bundle: {}'.format(compression, ex))
+            members = None
+        while reader.read(chunk_size):
+            pass
+        size = reader.bytes_read
+    if members is not None:
+        write_tar_index(fpath, members, size, hashtype, digests)
+    return members
+
+
+def write_tar_index(fpath, members, size, hashtype=None, digests=None):
+    """Write the index sidecar for the tar file members and their digests."""
+    if any(info.sparse is not None for info in members):
+        return
+    index = {
+        'size': size,
+        'hashtype': hashtype,
+        'digests': digests or {},
+        'members': [
+            [
+                info.name, info.type.decode('latin-1'), info.mode, info.mtime,
+                info.size, info.offset, info.offset_data, info.linkname
+            ]
+            for info in members
+        ]
+    }
+    with open(tar_index_path(fpath), 'w') as index_fd:
+        json.dump(index, index_fd, separators=(',', ':'))
+
+
+def read_tar_index(fpath):
+    """
+    Return the index sidecar of the tar file or None.
+
+    The sidecar is only used if it was written for a file of the same
+    size, otherwise the tar headers have to be read as usual.
+    """
+    try:
+        with open(tar_index_path(fpath)) as index_fd:
+            index = json.load(index_fd)
+    except (OSError, ValueError):
+        return None
+    if index.get('size') != os.path.getsize(fpath):
+        return None
+    return index
+
+
+def index_members(index):
+    """Return the tar info objects for the members in the index."""
+    members = []
+    for name, member_type, mode, mtime, size, offset, offset_data, linkname in index['members']:
+        info = tarfile.TarInfo(name)
+        info.type = member_type.encode('latin-1')
+        info.mode = mode
+        info.mtime = mtime
+        info.size = size
+        info.offset = offset
+        info.offset_data = offset_data
+        info.linkname = linkname
+        members.append(info)
+    return members
+
+
+def load_tar_index(tar, fpath):
+    """Load the tar file members and digests from the index sidecar if there is one."""
+    index = read_tar_index(fpath)
+    if index is None:
+        return False
+    tar.members = index_members(index)
+    tar.hashtype = index.get('hashtype')
+    tar.digests = index.get('digests', {})
+    # tarfile has no public way to say the members are already known
+    # pylint: disable=protected-access
+    tar._loaded = True
+    # pylint: enable=protected-access
+    return True
+
+
+def remove_tar(fpath):
+    """Remove the tar file and its sidecars."""
+    os.unlink(fpath)
+    for sidecar in [tar_index_path(fpath), tar_metadata_path(fpath)]:
+        if os.path.exists(sidecar):
+            os.unlink(sidecar)
+
+
+def stat_source(record):
+    """Return why the source of a file can not be moved or None."""
+    if not record.source:
+        return 'no source path'
+    try:
+        source_stat = os.stat(record.source)
+    except OSError as ex:
+        return '{}: {}'.format(record.source, ex.strerror)
+    size = dict(record.extra).get('size')
+    if size is not None and int(size) != source_stat.st_size:
+        return '{}: size {} does not match metadata size {}'.format(record.source, source_stat.st_size, size)
+    return None
+
+
+def preflight_files(meta_obj, workers):
+    """Check the source of every file before any file is moved."""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(stat_source, meta_obj.files.values())
+        errors = [
+            '{}: {}'.format(file_id, error)
+            for file_id, error in zip(meta_obj.files.keys(), results) if error
+        ]
+    if errors:
+        raise IngestFilesException('\n'.join(errors))
+
+
+def patch_file(session, archive_url, file_id, source):
+    """Patch a single file in the archive interface to move it from its source."""
+    req = session.patch(
+        '{}/{}'.format(archive_url, file_id),
+        headers={'content-type': 'application/json'},
+        data=json.dumps({'path': source})
+    )
+    if req.json().get('message') != 'File Moved Successfully':
+        raise Exception(json.dumps(req.json()))
+
+
+def patch_files(meta_obj, workers=None):
+    """
+    Patch the files in the archive interface.
+
+    The sources are checked first when ``move_preflight`` is set so a
+    bad path fails the move before any file is moved. The patches are
+    sent by a pool of workers over the shared session and every
+    failure is reported in the raised exception.
+    """
+    config = get_config()
+    if workers is None:
+        workers = config.getint('ingest', 'move_workers')
+    if config.getboolean('ingest', 'move_preflight'):
+        preflight_files(meta_obj, workers)
+    archive_url = config.get('archiveinterface', 'url')
+    session = get_session('archiveinterface')
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            (file_id, executor.submit(patch_file, session, archive_url, file_id, record.source))
+            for file_id, record in meta_obj.files.items()
+        ]
+    errors = [
+        '{}: {}'.format(file_id, future.exception())
+        for file_id, future in futures if future.exception() is not None
+    ]
+    if errors:
+        raise IngestFilesException('\n'.join(errors))
+
+
+def member_index(tar):
+    """
+    Return a map of member names to tar info objects for a tar file.
+
+    The tar headers are only scanned once so lookups by name are constant
+    time, unlike ``tar.getmember()`` which searches the member list. The
+    last occurrence of a name wins, like ``tar.getmember()``.
+    """
+    return {info.name.rstrip('/'): info for info in tar.getmembers()}
 
 
 def file_count(tar):
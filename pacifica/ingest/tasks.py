@@ -3,12 +3,25 @@
 """Module that contains all the amqp tasks that support the ingest infrastructure."""
 from __future__ import absolute_import, print_function
 import os
+import json
 import traceback
-import requests
-from celery import Celery
-from .tarutils import open_tar, MetaParser, TarIngester, patch_files
-from .orm import update_state
+from datetime import datetime, timedelta, timezone
+from time import sleep, time
+from threading import Lock, Thread
+from functools import partial
+from contextlib import contextmanager
+from celery import Celery, chord
+from celery.signals import worker_init, task_prerun, task_postrun, task_retry
+from celery.utils.log import get_task_logger
+from .tarutils import open_tar, MetaParser, TarIngester, IndexedTarFile, patch_files, remove_tar
+from .tarutils import ingest_members
+from .orm import update_state, update_progress, read_state, checkpoint_file, read_checkpoints, count_checkpoints
+from .orm import dedup_lookup, dedup_record, dedup_stats
+from .orm import queue_job, queue_depths, claim_queued_job, prune_states
+from .utils import get_session, parse_size, admit_large_job, parse_user_map, positive_float, IngestProgress
 from .config import get_config
+from .profiling import job_profile
+from .metrics import QUEUE_WAIT_SECONDS, TASK_RETRIES, write_snapshot, start_exporter
 
 
 INGEST_APP = Celery(
@@ -17,11 +30,76 @@ INGEST_APP = Celery(
     backend=get_config().get('celery', 'backend_url')
 )
 
+LOGGER = get_task_logger(__name__)
+
+
+if get_config().getint('database', 'retention_days') > 0:
+    INGEST_APP.conf.beat_schedule = {
+        'prune-job-states': {
+            'task': 'pacifica.ingest.tasks.prune',
+            'schedule': get_config().getfloat('database', 'prune_interval')
+        }
+    }
+
 
 class IngestException(Exception):
     """Ingest class exception."""
 
 
+def is_large_job(size, file_count):
+    """Return True if a job with size bytes and file_count files is a large job."""
+    config = get_config()
+    return (
+        size >= parse_size(config.get('ingest', 'large_job_size')) or
+        file_count >= config.getint('ingest', 'large_job_files')
+    )
+
+
+def job_queue(large):
+    """Return the celery queue for small or large jobs."""
+    return get_config().get('celery', 'large_queue' if large else 'small_queue')
+
+
+@contextmanager
+def job_admission(task, large):
+    """
+    Hold a large job slot on this host while a large job runs.
+
+    If the host does not have the resources for another large job the
+    task is retried later so another worker can take it.
+    """
+    if not large:
+        yield
+        return
+    slot = admit_large_job()
+    if slot is None:
+        raise task.retry(countdown=get_config().getint('ingest', 'admission_wait'), max_retries=None)
+    try:
+        yield
+    finally:
+        slot.close()
+
+
+@contextmanager
+def fail_job(job_id, task):
+    """
+    Set the job FAILED at the task if the block raises an error.
+
+    The traceback is saved as the exception of the job and an
+    IngestException is raised so the caller stops the job.
+    """
+    try:
+        yield
+    except IngestException:
+        raise
+    # pylint: disable=broad-except
+    except Exception as ex:
+        stack_dump = traceback.format_exc()
+        update_state(job_id, 'FAILED', task, 0, u'{}\n{}'.format(stack_dump, str(ex)))
+        raise IngestException()
+    # pylint: enable=broad-except
+
+
 def ingest_check_tarfile(job_id, filepath):
     """Check the ingest tarfile and return state or set it properly."""
     update_state(job_id, 'OK', 'open tar', 0)
@@ -57,9 +135,9 @@ def ingest_metadata_parser(job_id, tar):
     return meta
 
 
-def ingest_policy_check(job_id, meta_str, authed_user):
+def ingest_policy_check(job_id, meta, authed_user):
     """Ingest check to validate metadata at policy."""
-    success, exception = validate_meta(meta_str, authed_user)
+    success, exception = validate_meta(meta, authed_user)
     if not success:
         update_state(job_id, 'FAILED', 'Policy Validation', 0, exception)
         raise IngestException()
@@ -69,33 +147,90 @@ def ingest_policy_check(job_id, meta_str, authed_user):
 def move_files(job_id, meta_obj):
     """Move the files to the archive interface."""
     update_state(job_id, 'OK', 'move files', 0)
-    try:
+    with fail_job(job_id, 'move files'):
         patch_files(meta_obj)
-    # pylint: disable=broad-except
-    except Exception as ex:
-        # rollback files
-        stack_dump = traceback.format_exc()
-        update_state(job_id, 'FAILED', 'move files', 0,
-                     u'{}\n{}'.format(stack_dump, str(ex)))
-        raise IngestException()
     update_state(job_id, 'OK', 'move files', 100)
 
 
 def ingest_files(job_id, ingest_obj):
-    """Ingest the files to the archive interface."""
+    """Ingest the files to the archive interface and report the bytes and files done."""
     update_state(job_id, 'OK', 'ingest files', 0)
-    try:
+    with fail_job(job_id, 'ingest files'):
+        bytes_total, files_total, bytes_done, files_done = ingest_obj.totals()
+        ingest_obj.progress = IngestProgress(
+            partial(update_progress, job_id), bytes_total, files_total, bytes_done, files_done)
         ingest_obj.ingest()
-    # pylint: disable=broad-except
-    except Exception as ex:
-        # rollback files
-        stack_dump = traceback.format_exc()
-        update_state(job_id, 'FAILED', 'ingest files', 0,
-                     u'{}\n{}'.format(stack_dump, str(ex)))
-        raise IngestException()
+        ingest_obj.progress.finish()
     update_state(job_id, 'OK', 'ingest files', 100)
 
 
+def ingest_dedup_reference(ingest_obj, hits, known):
+    """
+    Reference the archived content of the hits instead of uploading them.
+
+    A file is only skipped if the archive interface answers with its
+    size, the others are uploaded as usual. Return the files referenced.
+    """
+    config = get_config()
+    session = get_session('archiveinterface')
+    referenced = 0
+    for file_id in hits:
+        file_hash = ingest_obj.meta.get_hash(file_id)
+        info = ingest_obj.get_info(file_id)
+        if known[file_hash].size != info.size:
+            continue
+        req = session.post(config.get('ingest', 'dedup_reference_url').format(
+            archive_url=config.get('archiveinterface', 'url'), file_id=file_id, source_id=known[file_hash].file_id))
+        try:
+            size = int(req.json()['total_bytes']) if req.ok else None
+        except (ValueError, KeyError):
+            size = None
+        if size != info.size:
+            LOGGER.warning('File %s was not referenced, uploading it: %s', file_id, req.text)
+            continue
+        ingest_obj.done.add(file_id)
+        if ingest_obj.checkpoint is not None:
+            ingest_obj.checkpoint(info.name, int(file_id), info.size, file_hash)
+        referenced += 1
+    return referenced
+
+
+def ingest_dedup_lookup(job_id, ingest_obj):
+    """
+    Find the files of the bundle already archived by content hash.
+
+    With ``dedup_reference_url`` set the archived content is referenced
+    for each hit instead of uploading the file again.
+    """
+    meta = ingest_obj.meta
+    update_state(job_id, 'OK', 'dedup lookup', 0)
+    with fail_job(job_id, 'dedup lookup'):
+        file_ids = ingest_obj.pending_files()
+        known = dedup_lookup(meta.get_hash(file_id) for file_id in file_ids)
+        hits = [file_id for file_id in file_ids if meta.get_hash(file_id) in known]
+        hit_bytes = sum(ingest_obj.get_info(file_id).size for file_id in hits)
+        referenced = 0
+        if get_config().get('ingest', 'dedup_reference_url'):
+            referenced = ingest_dedup_reference(ingest_obj, hits, known)
+    LOGGER.info(
+        'Job %s content already archived for %s of %s files %s bytes, %s referenced, hit rate %.1f%%',
+        job_id, len(hits), len(file_ids), hit_bytes, referenced, 100 * dedup_stats()['hit_rate']
+    )
+    update_state(job_id, 'OK', 'dedup lookup', 100)
+
+
+def ingest_dedup_record(ingest_obj):
+    """Add the files of the bundle to the content hash index."""
+    meta = ingest_obj.meta
+    dedup_record(
+        [
+            meta.get_hash(file_id) + (int(file_id), ingest_obj.get_info(file_id).size)
+            for file_id in meta.files.keys()
+        ],
+        get_config().getint('ingest', 'dedup_max_entries')
+    )
+
+
 def ingest_metadata(job_id, meta):
     """Ingest metadata to the metadata service."""
     update_state(job_id, 'OK', 'ingest metadata', 0)
@@ -108,47 +243,358 @@ def ingest_metadata(job_id, meta):
 
 
 @INGEST_APP.task(ignore_result=False)
-def move(job_id, filepath, authed_user):
+def move(job_id, filepath, authed_user, large=False):
     """Move a MD bundle into the archive."""
+    with job_admission(move, large), job_profile(job_id, 'move'):
+        try:
+            meta = move_metadata_parser(job_id, filepath)
+            ingest_policy_check(job_id, meta, authed_user)
+            move_files(job_id, meta)
+            ingest_metadata(job_id, meta)
+            os.unlink(filepath)
+        except IngestException:
+            pass
+    dispatch_after_job()
+
+
+def ingest_resume(job_id, ingest_obj):
+    """Skip the files the job already uploaded and verified in the archive."""
+    update_state(job_id, 'OK', 'resume ingest', 0)
+    with fail_job(job_id, 'resume ingest'):
+        skipped = ingest_obj.resume(read_checkpoints(job_id))
+    LOGGER.info('Resuming job %s with %s files already ingested', job_id, skipped)
+    update_state(job_id, 'OK', 'resume ingest', 100)
+
+
+def ingest_fanout_batches(ingest_obj):
+    """Return the batches of files to ingest on other workers or None to ingest here."""
+    batch_size = parse_size(get_config().get('ingest', 'fanout_batch_size'))
+    if not batch_size or not isinstance(ingest_obj.tar, IndexedTarFile):
+        return None
+    batches = ingest_obj.batches(batch_size)
+    if len(batches) < 2:
+        return None
+    return batches
+
+
+def ingest_fanout(job_id, filepath, ingest_obj, batches, large=False):
+    """
+    Ingest the batches of files as subtasks and finish the ingest once all are done.
+
+    The subtasks are sent to the queue of the job size. The large job
+    slot of the ingest task is held while they are sent.
+    """
+    meta = ingest_obj.meta
+    update_state(job_id, 'OK', 'ingest files', 0)
+    with fail_job(job_id, 'ingest files'):
+        bytes_total, files_total, _bytes_done, _files_done = ingest_obj.totals()
+    LOGGER.info('Job %s ingesting %s files in %s subtasks', job_id, len(meta.files), len(batches))
+    totals = [files_total, bytes_total]
+    queue = job_queue(large)
+    chord(
+        ingest_batch.si(job_id, filepath, batch, totals).set(queue=queue)
+        for batch in batches
+    )(ingest_finish.si(job_id, filepath, meta.start_id).set(queue=queue))
+
+
+def ingest_complete(job_id, filepath, tar, ingest_obj):
+    """Ingest the metadata and remove the bundle once the files are ingested."""
+    ingest_metadata(job_id, ingest_obj.meta)
+    if get_config().getboolean('ingest', 'dedup_index'):
+        ingest_dedup_record(ingest_obj)
+    tar.close()
+    remove_tar(filepath)
+
+
+def ingest_bundle(job_id, filepath, authed_user, resume, large=False):
+    """
+    Ingest a tar bundle into the archive.
+
+    Each file verified in the archive is recorded for the job so
+    ingesting it again with resume set only uploads the rest. With
+    ``fanout_batch_size`` set the files of an uncompressed bundle are
+    ingested by subtasks on any worker.
+    """
     try:
-        meta = move_metadata_parser(job_id, filepath)
-        ingest_policy_check(job_id, meta.meta_str, authed_user)
-        move_files(job_id, meta)
-        ingest_metadata(job_id, meta)
-        os.unlink(filepath)
+        tar = ingest_check_tarfile(job_id, filepath)
+        meta = ingest_metadata_parser(job_id, tar)
+        ingest_obj = TarIngester(tar, meta, checkpoint=partial(checkpoint_file, job_id))
+        if resume:
+            ingest_resume(job_id, ingest_obj)
+        ingest_policy_check(job_id, meta, authed_user)
+        if get_config().getboolean('ingest', 'dedup_index'):
+            ingest_dedup_lookup(job_id, ingest_obj)
+        with fail_job(job_id, 'ingest files'):
+            batches = ingest_fanout_batches(ingest_obj)
+        if batches:
+            tar.close()
+            ingest_fanout(job_id, filepath, ingest_obj, batches, large)
+            return
+        ingest_files(job_id, ingest_obj)
+        ingest_complete(job_id, filepath, tar, ingest_obj)
     except IngestException:
         return
 
 
 @INGEST_APP.task(ignore_result=False)
-def ingest(job_id, filepath, authed_user):
+def ingest(job_id, filepath, authed_user, resume=False, large=False):
     """Ingest a tar bundle into the archive."""
+    with job_admission(ingest, large), job_profile(job_id, 'ingest'):
+        ingest_bundle(job_id, filepath, authed_user, resume, large)
+    dispatch_after_job()
+
+
+def open_bundle(filepath):
+    """Open the bundle of a job ingested by subtasks."""
+    tar = open_tar(filepath)
+    if tar is None:
+        raise IOError('Failed to open tarfile {}.'.format(filepath))
+    return tar
+
+
+def ingest_batch_members(job_id, filepath, batch):
+    """Upload a batch of files from the bundle and fail the job if any upload fails."""
+    with fail_job(job_id, 'ingest files'):
+        tar = open_bundle(filepath)
+        try:
+            ingest_members(tar, batch, partial(checkpoint_file, job_id))
+        finally:
+            tar.close()
+
+
+@INGEST_APP.task(ignore_result=False)
+def ingest_batch(job_id, filepath, batch, totals):
+    """
+    Ingest a batch of files from a bundle and update the progress of the job.
+
+    The totals are the number of files and bytes of the whole bundle
+    and the progress is counted from the files verified by any batch.
+    Once another batch failed the job the files are not uploaded.
+    """
+    if read_state(job_id).state == 'FAILED':
+        LOGGER.info('Job %s failed, skipping a batch of %s files', job_id, len(batch))
+        return 0
     try:
-        tar = ingest_check_tarfile(job_id, filepath)
-        meta = ingest_metadata_parser(job_id, tar)
+        ingest_batch_members(job_id, filepath, batch)
+    except IngestException:
+        return 0
+    files_done, bytes_done = count_checkpoints(job_id)
+    files_total, bytes_total = totals
+    if bytes_total:
+        percent = 100 * bytes_done // bytes_total
+    else:
+        percent = 100 * files_done // max(files_total, 1)
+    update_progress(job_id, {
+        'task_percent': min(99, percent),
+        'bytes_done': bytes_done,
+        'bytes_total': bytes_total,
+        'files_done': files_done,
+        'files_total': files_total,
+        'throughput': 0
+    })
+    return files_done
+
+
+def ingest_fanout_complete(job_id, filepath, start_id):
+    """Check every file was ingested by the subtasks and ingest the metadata."""
+    with fail_job(job_id, 'ingest files'):
+        tar = open_bundle(filepath)
+        meta = MetaParser()
+        meta.load_meta(tar, job_id, start_id)
         ingest_obj = TarIngester(tar, meta)
-        ingest_policy_check(job_id, meta.meta_str, authed_user)
-        ingest_files(job_id, ingest_obj)
-        ingest_metadata(job_id, meta)
+        ingest_obj.resume(read_checkpoints(job_id))
+        missing = ingest_obj.pending_files()
+    if missing:
         tar.close()
-        os.unlink(filepath)
+        update_state(job_id, 'FAILED', 'ingest files', 0,
+                     'Files {} were not ingested.'.format(', '.join(missing)))
+        raise IngestException()
+    update_state(job_id, 'OK', 'ingest files', 100)
+    ingest_complete(job_id, filepath, tar, ingest_obj)
+
+
+@INGEST_APP.task(ignore_result=False)
+def ingest_finish(job_id, filepath, start_id):
+    """
+    Finish the ingest of a job once all its subtasks are done.
+
+    A job failed by a subtask is left as it is.
+    """
+    try:
+        if read_state(job_id).state != 'FAILED':
+            ingest_fanout_complete(job_id, filepath, start_id)
     except IngestException:
+        pass
+    dispatch_after_job()
+
+
+JOB_TASKS = {'ingest': ingest, 'move': move}
+
+
+def fair_share_state():
+    """Return the queued and running jobs with the weight and cap of each user."""
+    config = get_config()
+    weights = parse_user_map(config.get('ingest', 'fair_share_weights'), positive_float)
+    weight = positive_float(config.get('ingest', 'fair_share_weight'))
+    caps = parse_user_map(config.get('ingest', 'fair_share_caps'))
+    state = {}
+    for user, depth in queue_depths().items():
+        state[user] = {
+            'queued': depth['queued'],
+            'running': depth['running'],
+            'oldest': depth['oldest'],
+            'weight': weights.get(user, weight),
+            'cap': caps.get(user, config.getint('ingest', 'fair_share_cap'))
+        }
+    return state
+
+
+def dispatch_jobs():
+    """
+    Send queued jobs to celery interleaving the users by weight.
+
+    The next job comes from the user with the fewest running jobs for
+    their weight, the oldest queued job breaking ties, until
+    ``fair_share_max_running`` jobs are running. A user never has more
+    running jobs than their cap. Return the number of jobs sent.
+    """
+    state = fair_share_state()
+    running = sum(user_state['running'] for user_state in state.values())
+    sent = 0
+    while running < get_config().getint('ingest', 'fair_share_max_running'):
+        users = [
+            user for user, user_state in state.items()
+            if user_state['queued'] and user_state['running'] < user_state['cap']
+        ]
+        if not users:
+            break
+        user = min(users, key=lambda user: (
+            (state[user]['running'] + 1) / state[user]['weight'], state[user]['oldest']
+        ))
+        state[user]['queued'] -= 1
+        record = claim_queued_job(user)
+        if record is None:
+            continue
+        state[user]['running'] += 1
+        running += 1
+        job = json.loads(record.args)
+        JOB_TASKS[record.task].apply_async(
+            job['args'], job['kwargs'], queue=job['queue'],
+            headers={'enqueued': record.created.replace(tzinfo=timezone.utc).timestamp()}
+        )
+        sent += 1
+    return sent
+
+
+def dispatch_after_job():
+    """Let the fair share dispatcher send the queued jobs and log any error."""
+    if not get_config().getboolean('ingest', 'fair_share'):
         return
+    try:
+        dispatch_jobs()
+    # pylint: disable=broad-except
+    except Exception as ex:
+        LOGGER.error('Failed to dispatch jobs: %s', ex)
+    # pylint: enable=broad-except
+
+
+# pylint: disable=too-few-public-methods
+class FairShareDispatcher:
+    """Background thread that dispatches queued jobs every ``fair_share_interval`` seconds."""
+
+    def __init__(self):
+        """Create the dispatcher without starting the thread."""
+        self._lock = Lock()
+        self._pid = None
+
+    def _run(self):
+        """Dispatch jobs until the process exits."""
+        while True:
+            sleep(get_config().getfloat('ingest', 'fair_share_interval'))
+            dispatch_after_job()
+
+    def start(self):
+        """Start the thread once in each process."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            dispatch_thread = Thread(target=self._run)
+            dispatch_thread.daemon = True
+            dispatch_thread.start()
+
+
+# pylint: enable=too-few-public-methods
+
+
+FAIR_SHARE_DISPATCHER = FairShareDispatcher()
+
+
+def submit_job(task, authed_user, args, kwargs, queue):
+    """
+    Send the job to celery, or to the fair share queue of the user.
+
+    The job ID is the first of the task arguments. With ``fair_share``
+    set the job waits in the ingest database until the dispatcher
+    sends it.
+    """
+    if not get_config().getboolean('ingest', 'fair_share'):
+        JOB_TASKS[task].apply_async(args, kwargs, queue=queue, headers={'enqueued': time()})
+        return
+    queue_job(args[0], authed_user, task, json.dumps({'args': args, 'kwargs': kwargs, 'queue': queue}))
+    FAIR_SHARE_DISPATCHER.start()
+    dispatch_after_job()
 
 
-def validate_meta(meta_str, authed_user):
+def metrics_dir():
+    """Return the directory the worker processes write their metrics to."""
+    return get_config().get('celery', 'metrics_dir') or os.path.join(
+        get_config().get('ingest', 'volume_path'), 'metrics')
+
+
+@worker_init.connect
+def worker_metrics_exporter(**_kwargs):
+    """Serve the metrics of the worker processes when ``metrics_port`` is set."""
+    port = get_config().getint('celery', 'metrics_port')
+    if port:
+        os.makedirs(metrics_dir(), exist_ok=True)
+        start_exporter(port, metrics_dir())
+
+
+@task_prerun.connect
+def task_queue_wait(task=None, **_kwargs):
+    """Observe the time a job waited between being sent and a worker starting it."""
+    enqueued = getattr(task.request, 'enqueued', None)
+    if enqueued is None:
+        enqueued = (getattr(task.request, 'headers', None) or {}).get('enqueued')
+    if enqueued is not None and not task.request.retries:
+        QUEUE_WAIT_SECONDS.observe(max(time() - float(enqueued), 0), task=task.name.rsplit('.', 1)[-1])
+
+
+@task_retry.connect
+def task_retry_count(sender=None, **_kwargs):
+    """Count the retries of each task."""
+    TASK_RETRIES.inc(task=sender.name.rsplit('.', 1)[-1])
+
+
+@task_postrun.connect
+def task_metrics_snapshot(**_kwargs):
+    """Write the metrics of the worker process for the exporter."""
+    if not get_config().getint('celery', 'metrics_port'):
+        return
+    try:
+        write_snapshot(metrics_dir())
+    except OSError as ex:
+        LOGGER.error('Failed to write worker metrics: %s', ex)
+
+
+def validate_meta(meta, authed_user):
     """Validate metadata."""
     try:
         ingest_policy_url = get_config().get('policy', 'ingest_url')
-        headers = {
-            'content-type': 'application/json',
-            get_config().get('ingest', 'auth_header'): authed_user
-        }
-        session = requests.session()
-        retry_adapter = requests.adapters.HTTPAdapter(max_retries=5)
-        session.mount('http://', retry_adapter)
-        session.mount('https://', retry_adapter)
-        req = session.post(ingest_policy_url, headers=headers, data=meta_str)
+        headers, body = meta.request_body('policy')
+        headers[get_config().get('ingest', 'auth_header')] = authed_user
+        req = get_session('policy').post(ingest_policy_url, headers=headers, data=body)
 
         req_json = req.json()
         if req_json['status'] == 'success':
@@ -158,3 +604,16 @@ def validate_meta(meta_str, authed_user):
     except Exception as ex:
         return False, ex
     # pylint: enable=broad-except
+
+
+@INGEST_APP.task(ignore_result=True)
+def prune():
+    """Move the completed jobs older than the retention window out of the state table."""
+    config = get_config()
+    retention_days = config.getint('database', 'retention_days')
+    if retention_days <= 0:
+        return 0
+    return prune_states(
+        datetime.utcnow() - timedelta(days=retention_days),
+        config.getint('database', 'prune_batch_size')
+    )
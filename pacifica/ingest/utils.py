@@ -2,10 +2,29 @@
 # -*- coding: utf-8 -*-
 """Testable utilities for ingest."""
 from __future__ import print_function
+import re
 import json
+import logging
+import codecs
+import zlib
+import shutil
+from os import getpid, makedirs
+from os.path import join
+from textwrap import indent
+from time import monotonic
+from threading import Lock, Thread
 import requests
+from urllib3.util.retry import Retry
 import six
 from .config import get_config
+from .metrics import DOWNSTREAM_ERRORS, DOWNSTREAM_RETRIES
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+LOGGER = logging.getLogger(__name__)
 
 # pylint: disable=invalid-name
 int_type = six.integer_types[-1]
@@ -22,8 +41,201 @@ def parse_size(size):
     return int_type(float(number)*units[unit])
 
 
+# pylint: disable=too-few-public-methods
+class JsonListReader:
+    """
+    Incrementally decode the elements of a JSON list from a file object.
+
+    The file is read in chunks and only the element being decoded is
+    held in memory, instead of the whole document.
+    """
+
+    whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, fileobj, chunk_size=64 * 1024):
+        """Create the reader for the text or binary file object."""
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _read(self):
+        """Append the next chunk to the text not yet decoded."""
+        if self.eof:
+            return False
+        chunk = self.fileobj.read(self.chunk_size)
+        self.eof = not chunk
+        if isinstance(chunk, bytes):
+            chunk = self.text_decoder.decode(chunk, final=self.eof)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """Return the next non whitespace character or an empty string at the end."""
+        while True:
+            self.pos = self.whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._read():
+                return ''
+
+    def _expect(self, chars):
+        """Consume and return the next character if it is one of chars."""
+        char = self._peek()
+        if not char or char not in chars:
+            raise ValueError('Expecting one of {!r} in JSON list, found {!r}.'.format(chars, char))
+        self.pos += 1
+        return char
+
+    def _decode(self):
+        """Decode the next element reading more of the file as needed."""
+        while True:
+            self._peek()
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number may continue in the next chunk unless a delimiter follows
+                if self.eof or (end < len(self.buf) and self.buf[end] in ' \t\n\r,]'):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._read()
+
+    def __iter__(self):
+        """Yield the elements of the list."""
+        self._expect('[')
+        if self._peek() == ']':
+            self.pos += 1
+        else:
+            while True:
+                yield self._decode()
+                if self._expect(',]') == ']':
+                    break
+        if self._peek():
+            raise ValueError('Extra data after the JSON list.')
+# pylint: enable=too-few-public-methods
+
+
+def json_list_chunks(elements, compact=False):
+    """
+    Yield the elements as the pieces of a JSON list string.
+
+    The default output is the same as ``json.dumps(list(elements),
+    sort_keys=True, indent=4)``, compact output has no whitespace.
+    """
+    started = False
+    for element in elements:
+        if compact:
+            yield ',' if started else '['
+            yield json.dumps(element, sort_keys=True, separators=(',', ':'))
+        else:
+            yield ',\n' if started else '[\n'
+            yield indent(json.dumps(element, sort_keys=True, indent=4), '    ')
+        started = True
+    if not started:
+        yield '[]'
+    else:
+        yield ']' if compact else '\n]'
+
+
+def json_list_str(elements):
+    """Return the elements as a JSON list string in a single pass."""
+    return ''.join(json_list_chunks(elements))
+
+
+def iter_request_body(pieces, compress=False, chunk_size=64 * 1024):
+    """
+    Yield an encoded request body from string pieces.
+
+    The pieces are UTF-8 encoded, optionally gzip compressed, and
+    yielded in chunks of about chunk_size bytes.
+    """
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16) if compress else None
+    buf = []
+    size = 0
+    for piece in pieces:
+        data = piece.encode('utf8')
+        if compressor:
+            data = compressor.compress(data)
+        buf.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            yield b''.join(buf)
+            buf = []
+            size = 0
+    if compressor:
+        buf.append(compressor.flush())
+    if buf:
+        yield b''.join(buf)
+
+
+def parse_user_map(value, value_type=int):
+    """Parse a ``user:value, user:value`` option into a dictionary."""
+    user_map = {}
+    for item in value.split(','):
+        if item.strip():
+            user, user_value = item.rsplit(':', 1)
+            user_map[user.strip()] = value_type(user_value.strip())
+    return user_map
+
+
+def positive_float(value):
+    """Parse a float option that must be greater than 0."""
+    number = float(value)
+    if number <= 0:
+        raise ValueError('{} is not greater than 0'.format(value))
+    return number
+
+
+def percentiles(values, points=(50, 95, 99)):
+    """Return the nearest rank percentiles of the values keyed like p50."""
+    values = sorted(values)
+    if not values:
+        return {'p{}'.format(point): None for point in points}
+    return {
+        'p{}'.format(point): values[max(int(round(point / 100.0 * len(values))) - 1, 0)]
+        for point in points
+    }
+
+
+def stage_summary(stages):
+    """
+    Summarize the stage durations and throughput of ingest jobs by task.
+
+    The stages are (task, state, seconds, bytes, files) tuples. The
+    duration percentiles are in seconds over every finished stage and
+    the throughput percentiles are in bytes per second over the
+    stages that moved bytes.
+    """
+    tasks = {}
+    for task, state, seconds, bytes_done, _files_done in stages:
+        task_stages = tasks.setdefault(task, {'seconds': [], 'throughput': [], 'failed': 0})
+        task_stages['seconds'].append(seconds)
+        if state == 'FAILED':
+            task_stages['failed'] += 1
+        if bytes_done and seconds > 0:
+            task_stages['throughput'].append(bytes_done / seconds)
+    return {
+        task: {
+            'count': len(task_stages['seconds']),
+            'failed': task_stages['failed'],
+            'seconds': percentiles(task_stages['seconds']),
+            'throughput': percentiles(task_stages['throughput'])
+        }
+        for task, task_stages in tasks.items()
+    }
+
+
 def create_state_response(record):
     """Create the state response body from a record."""
+    eta = None
+    if record.throughput and record.bytes_total:
+        eta = int((record.bytes_total - record.bytes_done) / record.throughput)
     return {
         'job_id': record.job_id,
         'state': record.state,
@@ -32,19 +244,362 @@ def create_state_response(record):
         'complete': bool(record.complete),
         'updated': str(record.updated),
         'created': str(record.created),
-        'exception': str(record.exception)
+        'exception': str(record.exception),
+        'bytes_done': record.bytes_done,
+        'bytes_total': record.bytes_total,
+        'files_done': record.files_done,
+        'files_total': record.files_total,
+        'throughput': record.throughput,
+        'eta': eta
     }
 
 
-def get_unique_id(id_range, mode):
-    """Return a unique job id from the id server."""
+# pylint: disable=too-many-instance-attributes
+class IngestProgress:
+    """
+    Thread safe counter of the bytes and files done by a task.
+
+    The report callable gets the progress dictionary at most every
+    ``progress_interval`` seconds, and only when the percent moved
+    by ``progress_step`` or the last report is a minute old, so long
+    tasks show progress without a write for every block read. The
+    throughput is measured since the last report.
+    """
+
+    heartbeat = 60
+
+    def __init__(self, report, bytes_total, files_total, bytes_done=0, files_done=0):
+        """Create the counter with the totals and anything already done."""
+        config = get_config()
+        self.interval = config.getfloat('ingest', 'progress_interval')
+        self.step = config.getfloat('ingest', 'progress_step')
+        self.report = report
+        self.bytes_total = bytes_total
+        self.files_total = files_total
+        self.bytes_done = bytes_done
+        self.files_done = files_done
+        self.throughput = 0.0
+        self._lock = Lock()
+        self._last = (monotonic(), bytes_done, -100.0)
+
+    def percent(self):
+        """Return the percent done by bytes, or by files if there are no bytes."""
+        if self.bytes_total:
+            return 100.0 * self.bytes_done / self.bytes_total
+        if self.files_total:
+            return 100.0 * self.files_done / self.files_total
+        return 100.0
+
+    def progress(self):
+        """Return the progress dictionary."""
+        return {
+            'task_percent': round(self.percent(), 2),
+            'bytes_done': self.bytes_done,
+            'bytes_total': self.bytes_total,
+            'files_done': self.files_done,
+            'files_total': self.files_total,
+            'throughput': self.throughput
+        }
+
+    def _check(self, force=False):
+        """Report the progress if the throttle allows it, the lock must be held."""
+        now = monotonic()
+        last_time, last_bytes, last_percent = self._last
+        elapsed = now - last_time
+        if not force:
+            if elapsed < self.interval:
+                return None
+            if self.percent() - last_percent < self.step and elapsed < self.heartbeat:
+                return None
+        if elapsed > 0:
+            self.throughput = (self.bytes_done - last_bytes) / elapsed
+        self._last = (now, self.bytes_done, self.percent())
+        return self.progress()
+
+    def _update(self, bytes_done, files_done, force=False):
+        """Add to the counters and report the progress if it is time."""
+        with self._lock:
+            self.bytes_done += bytes_done
+            self.files_done += files_done
+            progress = self._check(force)
+        if progress is not None:
+            self.report(progress)
+
+    def add_bytes(self, bytes_done):
+        """Count bytes read for the task."""
+        self._update(bytes_done, 0)
+
+    def add_file(self):
+        """Count a file done by the task."""
+        self._update(0, 1)
+
+    def finish(self):
+        """Report the final progress of the task."""
+        self._update(0, 0, True)
+# pylint: enable=too-many-instance-attributes
+
+
+class CountingRetry(Retry):
+    """Retry policy that counts the retries of requests to a service."""
+
+    def __init__(self, *args, **kwargs):
+        """Create the policy for the service."""
+        self.service = kwargs.pop('service', '')
+        super().__init__(*args, **kwargs)
+
+    def new(self, **kwargs):
+        """Return the policy for the next attempt of the same service."""
+        kwargs['service'] = self.service
+        return super().new(**kwargs)
+
+    def increment(self, *args, **kwargs):  # pylint: disable=signature-differs
+        """Count the retry before the next attempt."""
+        DOWNSTREAM_RETRIES.inc(service=self.service)
+        return super().increment(*args, **kwargs)
+
+
+class CountingAdapter(requests.adapters.HTTPAdapter):
+    """Adapter that counts the failed requests to a service."""
+
+    service = ''
+
+    def send(self, *args, **kwargs):  # pylint: disable=signature-differs
+        """Send the request and count it if it failed."""
+        try:
+            resp = super().send(*args, **kwargs)
+        except requests.exceptions.RequestException:
+            DOWNSTREAM_ERRORS.inc(service=self.service)
+            raise
+        if resp.status_code >= 400:
+            DOWNSTREAM_ERRORS.inc(service=self.service)
+        return resp
+
+
+class SessionPool:
+    """
+    Process wide pool of keep-alive HTTP sessions.
+
+    There is one session per downstream service and the sessions are
+    shared by all threads in the process. A forked child process gets
+    new sessions so sockets are never shared with the parent.
+    """
+
+    def __init__(self):
+        """Create the empty pool for the current process."""
+        self._pid = getpid()
+        self._lock = Lock()
+        self._sessions = {}
+
+    def get(self, service):
+        """Return the session for the service creating it if needed."""
+        if self._pid != getpid():
+            self._pid = getpid()
+            self._lock = Lock()
+            self._sessions = {}
+        with self._lock:
+            if service not in self._sessions:
+                self._sessions[service] = self._create_session(service)
+            return self._sessions[service]
+
+    @staticmethod
+    def _create_session(service):
+        """Create a session with retries and a connection pool."""
+        pool_size = get_config().getint('ingest', 'http_pool_size')
+        session = requests.session()
+        retry_adapter = CountingAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size,
+            max_retries=CountingRetry(5, redirect=True, service=service))
+        retry_adapter.service = service
+        session.mount('https://', retry_adapter)
+        session.mount('http://', retry_adapter)
+        return session
+
+    def stats(self):
+        """
+        Return the connection reuse statistics for each service.
+
+        The requests count is the number of requests sent and the
+        connections count is the number of connections opened, so
+        the difference is the number of requests that reused one.
+        """
+        ret = {}
+        with self._lock:
+            sessions = dict(self._sessions)
+        for service, session in sessions.items():
+            pools = session.get_adapter('http://').poolmanager.pools
+            conn_pools = [pools[key] for key in pools.keys()]
+            ret[service] = {
+                'connections': sum(pool.num_connections for pool in conn_pools),
+                'requests': sum(pool.num_requests for pool in conn_pools)
+            }
+        return ret
+
+
+SESSION_POOL = SessionPool()
+
+
+def get_session(service):
+    """Return the shared HTTP session for a downstream service."""
+    return SESSION_POOL.get(service)
+
+
+def session_stats():
+    """Return the connection reuse statistics for the shared sessions."""
+    return SESSION_POOL.stats()
+
+
+def request_unique_id(id_range, mode):
+    """Return the start of a range of unique ids from the id server."""
     uniqueid_url = get_config().get('uniqueid', 'url')
     url = '{0}/getid?range={1}&mode={2}'.format(
         uniqueid_url, id_range, mode)
 
-    req = requests.get(url)
+    req = get_session('uniqueid').get(url)
     body = req.text
     info = json.loads(body)
     unique_id = info['startIndex']
 
     return unique_id
+
+
+# pylint: disable=too-few-public-methods
+class UniqueIdLease:
+    """
+    Block of unique ids leased from the id server for one mode.
+
+    Ids are handed out from memory and the next block is requested
+    in the background once a quarter of the current block is left.
+    Ranges larger than the lease size go straight to the id server.
+    """
+
+    def __init__(self, mode, lease_size):
+        """Create an empty lease for the mode."""
+        self.mode = mode
+        self.lease_size = lease_size
+        self._lock = Lock()
+        self._next_id = 0
+        self._end_id = 0
+        self._spare = None
+        self._refilling = False
+
+    def _refill(self):
+        """Request the next block for the lease in the background."""
+        try:
+            start_id = request_unique_id(self.lease_size, self.mode)
+        # pylint: disable=broad-except
+        except Exception as ex:
+            LOGGER.warning('Failed to lease unique ids: %s', ex)
+            start_id = None
+        # pylint: enable=broad-except
+        with self._lock:
+            if start_id is not None:
+                self._spare = start_id
+            self._refilling = False
+
+    def allocate(self, id_range):
+        """Return the start of a range of unique ids from the lease."""
+        if id_range > self.lease_size:
+            return request_unique_id(id_range, self.mode)
+        with self._lock:
+            if self._end_id - self._next_id < id_range:
+                if self._spare is None:
+                    self._spare = request_unique_id(self.lease_size, self.mode)
+                self._next_id = self._spare
+                self._end_id = self._spare + self.lease_size
+                self._spare = None
+            unique_id = self._next_id
+            self._next_id += id_range
+            low_water = (self._end_id - self._next_id) * 4 < self.lease_size
+            if low_water and self._spare is None and not self._refilling:
+                self._refilling = True
+                refill_thread = Thread(target=self._refill)
+                refill_thread.daemon = True
+                refill_thread.start()
+        return unique_id
+
+
+class UniqueIdAllocator:
+    """Process wide set of unique id leases, one per mode."""
+
+    def __init__(self):
+        """Create the allocator without any leases."""
+        self._pid = getpid()
+        self._lock = Lock()
+        self._leases = {}
+
+    def allocate(self, id_range, mode):
+        """Return the start of a range of unique ids for the mode."""
+        if self._pid != getpid():
+            self._pid = getpid()
+            self._lock = Lock()
+            self._leases = {}
+        with self._lock:
+            if mode not in self._leases:
+                self._leases[mode] = UniqueIdLease(
+                    mode, get_config().getint('uniqueid', 'lease_size'))
+            lease = self._leases[mode]
+        return lease.allocate(id_range)
+
+# pylint: enable=too-few-public-methods
+
+
+ID_ALLOCATOR = UniqueIdAllocator()
+
+
+def get_unique_id(id_range, mode):
+    """Return a unique job id from the id server or the leased ids."""
+    if get_config().getint('uniqueid', 'lease_size') > 0:
+        return ID_ALLOCATOR.allocate(id_range, mode)
+    return request_unique_id(id_range, mode)
+
+
+def free_memory():
+    """Return the memory available to new processes in bytes or None if unknown."""
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:  # pragma: no cover
+        pass
+    return None  # pragma: no cover
+
+
+def acquire_job_slot(slot_dir, max_slots):
+    """
+    Return a locked slot file or None if all max_slots slots are taken.
+
+    The slots are lock files shared by all worker processes on a host
+    and are released when the file is closed or the process exits.
+    Without file locks every job gets a slot.
+    """
+    makedirs(slot_dir, exist_ok=True)
+    for slot_index in range(max_slots):
+        slot = open(join(slot_dir, 'slot-{}.lock'.format(slot_index)), 'a')
+        if fcntl is None:  # pragma: no cover
+            return slot
+        try:
+            fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            slot.close()
+            continue
+        return slot
+    return None
+
+
+def admit_large_job():
+    """
+    Return a large job slot if this host has the resources for another large job.
+
+    The host needs ``admission_min_memory`` available memory and
+    ``admission_min_disk`` free on the volume path, and at most
+    ``max_large_jobs`` large jobs run on the host at once.
+    """
+    config = get_config()
+    volume_path = config.get('ingest', 'volume_path')
+    memory = free_memory()
+    if memory is not None and memory < parse_size(config.get('ingest', 'admission_min_memory')):
+        return None
+    if shutil.disk_usage(volume_path).free < parse_size(config.get('ingest', 'admission_min_disk')):
+        return None
+    return acquire_job_slot(join(volume_path, '.large-jobs'), config.getint('ingest', 'max_large_jobs'))
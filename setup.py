@@ -30,5 +30,8 @@ setup(
         'cherrypy',
         'peewee>2',
         'requests'
-    ]
+    ],
+    extras_require={
+        'zstd': ['zstandard']
+    }
 )
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the routing of jobs by size and the admission of large jobs."""
+from __future__ import absolute_import
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+import mock
+from celery.exceptions import Retry
+from pacifica.ingest.config import reload_config
+from pacifica.ingest.utils import acquire_job_slot, admit_large_job
+from pacifica.ingest.tasks import is_large_job, job_queue, ingest
+
+
+class TestAdmission(TestCase):
+    """Test the job classification and large job slots."""
+
+    # pylint: disable=invalid-name
+    def setUp(self):
+        """Use a temporary volume path and separate queues."""
+        self.temp_dir = TemporaryDirectory()
+        self.environ = mock.patch.dict(os.environ, {
+            'VOLUME_PATH': self.temp_dir.name, 'CELERY_LARGE_QUEUE': 'ingest_large',
+            'LARGE_JOB_SIZE': '1 Mb', 'LARGE_JOB_FILES': '100', 'ADMISSION_MIN_MEMORY': '0 B',
+            'ADMISSION_MIN_DISK': '0 B'
+        })
+        self.environ.start()
+        reload_config()
+
+    def tearDown(self):
+        """Restore the configuration."""
+        self.environ.stop()
+        reload_config()
+        self.temp_dir.cleanup()
+    # pylint: enable=invalid-name
+
+    def test_job_queue(self):
+        """Jobs over the size or file count thresholds should go to the large queue."""
+        self.assertEqual(job_queue(is_large_job(1024, 10)), 'celery')
+        self.assertEqual(job_queue(is_large_job(1024 ** 2, 10)), 'ingest_large')
+        self.assertEqual(job_queue(is_large_job(1024, 100)), 'ingest_large')
+
+    def test_job_slots(self):
+        """Only max_slots slots should be handed out until one is released."""
+        slot_dir = os.path.join(self.temp_dir.name, 'slots')
+        slots = [acquire_job_slot(slot_dir, 2) for _index in range(2)]
+        self.assertTrue(all(slots))
+        self.assertIsNone(acquire_job_slot(slot_dir, 2))
+        slots.pop().close()
+        slot = acquire_job_slot(slot_dir, 2)
+        self.assertIsNotNone(slot)
+        for slot in slots + [slot]:
+            slot.close()
+
+    def test_admit_resources(self):
+        """Large jobs should not be admitted without enough memory or disk."""
+        slot = admit_large_job()
+        self.assertIsNotNone(slot)
+        slot.close()
+        with mock.patch('pacifica.ingest.utils.free_memory', return_value=0), \
+                mock.patch.dict(os.environ, {'ADMISSION_MIN_MEMORY': '1 Mb'}):
+            reload_config()
+            self.assertIsNone(admit_large_job())
+        with mock.patch.dict(os.environ, {'ADMISSION_MIN_DISK': '1000 Tb'}):
+            reload_config()
+            self.assertIsNone(admit_large_job())
+
+    @mock.patch('pacifica.ingest.tasks.ingest_bundle')
+    def test_ingest_retry(self, mock_ingest):
+        """A large ingest without a slot should be retried instead of run."""
+        with mock.patch('pacifica.ingest.tasks.admit_large_job', return_value=None):
+            with self.assertRaises(Retry):
+                ingest(1, 'bundle.tar', 'root', large=True)
+        self.assertFalse(mock_ingest.called)
+        ingest(1, 'bundle.tar', 'root', large=True)
+        ingest(1, 'bundle.tar', 'root')
+        self.assertEqual(mock_ingest.call_count, 2)
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the content hash index of archived files."""
+from __future__ import absolute_import
+import os
+import json
+import mock
+from pacifica.ingest.config import reload_config
+from pacifica.ingest.orm import IngestDedup, dedup_lookup, dedup_record, dedup_stats, read_checkpoints, read_state
+from pacifica.ingest.tasks import ingest
+from .ingest_db_setup_test import IngestFileDBSetup
+from .parallel_ingest_test import create_bundle, slow_put
+
+
+class TestDedupIndex(IngestFileDBSetup):
+    """Test the lookups, eviction and hit rate of the content hash index."""
+
+    def test_lookup_and_evict(self):
+        """Known content should be found and the least recently used evicted."""
+        dedup_record([('sha1', 'aaa', 1, 10), ('sha1', 'bbb', 2, 20)], 2)
+        before = dedup_stats()
+        known = dedup_lookup([('sha1', 'aaa'), ('md5', 'bbb'), ('sha1', 'ccc')])
+        self.assertEqual(list(known.keys()), [('sha1', 'aaa')])
+        self.assertEqual(known[('sha1', 'aaa')].file_id, 1)
+        after = dedup_stats()
+        self.assertEqual(after['lookups'] - before['lookups'], 3)
+        self.assertEqual(after['hits'] - before['hits'], 1)
+        self.assertEqual(after['hit_bytes'] - before['hit_bytes'], 10)
+        dedup_record([('sha1', 'aaa', 3, 10), ('sha1', 'ccc', 4, 30)], 2)
+        records = {(record.hashsum, record.file_id) for record in IngestDedup.select()}
+        self.assertEqual(records, {('aaa', 1), ('ccc', 4)})
+
+    @mock.patch('requests.Session.put', side_effect=slow_put)
+    @mock.patch('pacifica.ingest.tasks.remove_tar')
+    @mock.patch('pacifica.ingest.tasks.validate_meta', return_value=(True, ''))
+    @mock.patch('pacifica.ingest.tarutils.MetaParser.post_metadata', return_value=(True, ''))
+    def test_ingest_hit_rate(self, *_mocks):
+        """Ingesting the same bundle twice should find all of its content."""
+        bundle_path = create_bundle(self.temp_dir.name, 4)
+        with mock.patch.dict(os.environ, {'DEDUP_INDEX': 'True'}):
+            reload_config()
+            with mock.patch('pacifica.ingest.tarutils.get_unique_id', return_value=1000):
+                ingest(1, bundle_path, 'root')
+            before = dedup_stats()
+            with mock.patch('pacifica.ingest.tarutils.get_unique_id', return_value=2000):
+                ingest(2, bundle_path, 'root')
+        reload_config()
+        after = dedup_stats()
+        self.assertEqual(after['hits'] - before['hits'], 4)
+        self.assertEqual(len(IngestDedup.select()), 4)
+        self.assertEqual({record.hits for record in IngestDedup.select()}, {1})
+
+    @mock.patch('requests.Session.put', side_effect=slow_put)
+    @mock.patch('pacifica.ingest.tasks.remove_tar')
+    @mock.patch('pacifica.ingest.tasks.validate_meta', return_value=(True, ''))
+    @mock.patch('pacifica.ingest.tarutils.MetaParser.post_metadata', return_value=(True, ''))
+    def test_ingest_reference(self, *mocks):
+        """Known content should be referenced in the archive and only uploaded if that fails."""
+        mock_put = mocks[-1]
+        bundle_path = create_bundle(self.temp_dir.name, 4)
+
+        def reference(url, *_args, **_kwargs):
+            """Reference every file except the last one."""
+            resp = mock.Mock()
+            resp.ok = not url.startswith('http://archive/2003')
+            resp.text = json.dumps({'total_bytes': 22})
+            resp.json.return_value = json.loads(resp.text)
+            return resp
+
+        environ = {'DEDUP_INDEX': 'True', 'DEDUP_REFERENCE_URL': 'http://archive/{file_id}?reference={source_id}'}
+        with mock.patch.dict(os.environ, environ), \
+                mock.patch('requests.Session.post', side_effect=reference) as mock_post:
+            reload_config()
+            with mock.patch('pacifica.ingest.tarutils.get_unique_id', return_value=1000):
+                ingest(1, bundle_path, 'root')
+            self.assertFalse(mock_post.called)
+            self.assertEqual(mock_put.call_count, 4)
+            with mock.patch('pacifica.ingest.tarutils.get_unique_id', return_value=2000):
+                ingest(2, bundle_path, 'root')
+        reload_config()
+        self.assertEqual(mock_post.call_count, 4)
+        mock_post.assert_any_call('http://archive/2000?reference=1000')
+        self.assertEqual(mock_put.call_count, 5)
+        self.assertEqual(mock_put.call_args[0][0].rsplit('/', 1)[1], '2003')
+        self.assertEqual(sorted(record.file_id for record in read_checkpoints(2).values()), list(range(2000, 2004)))
+        self.assertEqual(read_state(2).state, 'OK')
@@ -0,0 +1,45 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the ingest steps fail the job when the bundle is missing a file."""
+from __future__ import absolute_import
+import os
+import hashlib
+import mock
+from pacifica.ingest.config import reload_config
+from pacifica.ingest.orm import checkpoint_file, dedup_record, read_state
+from pacifica.ingest.tasks import ingest
+from .ingest_db_setup_test import IngestFileDBSetup
+from .parallel_ingest_test import create_bundle, slow_put
+
+
+MISSING_NAME = 'data/a/file.3.txt'
+MISSING_HASH = ('sha1', hashlib.sha1('This is a temp file 3.'.encode('utf8')).hexdigest())
+
+
+@mock.patch('requests.Session.put', side_effect=slow_put)
+@mock.patch('pacifica.ingest.tasks.remove_tar')
+@mock.patch('pacifica.ingest.tasks.validate_meta', return_value=(True, ''))
+@mock.patch('pacifica.ingest.tarutils.MetaParser.post_metadata', return_value=(True, ''))
+@mock.patch('pacifica.ingest.tarutils.get_unique_id', return_value=1000)
+class TestFailJob(IngestFileDBSetup):
+    """Test the state of a job whose tar is missing a file of the metadata."""
+
+    def test_missing_member(self, *_mocks):
+        """Each step reading the missing file should fail the job with the error."""
+        cases = [
+            (1, 'ingest files', {}, {}),
+            (2, 'resume ingest', {'resume': True}, {}),
+            (3, 'dedup lookup', {}, {'DEDUP_INDEX': 'True'}),
+            (4, 'ingest files', {}, {'FANOUT_BATCH_SIZE': '64 B'})
+        ]
+        checkpoint_file(2, MISSING_NAME, 1003, 22, MISSING_HASH)
+        dedup_record([MISSING_HASH + (1003, 22)], 10)
+        bundle_path = create_bundle(self.temp_dir.name, 4, missing=1)
+        for job_id, task, kwargs, environ in cases:
+            with self.subTest(task=task, **environ), mock.patch.dict(os.environ, environ):
+                reload_config()
+                ingest(job_id, bundle_path, 'root', **kwargs)
+            record = read_state(job_id)
+            self.assertEqual((record.state, record.task, record.complete), ('FAILED', task, True))
+            self.assertIn(MISSING_NAME, record.exception)
+        reload_config()
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the fair share dispatch of jobs between users."""
+from __future__ import absolute_import
+import os
+from datetime import datetime, timedelta
+import mock
+from pacifica.ingest.config import reload_config
+from pacifica.ingest.orm import IngestState, update_state
+from pacifica.ingest.tasks import submit_job, dispatch_jobs, fair_share_state
+from .ingest_db_setup_test import IngestFileDBSetup
+
+
+@mock.patch('pacifica.ingest.tasks.FAIR_SHARE_DISPATCHER')
+@mock.patch('pacifica.ingest.tasks.move.apply_async')
+@mock.patch('pacifica.ingest.tasks.ingest.apply_async')
+class TestFairShare(IngestFileDBSetup):
+    """Test the weights, caps and queue depths of the fair share dispatcher."""
+
+    # pylint: disable=invalid-name
+    def setUp(self):
+        """Enable the fair share queue with weights and caps."""
+        super().setUp()
+        self.environ = mock.patch.dict(os.environ, {
+            'FAIR_SHARE': 'True', 'FAIR_SHARE_MAX_RUNNING': '0',
+            'FAIR_SHARE_WEIGHTS': 'alice:2', 'FAIR_SHARE_CAPS': 'carol:1'
+        })
+        self.environ.start()
+        reload_config()
+
+    def tearDown(self):
+        """Restore the configuration."""
+        self.environ.stop()
+        reload_config()
+        super().tearDown()
+    # pylint: enable=invalid-name
+
+    @staticmethod
+    def submit(job_id, user):
+        """Submit an ingest job for the user."""
+        update_state(job_id, 'OK', 'UPLOADING', 0)
+        submit_job('ingest', user, [job_id, '{}.tar'.format(job_id), user], {'large': False}, 'celery')
+
+    @staticmethod
+    def dispatched_users(mock_ingest):
+        """Return the users of the jobs sent to celery in order."""
+        return [call[0][0][2] for call in mock_ingest.call_args_list]
+
+    def test_interleave(self, mock_ingest, *_mocks):
+        """Jobs should be interleaved by weight up to the running limits."""
+        job_id = 1
+        for user, count in [('alice', 6), ('bob', 3), ('carol', 3)]:
+            for _index in range(count):
+                self.submit(job_id, user)
+                job_id += 1
+        self.assertFalse(mock_ingest.called)
+        with mock.patch.dict(os.environ, {'FAIR_SHARE_MAX_RUNNING': '4'}):
+            reload_config()
+            self.assertEqual(dispatch_jobs(), 4)
+            self.assertEqual(self.dispatched_users(mock_ingest), ['alice', 'alice', 'bob', 'carol'])
+            self.assertEqual(dispatch_jobs(), 0)
+            depths = {
+                user: (user_state['queued'], user_state['running'])
+                for user, user_state in fair_share_state().items()
+            }
+            self.assertEqual(depths, {'alice': (4, 2), 'bob': (2, 1), 'carol': (2, 1)})
+            update_state(mock_ingest.call_args_list[3][0][0][0], 'OK', 'ingest metadata', 100)
+            update_state(mock_ingest.call_args_list[0][0][0][0], 'FAILED', 'ingest files', 0)
+            self.assertEqual(dispatch_jobs(), 2)
+        self.assertEqual(self.dispatched_users(mock_ingest)[4:], ['alice', 'carol'])
+        state = fair_share_state()
+        self.assertEqual((state['alice']['weight'], state['alice']['cap']), (2.0, 4))
+        self.assertEqual((state['carol']['queued'], state['carol']['running'], state['carol']['cap']), (1, 1, 1))
+
+    def test_stale_jobs(self, mock_ingest, *_mocks):
+        """Dispatched jobs without a state or with a stale state should stop counting as running."""
+        for job_id, user in [(1, 'bob'), (2, 'bob'), (3, 'dave'), (4, 'dave')]:
+            self.submit(job_id, user)
+        with mock.patch.dict(os.environ, {'FAIR_SHARE_MAX_RUNNING': '2', 'FAIR_SHARE_CAP': '1'}):
+            reload_config()
+            self.assertEqual(dispatch_jobs(), 2)
+            self.assertEqual(dispatch_jobs(), 0)
+            IngestState.delete().where(IngestState.job_id == 1).execute()
+            IngestState.update(updated=datetime.utcnow() - timedelta(days=1)).where(
+                IngestState.job_id == 3).execute()
+            self.assertEqual(dispatch_jobs(), 2)
+        self.assertEqual(self.dispatched_users(mock_ingest), ['bob', 'dave', 'bob', 'dave'])
+
+    def test_bad_weight(self, *_mocks):
+        """Weights that are not greater than 0 should be rejected."""
+        self.submit(1, 'alice')
+        for weights in [{'FAIR_SHARE_WEIGHTS': 'alice:0'}, {'FAIR_SHARE_WEIGHT': '-1'}]:
+            with mock.patch.dict(os.environ, weights):
+                reload_config()
+                with self.assertRaises(ValueError):
+                    fair_share_state()
+        reload_config()
+
+    def test_dispatch_error(self, mock_ingest, *_mocks):
+        """A dispatch error should be logged and leave the submitted job queued."""
+        with mock.patch.dict(os.environ, {'FAIR_SHARE_MAX_RUNNING': '4'}):
+            reload_config()
+            with mock.patch('pacifica.ingest.tasks.dispatch_jobs', side_effect=IOError('database is locked')), \
+                    mock.patch('pacifica.ingest.tasks.LOGGER') as logger:
+                self.submit(1, 'alice')
+            self.assertTrue(logger.error.called)
+            self.assertFalse(mock_ingest.called)
+            self.assertEqual(dispatch_jobs(), 1)
+        self.assertEqual(self.dispatched_users(mock_ingest), ['alice'])
+
+    def test_disabled(self, mock_ingest, *_mocks):
+        """Without fair share the job should be sent right away."""
+        with mock.patch.dict(os.environ, {'FAIR_SHARE': 'False'}):
+            reload_config()
+            self.submit(1, 'alice')
+        self.assertEqual(self.dispatched_users(mock_ingest), ['alice'])
+        self.assertEqual(fair_share_state(), {})
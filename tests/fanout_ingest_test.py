@@ -0,0 +1,98 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test ingesting a bundle with subtasks on other workers."""
+from __future__ import absolute_import
+import os
+import mock
+from pacifica.ingest.config import get_config, reload_config
+from pacifica.ingest.orm import IngestState, read_checkpoints, read_state, update_progress, update_state
+from pacifica.ingest.tasks import INGEST_APP, ingest, ingest_batch, ingest_finish
+from .ingest_db_setup_test import IngestFileDBSetup
+from .parallel_ingest_test import create_bundle, slow_put
+
+
+@mock.patch('pacifica.ingest.tasks.remove_tar')
+@mock.patch('pacifica.ingest.tasks.validate_meta', return_value=(True, ''))
+@mock.patch('pacifica.ingest.tarutils.get_unique_id', return_value=1000)
+class TestFanoutIngest(IngestFileDBSetup):
+    """Test the chord of file subtasks joined before the metadata ingest."""
+
+    # pylint: disable=invalid-name
+    def setUp(self):
+        """Run the subtasks in this process and split bundles in small batches."""
+        super().setUp()
+        INGEST_APP.conf.task_always_eager = True
+        self.environ = mock.patch.dict(os.environ, {'FANOUT_BATCH_SIZE': '64 B'})
+        self.environ.start()
+        reload_config()
+
+    def tearDown(self):
+        """Restore the configuration."""
+        INGEST_APP.conf.task_always_eager = False
+        self.environ.stop()
+        reload_config()
+        super().tearDown()
+    # pylint: enable=invalid-name
+
+    @mock.patch('requests.Session.put', side_effect=slow_put)
+    def test_fanout(self, mock_put, *_mocks):
+        """Every file should be ingested by a subtask before the metadata."""
+        with mock.patch('pacifica.ingest.tarutils.MetaParser.post_metadata', return_value=(True, '')) as post:
+            ingest(1, create_bundle(self.temp_dir.name, 8), 'root')
+        self.assertEqual(mock_put.call_count, 8)
+        self.assertEqual(sorted(record.file_id for record in read_checkpoints(1).values()), list(range(1000, 1008)))
+        self.assertTrue(post.called)
+        record = IngestState.get(job_id=1)
+        self.assertEqual((record.state, record.task, float(record.task_percent)), ('OK', 'ingest metadata', 100))
+
+    def test_fanout_failure(self, *_mocks):
+        """A failed subtask should fail the job and stop the other subtasks and the metadata ingest."""
+        with mock.patch('requests.Session.put', side_effect=IOError('archive interface is down')) as mock_put, \
+                mock.patch('pacifica.ingest.tarutils.MetaParser.post_metadata') as post, \
+                mock.patch('pacifica.ingest.tasks.dispatch_after_job') as dispatch:
+            ingest(2, create_bundle(self.temp_dir.name, 8), 'root')
+        self.assertLess(mock_put.call_count, 8)
+        self.assertFalse(post.called)
+        self.assertEqual(dispatch.call_count, 2)
+        record = IngestState.get(job_id=2)
+        self.assertEqual((record.state, record.task), ('FAILED', 'ingest files'))
+        self.assertIn('archive interface is down', record.exception)
+
+    def test_fanout_bad_tar(self, *_mocks):
+        """A bundle the subtasks cannot open should fail the job and still dispatch the next job."""
+        bad_path = os.path.join(self.temp_dir.name, 'bad.tar')
+        with open(bad_path, 'w') as bad_fd:
+            bad_fd.write('not a tar file')
+        update_state(3, 'OK', 'ingest files', 0)
+        self.assertEqual(ingest_batch(3, bad_path, [], [0, 0]), 0)
+        record = read_state(3)
+        self.assertEqual((record.state, record.task), ('FAILED', 'ingest files'))
+        self.assertIn('Failed to open tarfile', record.exception)
+        with mock.patch('requests.Session.put') as mock_put:
+            batch = [[1000, 'data/a/file.0.txt', 'sha1', 'hash']]
+            self.assertEqual(ingest_batch(3, create_bundle(self.temp_dir.name, 1), batch, [1, 22]), 0)
+        self.assertFalse(mock_put.called)
+        update_progress(3, {'task_percent': 50, 'bytes_done': 11, 'bytes_total': 22,
+                            'files_done': 0, 'files_total': 1, 'throughput': 0})
+        self.assertEqual(float(read_state(3).task_percent), 0)
+
+        update_state(4, 'OK', 'ingest files', 50)
+        with mock.patch('pacifica.ingest.tasks.dispatch_after_job') as dispatch:
+            ingest_finish(4, bad_path, 1000)
+        dispatch.assert_called_once_with()
+        record = read_state(4)
+        self.assertEqual((record.state, record.task), ('FAILED', 'ingest files'))
+
+    def test_fanout_queue(self, *_mocks):
+        """The subtasks of a large job should be sent to the large queue once the job is admitted."""
+        with mock.patch('pacifica.ingest.tasks.chord') as mock_chord, \
+                mock.patch('pacifica.ingest.tasks.admit_large_job') as mock_admit:
+            ingest(4, create_bundle(self.temp_dir.name, 8), 'root', large=True)
+        mock_admit.assert_called_once_with()
+        header = list(mock_chord.call_args[0][0])
+        body = mock_chord.return_value.call_args[0][0]
+        self.assertGreater(len(header), 1)
+        self.assertEqual(
+            {signature.options['queue'] for signature in header + [body]},
+            {get_config().get('celery', 'large_queue')}
+        )
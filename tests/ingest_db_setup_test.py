@@ -1,9 +1,11 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 """Test cart database setup class."""
+from os.path import join
+from tempfile import TemporaryDirectory
 from unittest import TestCase
 from peewee import SqliteDatabase
-from pacifica.ingest.orm import IngestState
+from pacifica.ingest.orm import IngestState, IngestStateHistory, IngestStage, IngestFile, IngestDedup, IngestQueue
 
 
 class IngestDBSetup(TestCase):
@@ -13,14 +15,38 @@ class IngestDBSetup(TestCase):
     def setUp(self):
         """Setup the database with in memory sqlite."""
         self._db = SqliteDatabase('file:cachedb?mode=memory&cache=shared')
-        for model in [IngestState]:
+        for model in [IngestState, IngestStateHistory, IngestStage, IngestFile, IngestDedup, IngestQueue]:
             model.bind(self._db, bind_refs=False, bind_backrefs=False)
         self._db.connect()
-        self._db.create_tables([IngestState])
+        self._db.create_tables([IngestState, IngestStateHistory, IngestStage, IngestFile, IngestDedup, IngestQueue])
 
     def tearDown(self):
         """Tear down the database."""
-        self._db.drop_tables([IngestState])
+        self._db.drop_tables([IngestState, IngestStateHistory, IngestStage, IngestFile, IngestDedup, IngestQueue])
         self._db.close()
         self._db = None
     # pylint: enable=invalid-name
+
+
+class IngestFileDBSetup(TestCase):
+    """Setup all the ingest tables in a temporary sqlite file."""
+
+    models = [IngestState, IngestStateHistory, IngestStage, IngestFile, IngestDedup, IngestQueue]
+
+    # pylint: disable=invalid-name
+    def setUp(self):
+        """Setup the database in a temporary directory that survives reconnects."""
+        self.temp_dir = TemporaryDirectory()
+        self._db = SqliteDatabase(join(self.temp_dir.name, 'ingest.sqlite3'))
+        for model in self.models:
+            model.bind(self._db, bind_refs=False, bind_backrefs=False)
+        self._db.connect()
+        self._db.create_tables(self.models)
+        self._db.close()
+
+    def tearDown(self):
+        """Tear down the database."""
+        self._db.close()
+        self._db = None
+        self.temp_dir.cleanup()
+    # pylint: enable=invalid-name
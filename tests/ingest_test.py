@@ -5,6 +5,7 @@ from __future__ import absolute_import
 import os
 from tempfile import mkstemp
 import requests
+import mock
 from pacifica.ingest.orm import IngestState, update_state, read_state
 from pacifica.ingest.orm import IngestStateSystem, OrmSync
 from pacifica.ingest.utils import get_unique_id
@@ -67,9 +68,9 @@ class IngestServerUnitTests(IngestDBSetup):
         def bad_put(*args, **kwargs):  # pylint: disable=unused-argument
             """bad put to the metadata server."""
             raise requests.HTTPError()
-        meta.session.put = bad_put
         meta.load_meta(tar, 1)
-        success, exception = meta.post_metadata()
+        with mock.patch.object(meta.session, 'put', side_effect=bad_put):
+            success, exception = meta.post_metadata()
         self.assertFalse(success)
         self.assertTrue(exception)
 
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the metrics of the service and the workers."""
+from __future__ import absolute_import
+import os
+import json
+from time import time
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from urllib.request import urlopen
+import mock
+import requests
+from pacifica.ingest.metrics import Registry, Metric, Histogram, METRICS, DOWNSTREAM_ERRORS, DOWNSTREAM_RETRIES
+from pacifica.ingest.metrics import QUEUE_WAIT_SECONDS, snapshot_path, write_snapshot, start_exporter
+from pacifica.ingest.orm import update_state
+from pacifica.ingest.rest import RestMetrics
+from pacifica.ingest.tasks import task_queue_wait
+from pacifica.ingest.utils import SessionPool
+from .ingest_db_setup_test import IngestFileDBSetup
+
+
+class TestRegistry(TestCase):
+    """Test the metric values, snapshots and text format."""
+
+    def setUp(self):
+        """Create a registry with a counter and a histogram."""
+        self.registry = Registry()
+        self.counter = self.registry.add(Metric('test_total', 'Test counter.', ('service',)))
+        self.histogram = self.registry.add(Histogram('test_seconds', 'Test histogram.', buckets=(1, 10)))
+
+    def test_render(self):
+        """The values should be rendered with cumulative buckets."""
+        self.counter.inc(service='archive')
+        self.counter.inc(2, service='archive')
+        self.histogram.observe(0.5)
+        self.histogram.observe(5)
+        text = self.registry.render(self.registry.snapshot())
+        self.assertIn('# TYPE test_total counter\ntest_total{service="archive"} 3\n', text)
+        self.assertIn('test_seconds_bucket{le="1"} 1\n', text)
+        self.assertIn('test_seconds_bucket{le="10"} 2\n', text)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 2\n', text)
+        self.assertIn('test_seconds_sum 5.5\ntest_seconds_count 2\n', text)
+
+    def test_merge(self):
+        """The snapshots of many processes should be summed."""
+        self.counter.inc(service='archive')
+        self.histogram.observe(20)
+        snapshot = json.loads(json.dumps(self.registry.snapshot()))
+        merged = self.registry.merge([snapshot, snapshot, {'unknown_total': [[[], 1]]}])
+        text = self.registry.render(merged)
+        self.assertIn('test_total{service="archive"} 2\n', text)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 2\n', text)
+        self.assertNotIn('unknown', text)
+
+
+class TestWorkerMetrics(TestCase):
+    """Test the worker exporter and the worker side metrics."""
+
+    def test_exporter(self):
+        """The exporter should serve the snapshots of the other worker processes."""
+        with TemporaryDirectory() as metrics_dir:
+            with open(snapshot_path(metrics_dir, 'stale'), 'w') as snapshot_fd:
+                json.dump({'ingest_task_retries_total': [[['ingest'], 1000]]}, snapshot_fd)
+            server = start_exporter(0, metrics_dir)
+            with open(snapshot_path(metrics_dir, 1), 'w') as snapshot_fd:
+                json.dump({'ingest_task_retries_total': [[['ingest'], 3]]}, snapshot_fd)
+            write_snapshot(metrics_dir)
+            self.assertTrue(os.path.exists(snapshot_path(metrics_dir, os.getpid())))
+            text = urlopen('http://127.0.0.1:{}/metrics'.format(server.server_address[1])).read().decode()
+            server.shutdown()
+            server.server_close()
+        self.assertIn('ingest_task_retries_total{task="ingest"} 3\n', text)
+
+    def test_queue_wait(self):
+        """The time since the job was sent should be observed once."""
+        before = dict(QUEUE_WAIT_SECONDS.snapshot()).get(('move',), [0])
+        task = mock.Mock()
+        task.name = 'pacifica.ingest.tasks.move'
+        task.request.enqueued = time() - 2
+        task.request.retries = 0
+        task_queue_wait(task=task)
+        task.request.retries = 1
+        task_queue_wait(task=task)
+        counts = [values for key, values in QUEUE_WAIT_SECONDS.snapshot() if key == ['move']][0]
+        self.assertEqual(counts[-1] - before[-1], 1)
+
+    def test_downstream_counts(self):
+        """Failed and retried requests should be counted for the service."""
+        def count(metric):
+            """Return the count of the test service."""
+            return dict((tuple(key), value) for key, value in metric.snapshot()).get(('nowhere',), 0)
+        errors, retries = count(DOWNSTREAM_ERRORS), count(DOWNSTREAM_RETRIES)
+        # pylint: disable=protected-access
+        session = SessionPool._create_session('nowhere')
+        # pylint: enable=protected-access
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            session.get('http://127.0.0.1:1/')
+        self.assertEqual(count(DOWNSTREAM_ERRORS) - errors, 1)
+        self.assertEqual(count(DOWNSTREAM_RETRIES) - retries, 6)
+
+
+class TestServiceMetrics(IngestFileDBSetup):
+    """Test the metrics endpoint of the service."""
+
+    def test_metrics(self):
+        """The metrics should include the jobs in each state."""
+        update_state(1, 'OK', 'ingest files', 0)
+        update_state(2, 'FAILED', 'ingest files', 0, 'archive interface is down')
+        text = RestMetrics.GET().decode()
+        self.assertIn('ingest_jobs{state="OK",complete="false"} 1\n', text)
+        self.assertIn('ingest_jobs{state="FAILED",complete="true"} 1\n', text)
+        self.assertIs(METRICS.metrics['ingest_jobs'].kind, 'gauge')
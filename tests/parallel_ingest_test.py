@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the concurrent upload of files against the serial path."""
+from __future__ import print_function, absolute_import
+import io
+import json
+import hashlib
+import tarfile
+from time import sleep
+from threading import Lock
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+import mock
+from pacifica.ingest.tarutils import open_tar, MetaParser, TarIngester, IngestFilesException
+
+
+def create_bundle(temp_dir, num_files=32, bad_hash=False, missing=0):
+    """
+    Create a bundle with num_files files and the metadata for them.
+
+    The last missing files are only in the metadata and not in the tar.
+    """
+    bundle_path = join(temp_dir, 'bundle.tar')
+    meta_list = []
+    with tarfile.open(bundle_path, 'w:') as tar:
+        for file_index in range(num_files):
+            content = 'This is a temp file {}.'.format(file_index).encode('utf8')
+            name = 'file.{}.txt'.format(file_index)
+            info = tarfile.TarInfo('data/a/{}'.format(name))
+            info.size = len(content)
+            if file_index < num_files - missing:
+                tar.addfile(info, io.BytesIO(content))
+            meta_list.append({
+                'destinationTable': 'Files',
+                'hashsum': 'badhash' if bad_hash else hashlib.sha1(content).hexdigest(),
+                'hashtype': 'sha1',
+                'name': name,
+                'subdir': 'data/a'
+            })
+        meta_content = json.dumps(meta_list).encode('utf8')
+        info = tarfile.TarInfo('metadata.txt')
+        info.size = len(meta_content)
+        tar.addfile(info, io.BytesIO(meta_content))
+    return bundle_path
+
+
+def slow_put(*args, **kwargs):  # pylint: disable=unused-argument
+    """Fake archive interface put with network latency."""
+    total_bytes = 0
+    buf = kwargs['data'].read(1024)
+    while buf:
+        total_bytes += len(buf)
+        buf = kwargs['data'].read(1024)
+    sleep(0.02)
+    resp = mock.Mock()
+    resp.text = json.dumps({'total_bytes': total_bytes})
+    return resp
+
+
+# pylint: disable=too-few-public-methods
+class ConcurrentCalls:
+    """Call a fake request and count the most calls running at once."""
+
+    def __init__(self, request):
+        """Wrap the fake request."""
+        self.request = request
+        self.lock = Lock()
+        self.running = 0
+        self.peak = 0
+
+    def __call__(self, *args, **kwargs):
+        """Count the call while the fake request runs."""
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        try:
+            return self.request(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.running -= 1
+# pylint: enable=too-few-public-methods
+
+
+@mock.patch('requests.Session.put', side_effect=slow_put)
+@mock.patch('pacifica.ingest.tarutils.get_unique_id', return_value=1000)
+class TestParallelIngest(TestCase):
+    """Compare the concurrent and serial ingest of files."""
+
+    @staticmethod
+    def ingest_peak(bundle_path, workers, mock_put):
+        """Ingest the bundle with the number of workers and return the most uploads at once."""
+        tar = open_tar(bundle_path)
+        meta = MetaParser()
+        meta.load_meta(tar, 1)
+        mock_put.side_effect = ConcurrentCalls(slow_put)
+        try:
+            TarIngester(tar, meta, workers).ingest()
+        finally:
+            tar.close()
+        return mock_put.side_effect.peak
+
+    def test_parallel_uploads(self, _mock_id, mock_put):
+        """The concurrent upload should have more than one upload running at once."""
+        with TemporaryDirectory() as temp_dir:
+            bundle_path = create_bundle(temp_dir)
+            self.assertEqual(self.ingest_peak(bundle_path, 1, mock_put), 1)
+            self.assertGreater(self.ingest_peak(bundle_path, 8, mock_put), 1)
+        self.assertEqual(mock_put.call_count, 64)
+
+    def test_parallel_bad_hash(self, _mock_id, mock_put):
+        """Every failed file should be reported by the concurrent upload."""
+        with TemporaryDirectory() as temp_dir:
+            bundle_path = create_bundle(temp_dir, 4, bad_hash=True)
+            with self.assertRaises(IngestFilesException) as context:
+                self.ingest_peak(bundle_path, 4, mock_put)
+        self.assertEqual(len(str(context.exception).splitlines()), 4)
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the opt-in profiling of jobs."""
+from __future__ import absolute_import
+import os
+import hashlib
+from os.path import exists, join
+from threading import Thread
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+import mock
+from pacifica.ingest.__main__ import cmd
+from pacifica.ingest.config import reload_config
+from pacifica.ingest.profiling import job_profile, profile_dir, profile_hot_spots
+
+
+def hash_work():
+    """Hash some data to have something to profile."""
+    hashval = hashlib.sha1()
+    for index in range(2000):
+        hashval.update(str(index).encode() * 1000)
+    return hashval.hexdigest()
+
+
+class TestProfiling(TestCase):
+    """Test the profiles written for a job."""
+
+    def setUp(self):
+        """Write the profiles to a temporary volume path."""
+        self.temp_dir = TemporaryDirectory()
+        self.environ = mock.patch.dict(os.environ, {'VOLUME_PATH': self.temp_dir.name, 'PROFILE_INTERVAL': '0.001'})
+        self.environ.start()
+        reload_config()
+
+    def tearDown(self):
+        """Put back the configuration."""
+        self.environ.stop()
+        reload_config()
+        self.temp_dir.cleanup()
+
+    def profile(self, mode, job_id, task):
+        """Profile the hash work in another thread for the job."""
+        with mock.patch.dict(os.environ, {'PROFILE_MODE': mode}):
+            reload_config()
+            with job_profile(job_id, task):
+                worker = Thread(target=hash_work)
+                worker.start()
+                hash_work()
+                worker.join()
+
+    def test_off(self):
+        """Nothing should be written unless profiling is on."""
+        self.profile('off', 1, 'ingest')
+        self.assertFalse(exists(profile_dir(1)))
+        with self.assertRaises(ValueError):
+            self.profile('everything', 1, 'ingest')
+
+    def test_cprofile(self):
+        """The cProfile output and memory summary should be written."""
+        self.profile('cprofile', 2, 'ingest')
+        self.assertTrue(exists(join(profile_dir(2), 'ingest.prof')))
+        profile = profile_hot_spots(2, 5)['ingest']
+        self.assertEqual(profile['summary']['mode'], 'cprofile')
+        self.assertGreater(profile['summary']['peak_memory'], 0)
+        self.assertEqual(len(profile['hot_spots']), 5)
+        hot_spots = profile_hot_spots(2, 100)['ingest']['hot_spots']
+        self.assertTrue(any('hash_work' in hot_spot[0] for hot_spot in hot_spots))
+
+    def test_without_reset_peak(self):
+        """The peak memory should be reset without tracemalloc.reset_peak() before Python 3.9."""
+        for job_id, tracing in [(4, False), (5, True)]:
+            names = ['is_tracing', 'start', 'stop', 'get_traced_memory', 'take_snapshot']
+            with mock.patch('pacifica.ingest.profiling.tracemalloc', spec=names) as mock_tracemalloc:
+                mock_tracemalloc.is_tracing.return_value = tracing
+                mock_tracemalloc.get_traced_memory.return_value = (0, 1024)
+                mock_tracemalloc.take_snapshot.return_value.statistics.return_value = []
+                self.profile('cprofile', job_id, 'ingest')
+            mock_tracemalloc.start.assert_called_once_with()
+            mock_tracemalloc.stop.assert_called_once_with()
+            self.assertEqual(profile_hot_spots(job_id)['ingest']['summary']['peak_memory'], 1024)
+
+    def test_sample(self):
+        """The samples of every thread should be written and summarized by the CLI."""
+        self.profile('sample', 3, 'move')
+        self.assertTrue(exists(join(profile_dir(3), 'move.samples.json')))
+        hot_spots = profile_hot_spots(3, 1000)['move']['hot_spots']
+        self.assertTrue(any('hash_work' in hot_spot[0] for hot_spot in hot_spots))
+        self.assertEqual(cmd(['profile', '--job_id', '3', '--top', '5']), 0)
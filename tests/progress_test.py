@@ -0,0 +1,58 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the byte level progress of an ingest job."""
+from __future__ import absolute_import
+import mock
+from pacifica.ingest.orm import IngestState, update_state, update_progress, read_state
+from pacifica.ingest.utils import IngestProgress, create_state_response
+from .ingest_db_setup_test import IngestFileDBSetup
+
+
+class TestIngestProgress(IngestFileDBSetup):
+    """Test the throttled progress counter and the progress written for a job."""
+
+    @mock.patch('pacifica.ingest.utils.monotonic')
+    def test_throttle(self, mock_monotonic):
+        """Progress should only be reported once the interval passed and the percent moved."""
+        mock_monotonic.return_value = 0.0
+        report = mock.Mock()
+        progress = IngestProgress(report, 1000, 10)
+        progress.add_bytes(100)
+        self.assertFalse(report.called)
+        mock_monotonic.return_value = 10.0
+        progress.add_bytes(100)
+        report.assert_called_once()
+        self.assertEqual(report.call_args[0][0]['task_percent'], 20.0)
+        self.assertEqual(report.call_args[0][0]['throughput'], 20.0)
+        mock_monotonic.return_value = 20.0
+        progress.add_bytes(5)
+        self.assertEqual(report.call_count, 1)
+        mock_monotonic.return_value = 90.0
+        progress.add_file()
+        self.assertEqual(report.call_count, 2)
+        progress.finish()
+        self.assertEqual(report.call_count, 3)
+        self.assertEqual(report.call_args[0][0]['files_done'], 1)
+
+    def test_files_percent(self):
+        """Bundles of empty files should report the percent of files done."""
+        progress = IngestProgress(mock.Mock(), 0, 4, files_done=1)
+        self.assertEqual(progress.percent(), 25.0)
+
+    def test_update_progress(self):
+        """The progress should be written to the job state and the eta worked out."""
+        update_state(1, 'OK', 'ingest files', 0)
+        update_progress(1, {
+            'task_percent': 25.0,
+            'bytes_done': 250,
+            'bytes_total': 1000,
+            'files_done': 1,
+            'files_total': 4,
+            'throughput': 50.0
+        })
+        record = read_state(1)
+        self.assertEqual(float(record.task_percent), 25.0)
+        response = create_state_response(record)
+        self.assertEqual((response['bytes_done'], response['files_total']), (250, 4))
+        self.assertEqual(response['eta'], 15)
+        self.assertEqual(len(IngestState.select()), 1)
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test moving completed jobs out of the job state table."""
+from __future__ import absolute_import
+import os
+import json
+from os.path import join
+from datetime import datetime, timedelta
+import mock
+from pacifica.ingest.__main__ import cmd
+from pacifica.ingest.config import reload_config
+from pacifica.ingest.orm import IngestState, IngestStateHistory, IngestFile, prune_states, read_state
+from pacifica.ingest.tasks import prune
+from .ingest_db_setup_test import IngestFileDBSetup
+
+
+class TestPrune(IngestFileDBSetup):
+    """Test the prune of completed jobs to the history table or a file."""
+
+    def setUp(self):
+        """Create old completed, old running and new completed jobs."""
+        super().setUp()
+        old = datetime.utcnow() - timedelta(days=60)
+        for job_id in range(1, 8):
+            IngestState.create(
+                job_id=job_id, state='OK', task='ingest metadata', task_percent=100,
+                complete=job_id != 7, updated=old
+            )
+            IngestFile.create(
+                file_id=job_id, job_id=job_id, name='data/{}.txt'.format(job_id),
+                size=1, hashtype='sha1', hashsum='abc'
+            )
+        IngestState.create(job_id=8, state='OK', task='ingest metadata', task_percent=100, complete=True)
+        IngestState.database_close()
+
+    def remaining(self):
+        """Return the job IDs left in the state table."""
+        IngestState.database_connect()
+        job_ids = sorted(record.job_id for record in IngestState.select())
+        IngestState.database_close()
+        return job_ids
+
+    def test_prune_history(self):
+        """Old completed jobs should move in batches and still be read."""
+        self.assertEqual(prune_states(datetime.utcnow() - timedelta(days=30), 2), 6)
+        self.assertEqual(self.remaining(), [7, 8])
+        self.assertEqual(len(IngestStateHistory.select()), 6)
+        self.assertEqual([record.job_id for record in IngestFile.select()], [7])
+        self.assertEqual(read_state(3).task, 'ingest metadata')
+
+    def test_prune_export(self):
+        """The jobs should be written to the export file instead."""
+        export = join(self.temp_dir.name, 'jobs.jsonl')
+        with mock.patch('pacifica.ingest.__main__.OrmSync.dbconn_blocking'):
+            with mock.patch.dict(os.environ):
+                self.assertEqual(cmd(['prune', '--days', '30', '--export', export]), 0)
+                self.assertEqual(cmd(['prune']), -1)
+        with open(export) as export_fd:
+            rows = [json.loads(line) for line in export_fd]
+        self.assertEqual([row['job_id'] for row in rows], [1, 2, 3, 4, 5, 6])
+        self.assertEqual(len(IngestStateHistory.select()), 0)
+        self.assertEqual(self.remaining(), [7, 8])
+
+    def test_prune_task(self):
+        """The periodic task should use the retention days."""
+        self.assertEqual(prune(), 0)
+        with mock.patch.dict(os.environ, {'DATABASE_RETENTION_DAYS': '90'}):
+            reload_config()
+            self.assertEqual(prune(), 0)
+        with mock.patch.dict(os.environ, {'DATABASE_RETENTION_DAYS': '30'}):
+            reload_config()
+            self.assertEqual(prune(), 6)
+        reload_config()
@@ -0,0 +1,48 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test resuming an ingest from the files checkpointed by an earlier attempt."""
+from __future__ import absolute_import
+import mock
+from pacifica.ingest.orm import IngestState, read_checkpoints
+from pacifica.ingest.tasks import ingest
+from .ingest_db_setup_test import IngestFileDBSetup
+from .parallel_ingest_test import create_bundle, slow_put
+
+
+class TestResumeIngest(IngestFileDBSetup):
+    """Test the checkpoints written by the ingest task."""
+
+    @mock.patch('pacifica.ingest.tasks.validate_meta', return_value=(True, ''))
+    @mock.patch('pacifica.ingest.tarutils.MetaParser.post_metadata', return_value=(True, ''))
+    def test_resume(self, *_mocks):
+        """A resumed ingest should only upload the files not verified before."""
+        bundle_path = create_bundle(self.temp_dir.name, 8)
+        uploaded = []
+
+        def flaky_put(*args, **kwargs):
+            """Fail the archive interface after four uploads."""
+            if len(uploaded) == 4:
+                raise IOError('archive interface is down')
+            uploaded.append(args[0])
+            return slow_put(*args, **kwargs)
+
+        with mock.patch('pacifica.ingest.tasks.remove_tar'), \
+                mock.patch('pacifica.ingest.tarutils.get_unique_id', return_value=1000), \
+                mock.patch('requests.Session.put', side_effect=flaky_put):
+            ingest(12, bundle_path, 'root')
+        self.assertEqual(IngestState.get(job_id=12).state, 'FAILED')
+        checkpoints = read_checkpoints(12)
+        self.assertEqual(len(checkpoints), 4)
+
+        with mock.patch('pacifica.ingest.tasks.remove_tar'), \
+                mock.patch('pacifica.ingest.tarutils.get_unique_id', return_value=2000), \
+                mock.patch('requests.Session.put', side_effect=slow_put) as mock_put:
+            ingest(12, bundle_path, 'root', resume=True)
+        self.assertEqual(IngestState.get(job_id=12).state, 'OK')
+        self.assertEqual(mock_put.call_count, 4)
+        for name, record in read_checkpoints(12).items():
+            if name in checkpoints:
+                self.assertEqual(record.file_id, checkpoints[name].file_id)
+            else:
+                self.assertGreaterEqual(record.file_id, 2000)
+        self.assertEqual(len(read_checkpoints(12)), 8)
@@ -0,0 +1,99 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the stage timing history of ingest jobs."""
+from __future__ import absolute_import
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+import mock
+from pacifica.ingest.__main__ import cmd
+from pacifica.ingest.config import reload_config
+from pacifica.ingest.orm import IngestStage, update_state, update_progress, read_stages
+from pacifica.ingest.utils import percentiles, stage_summary
+from .ingest_db_setup_test import IngestFileDBSetup
+
+
+class TestStageHistory(IngestFileDBSetup):
+    """Test the stages recorded by the job state updates."""
+
+    # pylint: disable=invalid-name
+    def setUp(self):
+        """Turn on the stage history."""
+        super().setUp()
+        self.environ = mock.patch.dict(os.environ, {'DATABASE_STAGE_HISTORY': 'True'})
+        self.environ.start()
+        reload_config()
+
+    def tearDown(self):
+        """Restore the configuration."""
+        self.environ.stop()
+        reload_config()
+        super().tearDown()
+    # pylint: enable=invalid-name
+
+    def run_job(self, job_id, fail=False):
+        """Update the state of a job like an ingest does."""
+        update_state(job_id, 'OK', 'UPLOADING', 0)
+        update_state(job_id, 'OK', 'open tar', 0)
+        update_state(job_id, 'OK', 'open tar', 100)
+        update_state(job_id, 'OK', 'load metadata', 0)
+        update_state(job_id, 'OK', 'load metadata', 100)
+        update_state(job_id, 'OK', 'Policy Validation', 100)
+        update_state(job_id, 'OK', 'ingest files', 0)
+        update_state(job_id, 'OK', 'ingest files', 50)
+        update_progress(job_id, {
+            'task_percent': 100, 'bytes_done': 4096, 'bytes_total': 4096,
+            'files_done': 4, 'files_total': 4, 'throughput': 0
+        })
+        if fail:
+            update_state(job_id, 'FAILED', 'ingest files', 0, 'archive interface is down')
+            return
+        update_state(job_id, 'OK', 'ingest files', 100)
+        update_state(job_id, 'OK', 'ingest metadata', 0)
+        update_state(job_id, 'OK', 'ingest metadata', 100)
+
+    def test_stages(self):
+        """Every stage of the job should be finished with the bytes it moved."""
+        self.run_job(1)
+        stages = list(IngestStage.select().order_by(IngestStage.stage_id))
+        self.assertEqual([stage.task for stage in stages], [
+            'UPLOADING', 'open tar', 'load metadata', 'Policy Validation', 'ingest files', 'ingest metadata'
+        ])
+        self.assertTrue(all(stage.finished >= stage.started for stage in stages))
+        self.assertEqual([(stage.bytes_done, stage.files_done) for stage in stages][-2:], [(4096, 4), (0, 0)])
+
+    def test_off(self):
+        """No stage should be recorded unless the stage history is on."""
+        with mock.patch.dict(os.environ, {'DATABASE_STAGE_HISTORY': 'False'}):
+            reload_config()
+            self.run_job(1)
+        self.assertEqual(len(IngestStage.select()), 0)
+
+    def test_failed_stage(self):
+        """A failed stage should be finished as failed."""
+        self.run_job(2, fail=True)
+        stage = IngestStage.select().order_by(IngestStage.stage_id.desc()).first()
+        self.assertEqual((stage.task, stage.state), ('ingest files', 'FAILED'))
+        self.assertIsNotNone(stage.finished)
+
+    def test_report(self):
+        """The report should summarize the stages of every job."""
+        for job_id in range(1, 4):
+            self.run_job(job_id, fail=job_id == 3)
+        summary = stage_summary(read_stages(datetime.utcnow() - timedelta(days=1)))
+        self.assertEqual((summary['ingest files']['count'], summary['ingest files']['failed']), (3, 1))
+        self.assertEqual(summary['ingest metadata']['count'], 2)
+        self.assertIsNone(summary['open tar']['throughput']['p50'])
+        with mock.patch('pacifica.ingest.__main__.OrmSync.dbconn_blocking'):
+            with mock.patch.dict(os.environ):
+                self.assertEqual(cmd(['stages', '--days', '1']), 0)
+
+
+class TestPercentiles(TestCase):
+    """Test the percentiles of the report."""
+
+    def test_percentiles(self):
+        """The nearest rank percentiles should be returned."""
+        self.assertEqual(percentiles(range(1, 101)), {'p50': 50, 'p95': 95, 'p99': 99})
+        self.assertEqual(percentiles([3]), {'p50': 3, 'p95': 3, 'p99': 3})
+        self.assertEqual(percentiles([]), {'p50': None, 'p95': None, 'p99': None})
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the bulk and filtered ingest state queries."""
+from __future__ import absolute_import
+from datetime import datetime, timedelta
+import cherrypy
+import mock
+from pacifica.ingest.orm import IngestState, OrmSync, update_state
+from pacifica.ingest.rest import state_query
+from .ingest_db_setup_test import IngestFileDBSetup
+
+
+class TestStateQuery(IngestFileDBSetup):
+    """Test the pages of job states and the indexes behind them."""
+
+    def setUp(self):
+        """Create jobs in a few states."""
+        super().setUp()
+        for job_id in range(1, 11):
+            update_state(job_id, 'OK', 'ingest files', 50)
+        for job_id in [3, 6, 9]:
+            update_state(job_id, 'FAILED', 'ingest files', 0, 'archive interface is down')
+        update_state(10, 'OK', 'ingest metadata', 100)
+
+    def test_job_ids(self):
+        """The listed jobs should be read in pages of limit jobs."""
+        page = state_query({'job_ids': ['10', '2', '4', '12', '8'], 'limit': 2})
+        self.assertEqual([job['job_id'] for job in page['jobs']], [2, 4])
+        page = state_query({'job_ids': ['10', '2', '4', '12', '8'], 'limit': 2, 'after': page['next']})
+        self.assertEqual([job['job_id'] for job in page['jobs']], [8, 10])
+        page = state_query({'job_ids': ['10', '2', '4', '12', '8'], 'limit': 2, 'after': page['next']})
+        self.assertEqual((page['jobs'], page['next']), ([], None))
+
+    def test_filters(self):
+        """The jobs should be filtered by state, task, completion and updated time."""
+        since = str(datetime.utcnow() - timedelta(minutes=1))
+        page = state_query({'state': 'FAILED', 'since': since})
+        self.assertEqual([job['job_id'] for job in page['jobs']], [3, 6, 9])
+        page = state_query({'complete': 'false', 'task': 'ingest files', 'limit': '4'})
+        self.assertEqual([job['job_id'] for job in page['jobs']], [1, 2, 4, 5])
+        page = state_query({'complete': 'false', 'task': 'ingest files', 'limit': '4', 'after': page['next']})
+        self.assertEqual([job['job_id'] for job in page['jobs']], [7, 8])
+        self.assertIsNone(page['next'])
+        self.assertEqual(state_query({'since': str(datetime.utcnow() + timedelta(minutes=1))})['jobs'], [])
+        self.assertEqual(len(state_query({'since': '2018-01-25'})['jobs']), 10)
+        self.assertEqual(len(state_query({'since': '2018-01-25T17:00:32'})['jobs']), 10)
+        with self.assertRaises(cherrypy.HTTPError):
+            state_query({'since': 'yesterday'})
+
+    def test_index_migration(self):
+        """The migration should add the missing state indexes."""
+        self._db.connect()
+        for index_md in self._db.get_indexes('ingeststate'):
+            self._db.execute_sql('DROP INDEX {}'.format(index_md.name))
+        with mock.patch('pacifica.ingest.orm.DB', self._db):
+            OrmSync.update_2_4_to_2_5()
+            OrmSync.update_2_4_to_2_5()
+        index_names = sorted(index_md.name for index_md in self._db.get_indexes('ingeststate'))
+        self._db.close()
+        # pylint: disable=no-member,protected-access
+        model_names = sorted(index._name for index in IngestState._meta.fields_to_index())
+        # pylint: enable=no-member,protected-access
+        self.assertEqual(index_names, model_names)
+        self.assertIn('ingeststate_state_updated', index_names)
+
+    def test_narrowed_index_migration(self):
+        """The migration should rebuild an index that lost one of its columns."""
+        self._db.connect()
+        self._db.execute_sql('DROP INDEX ingeststate_complete_updated')
+        self._db.execute_sql('CREATE INDEX ingeststate_complete_updated ON ingeststate (updated)')
+        with mock.patch('pacifica.ingest.orm.DB', self._db):
+            OrmSync.update_2_4_to_2_5()
+        index_columns = {index_md.name: index_md.columns for index_md in self._db.get_indexes('ingeststate')}
+        self._db.close()
+        self.assertEqual(index_columns['ingeststate_complete_updated'], ['complete', 'updated'])
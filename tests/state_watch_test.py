@@ -0,0 +1,70 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test waiting on ingest state changes."""
+from __future__ import absolute_import
+import os
+import json
+from threading import Thread
+import mock
+from pacifica.ingest.config import reload_config
+from pacifica.ingest import orm
+from pacifica.ingest.orm import STATE_WATCHER, update_state
+from pacifica.ingest.rest import state_events, wait_timeout
+from .ingest_db_setup_test import IngestFileDBSetup
+
+
+class TestStateWatch(IngestFileDBSetup):
+    """Test the long poll and event stream of the ingest state."""
+
+    def setUp(self):
+        """Poll the states quickly and wait a short time."""
+        super().setUp()
+        self.environ = mock.patch.dict(os.environ, {'STATE_POLL_INTERVAL': '0.05', 'STATE_WAIT_TIMEOUT': '5'})
+        self.environ.start()
+        reload_config()
+
+    def tearDown(self):
+        """Put back the configuration."""
+        self.environ.stop()
+        reload_config()
+        super().tearDown()
+
+    def test_wait_timeout(self):
+        """The current state should be returned once the timeout passed."""
+        update_state(1, 'OK', 'open tar', 0)
+        record = STATE_WATCHER.wait(1)
+        self.assertEqual(STATE_WATCHER.wait(1, str(record.updated), 0.1).task, 'open tar')
+        self.assertEqual(wait_timeout('600'), 5)
+        self.assertEqual(wait_timeout('-1'), 0)
+
+    def test_shared_poll(self):
+        """Many waiting clients should share the reads of the state."""
+        update_state(2, 'OK', 'open tar', 0)
+        since = str(STATE_WATCHER.wait(2).updated)
+        tasks = []
+
+        def waiter():
+            """Wait for the job to change state."""
+            tasks.append(STATE_WATCHER.wait(2, since, 5).task)
+        with mock.patch('pacifica.ingest.orm.read_states', side_effect=orm.read_states) as mock_read:
+            threads = [Thread(target=waiter) for _index in range(50)]
+            for thread in threads:
+                thread.start()
+            update_state(2, 'OK', 'load metadata', 0)
+            for thread in threads:
+                thread.join()
+        self.assertEqual(tasks, ['load metadata'] * 50)
+        self.assertLess(mock_read.call_count, 10)
+
+    def test_state_events(self):
+        """The event stream should send each change until the job is complete."""
+        update_state(3, 'OK', 'ingest files', 0)
+        record = STATE_WATCHER.wait(3)
+        events = state_events(record)
+        event = next(events).decode()
+        self.assertTrue(event.startswith('event: state\n'))
+        self.assertEqual(json.loads(event.split('data: ')[1])['task'], 'ingest files')
+        update_state(3, 'OK', 'ingest metadata', 100)
+        event = json.loads(next(events).decode().split('data: ')[1])
+        self.assertTrue(event['complete'])
+        self.assertEqual(list(events), [])
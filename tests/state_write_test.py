@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Test the pooled database and buffered ingest state writes."""
+from __future__ import absolute_import
+import os
+import json
+import tarfile
+from io import BytesIO
+from wsgiref.util import setup_testing_defaults
+import mock
+import cherrypy
+from playhouse.pool import PooledSqliteExtDatabase
+from pacifica.ingest.config import reload_config
+from pacifica.ingest.orm import IngestState, STATE_BUFFER, connect_database, update_state, read_state
+from pacifica.ingest.rest import Root
+from .ingest_db_setup_test import IngestFileDBSetup
+
+
+class TestStateWrite(IngestFileDBSetup):
+    """Test the single statement upsert and the write-behind buffer."""
+
+    def test_upsert(self):
+        """The state should be created and then updated in place."""
+        update_state(1, 'OK', 'open tar', 0)
+        created = read_state(1).created
+        update_state(1, 'OK', 'load metadata', 50)
+        record = read_state(1)
+        self.assertEqual((record.task, float(record.task_percent), record.created), ('load metadata', 50, created))
+        self.assertEqual(len(IngestState.select()), 1)
+
+    def test_write_behind(self):
+        """Progress should be coalesced while final states are written right away."""
+        update_state(1, 'OK', 'open tar', 0)
+        update_state(2, 'OK', 'open tar', 0)
+        with mock.patch.dict(os.environ, {'DATABASE_STATE_WRITE_BEHIND': '3600'}):
+            reload_config()
+            with mock.patch('pacifica.ingest.orm.write_state') as mock_write:
+                for percent in range(1, 51):
+                    update_state(1, 'OK', 'ingest files', percent)
+                    update_state(2, 'OK', 'ingest files', percent)
+                self.assertFalse(mock_write.called)
+            self.assertEqual(read_state(1).task, 'open tar')
+            update_state(2, 'FAILED', 'ingest files', 0, 'archive interface is down')
+            self.assertEqual(read_state(2).state, 'FAILED')
+            with mock.patch('pacifica.ingest.orm.write_state') as mock_write:
+                STATE_BUFFER.flush()
+            mock_write.assert_called_once_with(1, ('OK', 'ingest files', 50, ''))
+            STATE_BUFFER.flush()
+        reload_config()
+        self.assertEqual(read_state(2).state, 'FAILED')
+
+    @mock.patch('pacifica.ingest.rest.submit_job')
+    @mock.patch('pacifica.ingest.rest.get_unique_id', return_value=42)
+    def test_upload_write_behind(self, _get_unique_id, submit_job):
+        """The first state of an upload should be written so the upload can return it."""
+        tar_fd = BytesIO()
+        with tarfile.open(fileobj=tar_fd, mode='w') as tar:
+            info = tarfile.TarInfo('data/hello.txt')
+            info.size = 5
+            tar.addfile(info, BytesIO(b'hello'))
+        environ = {}
+        setup_testing_defaults(environ)
+        environ.update({
+            'REQUEST_METHOD': 'POST', 'PATH_INFO': '/upload', 'CONTENT_TYPE': 'application/octet-stream',
+            'CONTENT_LENGTH': str(len(tar_fd.getvalue())), 'wsgi.input': BytesIO(tar_fd.getvalue())
+        })
+        application = cherrypy.Application(Root(), '/', {
+            '/': {'request.dispatch': cherrypy.dispatch.MethodDispatcher()}
+        })
+        statuses = []
+        with mock.patch.dict(os.environ, {'DATABASE_STATE_WRITE_BEHIND': '3600', 'VOLUME_PATH': self.temp_dir.name}):
+            reload_config()
+            body = b''.join(application(environ, lambda status, headers: statuses.append(status)))
+            update_state(42, 'OK', 'open tar', 0)
+            self.assertEqual(read_state(42).task, 'UPLOADING')
+            STATE_BUFFER.flush()
+        reload_config()
+        self.assertEqual(statuses, ['200 OK'])
+        self.assertEqual(json.loads(body.decode())['task'], 'UPLOADING')
+        self.assertTrue(submit_job.called)
+        self.assertEqual(read_state(42).task, 'open tar')
+
+    def test_pool_url(self):
+        """The pool option should connect a pooled database."""
+        peewee_url = 'sqliteext:///{}'.format(os.path.join(self.temp_dir.name, 'pool.sqlite3'))
+        with mock.patch.dict(os.environ, {'DATABASE_POOL': 'True', 'PEEWEE_URL': peewee_url}):
+            reload_config()
+            database = connect_database()
+        reload_config()
+        self.assertIsInstance(database, PooledSqliteExtDatabase)
+        database.connect()
+        connection = database.connection()
+        database.close()
+        database.connect()
+        self.assertIs(database.connection(), connection)
+        database.close()
+        database.close_all()
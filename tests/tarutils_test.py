@@ -0,0 +1,388 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Unit tests for the tar utilities that do not need other services."""
+from __future__ import print_function, absolute_import
+import io
+import os
+import gzip
+import json
+import hashlib
+import tarfile
+import tracemalloc
+from time import sleep
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase, skipIf
+import mock
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+from pacifica.ingest.utils import JsonListReader
+from pacifica.ingest.config import reload_config
+from pacifica.ingest.tarutils import open_tar, member_index, MetaParser, get_clipped
+from pacifica.ingest.tarutils import receive_tar, tar_index_path, tar_metadata_path, remove_tar
+from pacifica.ingest.tarutils import TarIngester, HashValidationException, IngestFilesException
+from pacifica.ingest.tarutils import BundleCompressionException
+from pacifica.ingest.tarutils import patch_files
+from pacifica.ingest.tarutils import FileIngester, MappedMember, open_member, StreamedTar
+from .parallel_ingest_test import create_bundle, slow_put, ConcurrentCalls
+
+
+def create_empty_members(temp_dir, num_files):
+    """Create a tar file with num_files empty members."""
+    tar_path = join(temp_dir, 'members-{}.tar'.format(num_files))
+    with tarfile.open(tar_path, 'w:') as tar:
+        for file_index in range(num_files):
+            tar.addfile(tarfile.TarInfo('data/a/file.{}.txt'.format(file_index)), io.BytesIO())
+    return tar_path
+
+
+class TestMemberIndex(TestCase):
+    """Test the tar member index."""
+
+    def test_member_index_lookup(self):
+        """The index should return the same members as getmember."""
+        with TemporaryDirectory() as temp_dir:
+            tar = open_tar(create_empty_members(temp_dir, 10))
+            index = member_index(tar)
+            for info in tar.getmembers():
+                self.assertEqual(index[info.name], tar.getmember(info.name))
+            tar.close()
+
+    def test_member_index_scan_once(self):
+        """The index should scan the members once and never search the member list."""
+        with TemporaryDirectory() as temp_dir:
+            tar = open_tar(create_empty_members(temp_dir, 2000))
+            names = [info.name for info in tar.getmembers()]
+            # pylint: disable=protected-access
+            with mock.patch.object(tar, 'getmembers', wraps=tar.getmembers) as getmembers, \
+                    mock.patch.object(tar, '_getmember', side_effect=AssertionError('member list searched')):
+                index = member_index(tar)
+                for name in names:
+                    self.assertEqual(index[name].name, name)
+            # pylint: enable=protected-access
+            tar.close()
+        self.assertEqual(getmembers.call_count, 1)
+
+
+class TestTarIndex(TestCase):
+    """Test the tar index sidecar written while receiving a tar file."""
+
+    def test_receive_tar(self):
+        """The members loaded from the sidecar should match the tar headers."""
+        with TemporaryDirectory() as temp_dir:
+            src_path = join(temp_dir, 'src.tar')
+            with tarfile.open(src_path, 'w:') as tar:
+                for name in ['data/short.txt', 'data/{}.txt'.format('long' * 50)]:
+                    info = tarfile.TarInfo(name)
+                    info.size = len(name)
+                    tar.addfile(info, io.BytesIO(name.encode('utf8')))
+            dst_path = join(temp_dir, 'dst.tar')
+            with open(src_path, 'rb') as src_fd:
+                receive_tar(src_fd, dst_path, 512, 'sha1')
+            with open(src_path, 'rb') as src_fd, open(dst_path, 'rb') as dst_fd:
+                self.assertEqual(src_fd.read(), dst_fd.read())
+            self.assertTrue(os.path.exists(tar_index_path(dst_path)))
+            tar = open_tar(dst_path)
+            self.assertEqual(tar.hashtype, 'sha1')
+            self.assertEqual(
+                tar.digests['data/short.txt'], hashlib.sha1(b'data/short.txt').hexdigest())
+            with mock.patch.object(tar, 'next', side_effect=AssertionError('headers scanned')):
+                for info in tar.getmembers():
+                    self.assertEqual(tar.extractfile(info.name).read(), info.name.encode('utf8'))
+                members = [(info.name, info.offset_data, info.size) for info in tar.getmembers()]
+            tar.close()
+            tar = open_tar(src_path)
+            self.assertEqual(members, [(info.name, info.offset_data, info.size) for info in tar.getmembers()])
+            tar.close()
+            remove_tar(dst_path)
+            self.assertFalse(os.path.exists(tar_index_path(dst_path)))
+
+    @mock.patch('requests.Session.put')
+    @mock.patch('pacifica.ingest.tarutils.get_unique_id', return_value=1000)
+    def test_receive_bad_hash(self, _mock_id, mock_put):
+        """A bad hash should be found from the received digests before any upload."""
+        with TemporaryDirectory() as temp_dir:
+            dst_path = join(temp_dir, 'dst.tar')
+            with open(create_bundle(temp_dir, 4, bad_hash=True), 'rb') as src_fd:
+                receive_tar(src_fd, dst_path, 512, 'sha1')
+            tar = open_tar(dst_path)
+            meta = MetaParser()
+            meta.load_meta(tar, 1)
+            with self.assertRaises(HashValidationException):
+                TarIngester(tar, meta, 1).ingest()
+            tar.close()
+        self.assertFalse(mock_put.called)
+
+    def test_receive_not_tar(self):
+        """Data that is not a tar file should be copied without a sidecar."""
+        with TemporaryDirectory() as temp_dir:
+            dst_path = join(temp_dir, 'dst.tar')
+            receive_tar(io.BytesIO(b'not a tar file' * 100), dst_path, 512)
+            with open(dst_path, 'rb') as dst_fd:
+                self.assertEqual(dst_fd.read(), b'not a tar file' * 100)
+            self.assertFalse(os.path.exists(tar_index_path(dst_path)))
+
+
+@mock.patch('requests.Session.put', side_effect=slow_put)
+@mock.patch('pacifica.ingest.tarutils.get_unique_id', return_value=1000)
+class TestCompressedBundle(TestCase):
+    """Test receiving and ingesting compressed bundles."""
+
+    @staticmethod
+    def compress_bundle(temp_dir, compression):
+        """Create a bundle and return the path of a compressed copy."""
+        bundle_path = create_bundle(temp_dir, 8)
+        compressed_path = '{}.{}'.format(bundle_path, compression)
+        with tarfile.open(bundle_path, 'r:') as src, tarfile.open(compressed_path, 'w:' + compression) as dst:
+            for info in src.getmembers():
+                dst.addfile(info, src.extractfile(info))
+        return compressed_path
+
+    def ingest_bundle(self, bundle_path, mock_put):
+        """Ingest the bundle and check every file was uploaded once."""
+        tar = open_tar(bundle_path)
+        self.assertIsInstance(tar, StreamedTar)
+        meta = MetaParser()
+        meta.load_meta(tar, 1)
+        TarIngester(tar, meta, 4).ingest()
+        tar.close()
+        self.assertEqual(mock_put.call_count, 8)
+
+    def test_receive_compressed(self, _mock_id, mock_put):
+        """A received compressed bundle should be indexed, hashed and ingested in one pass."""
+        for compression in ['gz', 'bz2', 'xz']:
+            mock_put.reset_mock()
+            with TemporaryDirectory() as temp_dir:
+                dst_path = join(temp_dir, 'dst.tar')
+                with open(self.compress_bundle(temp_dir, compression), 'rb') as src_fd:
+                    members = receive_tar(src_fd, dst_path, 512, 'sha1')
+                self.assertEqual(len(members), 9)
+                self.assertTrue(os.path.exists(tar_metadata_path(dst_path)))
+                tar = open_tar(dst_path)
+                self.assertEqual(tar.compression, compression)
+                self.assertEqual(
+                    tar.digests['data/a/file.0.txt'], hashlib.sha1(b'This is a temp file 0.').hexdigest())
+                with mock.patch.object(tar, 'stream', side_effect=AssertionError('stream scanned')):
+                    self.assertEqual(len(tar.getmembers()), 9)
+                    self.assertEqual(len(json.loads(tar.extractfile('metadata.txt').read().decode('utf8'))), 8)
+                self.ingest_bundle(dst_path, mock_put)
+                remove_tar(dst_path)
+                self.assertFalse(os.path.exists(tar_metadata_path(dst_path)))
+
+    def test_compressed_without_index(self, _mock_id, mock_put):
+        """A compressed bundle without sidecars should be scanned before the upload."""
+        with TemporaryDirectory() as temp_dir:
+            self.ingest_bundle(self.compress_bundle(temp_dir, 'gz'), mock_put)
+
+    def test_corrupt_compressed(self, *_mocks):
+        """A compressed bundle that can not be decompressed should not be received."""
+        with TemporaryDirectory() as temp_dir:
+            with open(self.compress_bundle(temp_dir, 'gz'), 'rb') as bundle_fd:
+                data = bundle_fd.read()
+            with self.assertRaises(BundleCompressionException):
+                receive_tar(io.BytesIO(data[:len(data) // 2]), join(temp_dir, 'dst.tar'), 512, 'sha1')
+
+    @skipIf(zstandard is None, 'zstandard module is not available')
+    def test_corrupt_zstd(self, *_mocks):
+        """A zstd error should be raised like the errors of the other decompressors."""
+        with TemporaryDirectory() as temp_dir:
+            with open(create_bundle(temp_dir, 8), 'rb') as bundle_fd:
+                data = zstandard.ZstdCompressor().compress(bundle_fd.read())
+            with self.assertRaises(BundleCompressionException):
+                receive_tar(io.BytesIO(data[:4] + b'\xff' * 16 + data[20:]), join(temp_dir, 'dst.tar'), 512)
+
+    def test_compressed_missing_file(self, *_mocks):
+        """Files in the metadata that are not in the stream should fail the ingest."""
+        with TemporaryDirectory() as temp_dir:
+            tar = open_tar(self.compress_bundle(temp_dir, 'gz'))
+            meta = MetaParser()
+            meta.load_meta(tar, 1)
+            next(iter(meta.files.values())).name = 'missing.txt'
+            with self.assertRaises(KeyError):
+                TarIngester(tar, meta).ingest()
+
+
+class TestMappedMember(TestCase):
+    """Test reading members from a memory map against tarfile reads."""
+
+    member_size = int(os.getenv('BENCHMARK_MEMBER_SIZE', '0'))
+
+    @staticmethod
+    def read_member(tar, info, use_mmap):
+        """Read and hash the member like a file upload and return the digest and peak memory."""
+        ingest = FileIngester('sha1', '', 1)
+        ingest.fileobj = open_member(tar, info) if use_mmap else tar.extractfile(info)
+        tracemalloc.start()
+        while ingest.read(16 * 1024):
+            pass
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        ingest.fileobj.close()
+        return ingest.hashval.hexdigest(), peak
+
+    @skipIf(not member_size, 'set BENCHMARK_MEMBER_SIZE to the member size in bytes to run the benchmark')
+    def test_mapped_member_benchmark(self):
+        """The memory map should hash the same data with less allocation."""
+        with TemporaryDirectory() as temp_dir:
+            tar_path = join(temp_dir, 'big.tar')
+            with tarfile.open(tar_path, 'w:') as tar:
+                info = tarfile.TarInfo('data/big.bin')
+                info.size = self.member_size
+                tar.addfile(info, io.BytesIO(os.urandom(1024) * (self.member_size // 1024)))
+            tar = open_tar(tar_path)
+            info = tar.getmember('data/big.bin')
+            self.assertIsInstance(open_member(tar, info), MappedMember)
+            copy_digest, copy_peak = self.read_member(tar, info, False)
+            mmap_digest, mmap_peak = self.read_member(tar, info, True)
+            tar.close()
+        self.assertEqual(copy_digest, mmap_digest)
+        self.assertLessEqual(mmap_peak, copy_peak)
+
+    def test_mapped_member_seek(self):
+        """The mapped member should read and seek like a file."""
+        member = MappedMember(memoryview(b'0123456789'), 4)
+        self.assertEqual(bytes(member.read(2)), b'0123')
+        self.assertEqual(member.seek(-2, 2), 8)
+        self.assertEqual(bytes(member.read()), b'89')
+        self.assertEqual(member.seek(-9, 1), 1)
+        self.assertEqual(member.tell(), 1)
+        member.close()
+
+
+class TestMetaParser(TestCase):
+    """Test the incremental metadata parser."""
+
+    md_file = join('test_data', 'metadata-files', 'good-md.json')
+
+    def test_json_list_reader(self):
+        """The reader should decode the same elements as json.loads."""
+        for text in ['[]', ' [ 1 , 23456, "ab\\"c" ] ', '[{"a": [1, {"b": null}]}, 2.5]']:
+            for chunk_size in [1, 3, 64]:
+                self.assertEqual(
+                    list(JsonListReader(io.StringIO(text), chunk_size)), json.loads(text))
+        with open(self.md_file, 'rb') as md_fd:
+            self.assertEqual(list(JsonListReader(md_fd, 7)), json.loads(open(self.md_file).read()))
+        for text in ['', '{}', '[1, 2', '[1 2]', '[1], 2', '[{"a": }]']:
+            with self.assertRaises(ValueError):
+                list(JsonListReader(io.StringIO(text), 2))
+
+    @mock.patch('pacifica.ingest.tarutils.get_unique_id', return_value=1000)
+    def test_meta_str(self, _mock_id):
+        """The metadata output should match the previous format."""
+        meta_list = json.loads(open(self.md_file).read())
+        file_id = 1000
+        for meta in meta_list:
+            if meta['destinationTable'] == 'Files':
+                meta['_id'] = file_id
+                file_id += 1
+        meta_list.append({'destinationTable': 'Transactions._id', 'value': 1})
+        meta = MetaParser()
+        meta.read_meta(self.md_file, 1)
+        self.assertEqual(meta.meta_str, json.dumps(meta_list, sort_keys=True, indent=4))
+        self.assertEqual(meta.get_hash('1001'), ('sha1', 'e242ed3bffccdf271b7fbaf34ed72d089537b42f'))
+        for meta_entry in meta_list:
+            if meta_entry['destinationTable'] == 'Files':
+                meta_entry['subdir'] = get_clipped(meta_entry['subdir'])
+        meta.clean_metadata()
+        self.assertEqual(meta.meta_str, json.dumps(meta_list, sort_keys=True, indent=4))
+
+    @mock.patch('pacifica.ingest.tarutils.get_unique_id', return_value=1000)
+    def test_request_body(self, _mock_id):
+        """The streamed and compressed bodies should hold the same metadata."""
+        meta = MetaParser()
+        meta.read_meta(self.md_file, 1)
+        meta.clean_metadata()
+        headers, body = meta.request_body('metadata')
+        self.assertEqual(body, meta.meta_str)
+        self.assertNotIn('content-encoding', headers)
+        for stream, compress in [('True', 'False'), ('False', 'True'), ('True', 'True')]:
+            with mock.patch.dict(os.environ, {
+                    'METADATA_STREAM_BODY': stream, 'METADATA_COMPRESS_BODY': compress}):
+                reload_config()
+                headers, body = meta.request_body('metadata')
+            if stream == 'True':
+                body = b''.join(body)
+            if compress == 'True':
+                self.assertEqual(headers['content-encoding'], 'gzip')
+                body = gzip.decompress(body)
+            self.assertEqual(json.loads(body.decode('utf8')), json.loads(meta.meta_str))
+            if stream == 'True':
+                self.assertLess(len(body), len(meta.meta_str.encode('utf8')))
+        reload_config()
+
+
+def slow_patch(*_args, **_kwargs):
+    """Fake archive interface patch with network latency."""
+    sleep(0.02)
+    resp = mock.Mock()
+    resp.json.return_value = {'message': 'File Moved Successfully'}
+    return resp
+
+
+@mock.patch('requests.Session.patch', side_effect=slow_patch)
+@mock.patch('pacifica.ingest.tarutils.get_unique_id', return_value=1000)
+class TestPatchFiles(TestCase):
+    """Test moving files with the archive interface."""
+
+    @staticmethod
+    def move_meta(temp_dir, num_files):
+        """Create num_files source files and return the metadata to move them."""
+        meta_list = []
+        for file_index in range(num_files):
+            source = join(temp_dir, 'file.{}.txt'.format(file_index))
+            with open(source, 'w') as source_fd:
+                source_fd.write('This is a temp file {}.'.format(file_index))
+            meta_list.append({
+                'destinationTable': 'Files', 'name': 'file.{}.txt'.format(file_index),
+                'subdir': 'data/a', 'hashtype': 'sha1', 'hashsum': '',
+                'size': os.path.getsize(source), 'source': source
+            })
+        meta = MetaParser()
+        meta.parse_meta(io.StringIO(json.dumps(meta_list)))
+        return meta
+
+    def test_patch_concurrency(self, _mock_id, mock_patch):
+        """The concurrent move should have more than one patch running at once."""
+        with TemporaryDirectory() as temp_dir:
+            meta = self.move_meta(temp_dir, 32)
+            mock_patch.side_effect = ConcurrentCalls(slow_patch)
+            patch_files(meta, 1)
+            self.assertEqual(mock_patch.side_effect.peak, 1)
+            mock_patch.side_effect = ConcurrentCalls(slow_patch)
+            patch_files(meta, 8)
+            self.assertGreater(mock_patch.side_effect.peak, 1)
+        self.assertEqual(mock_patch.call_count, 64)
+
+    def test_preflight(self, _mock_id, mock_patch):
+        """Every bad source should be reported before any file is moved when the preflight is on."""
+        with TemporaryDirectory() as temp_dir:
+            meta = self.move_meta(temp_dir, 4)
+            os.unlink(join(temp_dir, 'file.1.txt'))
+            with open(join(temp_dir, 'file.2.txt'), 'a') as source_fd:
+                source_fd.write('more data')
+            with mock.patch.dict(os.environ, {'MOVE_PREFLIGHT': 'True'}):
+                reload_config()
+                with self.assertRaises(IngestFilesException) as context:
+                    patch_files(meta, 4)
+            reload_config()
+            self.assertEqual(len(str(context.exception).splitlines()), 2)
+            self.assertFalse(mock_patch.called)
+            patch_files(meta, 4)
+        self.assertEqual(mock_patch.call_count, 4)
+
+    def test_patch_failures(self, _mock_id, mock_patch):
+        """Every failed patch should be reported after all files are tried."""
+        def bad_patch(url, **_kwargs):
+            """Fail to move the odd file IDs."""
+            resp = mock.Mock()
+            failed = int(url.rsplit('/', 1)[1]) % 2
+            resp.json.return_value = {'message': 'Failed' if failed else 'File Moved Successfully'}
+            return resp
+        mock_patch.side_effect = bad_patch
+        with TemporaryDirectory() as temp_dir:
+            with self.assertRaises(IngestFilesException) as context:
+                patch_files(self.move_meta(temp_dir, 6), 3)
+        self.assertEqual(mock_patch.call_count, 6)
+        self.assertEqual(len(str(context.exception).splitlines()), 3)
@@ -2,10 +2,16 @@
 # -*- coding: utf-8 -*-
 """Test ingest."""
 import os
+from tempfile import mkstemp
+from threading import Thread
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
 import mock
 import peewee
 import requests
 from pacifica.ingest.orm import OrmSync, IngestState
+from pacifica.ingest.config import get_config, reload_config
+from pacifica.ingest.utils import SessionPool, UniqueIdLease
 
 
 @mock.patch.object(IngestState, 'database_connect')
@@ -16,6 +22,7 @@ def test_bad_db_connection(mock_is_table_exists):
     hit_exception = False
     os.environ['DATABASE_CONNECT_ATTEMPTS'] = '1'
     os.environ['DATABASE_CONNECT_WAIT'] = '1'
+    reload_config()
     try:
         OrmSync.dbconn_blocking()
     except peewee.OperationalError:
@@ -23,9 +30,122 @@ def test_bad_db_connection(mock_is_table_exists):
     assert hit_exception
 
 
+def test_config_cache():
+    """Test the config is cached, read only and reloaded on change."""
+    assert get_config() is get_config()
+    hit_exception = False
+    try:
+        get_config().set('ingest', 'volume_path', '/')
+    except TypeError:
+        hit_exception = True
+    assert hit_exception
+    rwfd, fname = mkstemp()
+    os.close(rwfd)
+    with mock.patch('pacifica.ingest.config.CONFIG_FILE', fname), \
+            mock.patch('pacifica.ingest.config.CONFIG_CHECK_INTERVAL', 0):
+        config = reload_config()
+        assert get_config() is config
+        with open(fname, 'w') as config_fd:
+            config_fd.write('[ingest]\nvolume_path = /srv\n')
+        os.utime(fname, (0, 0))
+        assert get_config() is not config
+        assert get_config().get('ingest', 'volume_path') == '/srv'
+    os.unlink(fname)
+    reload_config()
+
+
+# pylint: disable=too-few-public-methods
+class FakeIdServer:
+    """Hand out ranges of ids and count the requests."""
+
+    def __init__(self):
+        """Start the ids at one."""
+        self.next_id = 1
+        self.requests = 0
+
+    def request(self, id_range, mode):  # pylint: disable=unused-argument
+        """Return the start of the next range of ids."""
+        self.requests += 1
+        start_id = self.next_id
+        self.next_id += id_range
+        return start_id
+# pylint: enable=too-few-public-methods
+
+
+def test_unique_id_lease():
+    """Test leased ids are unique, contiguous and rarely requested."""
+    id_server = FakeIdServer()
+    with mock.patch('pacifica.ingest.utils.request_unique_id', side_effect=id_server.request):
+        lease = UniqueIdLease('upload_job', 100)
+        ids = []
+        threads = [
+            Thread(target=lambda: ids.extend(lease.allocate(1) for _index in range(50)))
+            for _thread in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        file_start = lease.allocate(10)
+        big_start = lease.allocate(1000)
+    assert len(set(ids)) == 200
+    assert file_start not in ids and file_start + 9 not in ids
+    assert big_start >= max(ids)
+    assert id_server.requests < 10
+
+
 def test_rest_root_status():
     """Test the root level status page."""
     resp = requests.get('http://127.0.0.1:8066')
     assert resp.status_code == 200, 'Status code should be 200 OK'
     assert 'message' in resp.json(), 'Status should be object with message key.'
     assert resp.json()['message'] == 'Pacifica Ingest Up and Running', 'message should be specific.'
+
+
+class KeepAliveServer(ThreadingMixIn, HTTPServer):
+    """Threaded server so open keep-alive connections do not block shutdown."""
+
+    daemon_threads = True
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    """Respond to every get with an empty keep-alive response."""
+
+    protocol_version = 'HTTP/1.1'
+
+    # pylint: disable=invalid-name
+    def do_GET(self):
+        """Send the empty response."""
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    # pylint: enable=invalid-name
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Do not log requests."""
+
+
+def test_session_pool_reuse():
+    """Test the sessions are shared and reuse connections."""
+    server = KeepAliveServer(('127.0.0.1', 0), KeepAliveHandler)
+    server_thread = Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    pool = SessionPool()
+    session = pool.get('uniqueid')
+    assert pool.get('uniqueid') is session
+    assert pool.get('metadata') is not session
+    for _index in range(5):
+        session.get('http://127.0.0.1:{}/'.format(server.server_port))
+    server.shutdown()
+    stats = pool.stats()
+    assert stats['uniqueid'] == {'connections': 1, 'requests': 5}
+    assert stats['metadata'] == {'connections': 0, 'requests': 0}
+
+
+def test_session_pool_fork():
+    """Test a forked process gets new sessions."""
+    pool = SessionPool()
+    session = pool.get('uniqueid')
+    with mock.patch('pacifica.ingest.utils.getpid', return_value=-1):
+        assert pool.get('uniqueid') is not session